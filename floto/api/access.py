@@ -0,0 +1,73 @@
+import uuid
+from functools import cached_property
+
+from rest_framework.exceptions import ValidationError
+
+from floto.api.models import DeviceData
+
+
+class AccessContext:
+    """
+    The requesting user's projects, looked up at most once per request, and
+    shared by the permissions, filters, serializers and templates.
+    """
+
+    def __init__(self, request):
+        self.user = request.user
+        self._active_project_pk = request.GET.get("active_project")
+
+    @cached_property
+    def projects(self):
+        if not self.user.is_authenticated:
+            return []
+        return list(self.user.projects.all())
+
+    @cached_property
+    def project_ids(self):
+        return {p.pk for p in self.projects}
+
+    @cached_property
+    def active_project(self):
+        """
+        The project given by the active_project query parameter, if the user is
+        a member of it. Raises ValidationError if it is not a project id.
+        """
+        if not self._active_project_pk:
+            return None
+        try:
+            active_project_pk = uuid.UUID(self._active_project_pk)
+        except ValueError:
+            raise ValidationError({"active_project": ["Not a valid project id."]})
+        return next((p for p in self.projects if p.pk == active_project_pk), None)
+
+    def is_member(self, project):
+        return project.pk in self.project_ids
+
+    def device_access(self, device_uuids, active_project=None):
+        """
+        Returns {device uuid: (management access, application access)} for the
+        devices that exist, see DeviceData.get_access. Access is through any of
+        the user's projects, unless active_project is given.
+        """
+        if not self.user.is_authenticated:
+            # Anonymous users have no access, even to devices open to all
+            return {
+                device_uuid: (False, False)
+                for device_uuid in DeviceData.objects.filter(
+                    device_uuid__in=device_uuids
+                ).values_list("device_uuid", flat=True)
+            }
+        return DeviceData.get_access(device_uuids, self.project_ids, active_project)
+
+
+def get_access_context(request):
+    """
+    Returns the AccessContext of the request, which is either a Django or a DRF
+    request. It is kept on the Django request, so both share it.
+    """
+    request = getattr(request, "_request", request)
+    access = getattr(request, "_floto_access", None)
+    if access is None or access.user is not request.user:
+        access = AccessContext(request)
+        request._floto_access = access
+    return access
@@ -10,9 +10,11 @@ from django.utils.translation import gettext_lazy as _
 from django.http import HttpResponse
 from django.shortcuts import redirect, render
 from django.urls import path
+from django.utils.html import format_html_join
+from django.utils.safestring import mark_safe
 
 from floto.api.balena import get_balena_client
-from floto.api.tasks import bulk_device_update_csv_reader
+from floto.api.tasks import import_devices
 
 from . import models
 
@@ -96,12 +98,21 @@ class ApplicationAdmin(SoftDeleteAdmin):
 admin.site.register(models.Application, ApplicationAdmin)
 
 
+class DeviceDeploymentInline(nested_admin.NestedTabularInline):
+    model = models.DeviceDeployment
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 class EventInline(nested_admin.NestedStackedInline):
     model = models.Event
 
     def has_add_permission(self, request, obj=None):
         return False
 
+    inlines = [DeviceDeploymentInline]
+
 
 class JobTimeslotInline(nested_admin.NestedStackedInline):
     model = models.JobTiming
@@ -344,28 +355,21 @@ class DeviceDataAdmin(admin.ModelAdmin):
 
     def import_device_update_CSV(self, request):
         if request.method == "POST":
-            csv_file = request.FILES["csv_file"]
+            csv_file = request.FILES.get("csv_file")
             try:
                 if not csv_file:
                     self.message_user(request, "CSV file is required.", "error")
                     raise Exception
                 try:
-                    decoded_file = csv_file.read().decode("utf-8").splitlines()
-                    reader = csv.DictReader(decoded_file)
-                except Exception as e:
-                    self.message_user(request, "Error with CSV file", "error")
-                    raise e
-                try:
-                    reader = csv.DictReader(decoded_file)
-                except csv.Error as e:
-                    self.message_user(
-                        request, f"Error with CSV file updated: {e}", "error"
-                    )
+                    first_line = csv_file.readline().decode("utf-8-sig")
+                    header = next(csv.reader([first_line]))
+                except (UnicodeDecodeError, StopIteration, csv.Error) as e:
+                    self.message_user(request, f"Error with CSV file: {e}", "error")
                     raise e
                 missing_columns = [
                     col
                     for col in models.DeviceData.device_update_columns
-                    if col not in reader.fieldnames
+                    if col not in header
                 ]
                 if missing_columns:
                     self.message_user(
@@ -378,11 +382,16 @@ class DeviceDataAdmin(admin.ModelAdmin):
                 # if exceptions, return to form page and show error message
                 pass
             else:
-                devices_data = [row for row in reader]
+                csv_file.seek(0)
+                device_import = models.DeviceImport.objects.create(
+                    created_by=request.user, csv_file=csv_file
+                )
                 # trigger a celery task to process the CSV
-                bulk_device_update_csv_reader.delay(devices_data)
+                transaction.on_commit(lambda: import_devices.delay(device_import.pk))
                 self.message_user(request, "Your csv file is importing", "info")
-                return redirect("..")
+                return redirect(
+                    "admin:floto_api_deviceimport_change", device_import.pk
+                )
         form = CsvImportForm()
         payload = {"form": form}
         return render(request, "admin/csv_form.html", payload)
@@ -391,6 +400,56 @@ class DeviceDataAdmin(admin.ModelAdmin):
 admin.site.register(models.DeviceData, DeviceDataAdmin)
 
 
+class DeviceImportAdmin(admin.ModelAdmin):
+    list_display = [
+        "created_at",
+        "created_by",
+        "csv_file",
+        "status",
+        "progress",
+        "updated_rows",
+        "error_count",
+    ]
+    list_filter = ["status"]
+    readonly_fields = [
+        "created_at",
+        "created_by",
+        "csv_file",
+        "status",
+        "progress",
+        "updated_rows",
+        "row_errors",
+        "finished_at",
+    ]
+    exclude = ["total_rows", "processed_rows", "errors"]
+    ordering = ("-created_at",)
+
+    def has_add_permission(self, request):
+        # Imports are uploaded from the devices page
+        return False
+
+    @admin.display(description="Progress")
+    def progress(self, obj):
+        if obj.total_rows is None:
+            return "-"
+        return f"{obj.processed_rows} / {obj.total_rows} rows"
+
+    @admin.display(description="Errors")
+    def error_count(self, obj):
+        return len(obj.errors)
+
+    @admin.display(description="Errors")
+    def row_errors(self, obj):
+        return format_html_join(
+            mark_safe("<br>"),
+            "Row {}: {} ({})",
+            ((e["row"], e["error"], e["device_uuid"]) for e in obj.errors),
+        )
+
+
+admin.site.register(models.DeviceImport, DeviceImportAdmin)
+
+
 class PeripheralSchemaResourceInline(admin.TabularInline):
     model = models.PeripheralSchemaResource
 
@@ -1,21 +1,176 @@
 from django.conf import settings
+from django.core.cache import cache
 
 import balena
+import base64
+import binascii
+import json
 import logging
+import os
+import threading
+import time
 
 LOG = logging.getLogger(__name__)
 
 
+class BalenaClientManager:
+    """
+    Shares one authenticated balena client per process. The client logs in once,
+    and logs in again shortly before its token expires, instead of on every call,
+    or when balena rejects its session, e.g. because it was revoked.
+    """
+
+    def __init__(self):
+        self._reset()
+        # Locks and sessions must not be shared with forked children, e.g. celery
+        # prefork workers, so each child starts with its own client.
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._client = None
+        self._expires_at = 0
+        self.login_count = 0
+        self.login_seconds = 0.0
+        self.client_requests = 0
+
+    def _new_client(self):
+        balena_client = balena.Balena()
+        balena_client.settings.set("api_endpoint", settings.BALENA_API_ENDPOINT)
+        balena_client.settings.set("pine_endpoint", settings.BALENA_PINE_ENDPOINT)
+        request = balena_client.pine._request
+
+        def request_with_login(*args, **kwargs):
+            token = balena_client.settings.get("token")
+            try:
+                return request(*args, **kwargs)
+            except balena.exceptions.RequestError as e:
+                if e.status_code != 401:
+                    raise
+            self._login_again(balena_client, token)
+            return request(*args, **kwargs)
+
+        balena_client.pine._request = request_with_login
+        return balena_client
+
+    def _login_again(self, balena_client, rejected_token):
+        with self._lock:
+            # Another thread may have logged in again already
+            if balena_client.settings.get("token") == rejected_token:
+                LOG.warning("Balena rejected the session, logging in again")
+                self._login(balena_client)
+
+    def _login(self, balena_client):
+        start = time.monotonic()
+        credentials = {
+            "username": settings.BALENA_USERNAME,
+            "password": settings.BALENA_PASSWORD,
+        }
+        balena_client.auth.login(**credentials)
+        elapsed = time.monotonic() - start
+
+        self.login_count += 1
+        self.login_seconds += elapsed
+        self._expires_at = self._get_token_expiry(balena_client.settings.get("token"))
+        LOG.info(
+            f"Logged in to balena in {elapsed:.2f}s "
+            f"({self.login_count} logins for {self.client_requests} requests)"
+        )
+        return balena_client
+
+    @staticmethod
+    def _get_token_expiry(token):
+        # Only the expiry is read from the token, so its signature is not checked
+        try:
+            payload = token.split(".")[1]
+            padding = "=" * (-len(payload) % 4)
+            claims = json.loads(base64.urlsafe_b64decode(payload + padding))
+            return float(claims.get("exp", float("inf")))
+        except (AttributeError, IndexError, binascii.Error, ValueError, TypeError):
+            # Not a JWT, e.g. an API key, which does not expire
+            return float("inf")
+
+    def get_client(self):
+        with self._lock:
+            self.client_requests += 1
+            refresh_at = self._expires_at - settings.BALENA_TOKEN_REFRESH_MARGIN
+            if self._client is None:
+                self._client = self._login(self._new_client())
+            elif time.time() >= refresh_at:
+                self._login(self._client)
+            if self.client_requests % settings.BALENA_STATS_LOG_INTERVAL == 0:
+                LOG.info(f"Balena client stats: {self.stats()}")
+            return self._client
+
+    def stats(self):
+        return {
+            "login_count": self.login_count,
+            "login_seconds": self.login_seconds,
+            "client_requests": self.client_requests,
+            # None for tokens that do not expire
+            "token_expires_at": (
+                None if self._expires_at == float("inf") else self._expires_at
+            ),
+        }
+
+
+client_manager = BalenaClientManager()
+
+
 def get_balena_client():
-    balena_client = balena.Balena()
-    balena_client.settings.set("api_endpoint", settings.BALENA_API_ENDPOINT)
-    balena_client.settings.set("pine_endpoint", settings.BALENA_PINE_ENDPOINT)
-    credentials = {
-        "username": settings.BALENA_USERNAME,
-        "password": settings.BALENA_PASSWORD,
-    }
-    balena_client.auth.login(**credentials)
-    return balena_client
+    return client_manager.get_client()
+
+
+def _env_var_cache_key(device_uuid):
+    return f"balena-env-vars:{device_uuid}"
+
+
+def get_device_env_vars(device_uuids, chunk_size=200):
+    """
+    Returns {device uuid: [environment variable]} for the devices. Variables are
+    kept for BALENA_ENV_VAR_CACHE_TTL seconds; the rest are fetched with one
+    pine query for the device ids, and one for their variables, per chunk.
+    Devices unknown to balena are left out.
+    """
+    keys = {_env_var_cache_key(uuid): uuid for uuid in device_uuids}
+    env_vars = {keys[key]: value for key, value in cache.get_many(keys).items()}
+    missing = [uuid for uuid in keys.values() if uuid not in env_vars]
+    if not missing:
+        return env_vars
+
+    balena_client = get_balena_client()
+    fetched = {}
+    for i in range(0, len(missing), chunk_size):
+        devices = balena_client.pine.get(
+            {
+                "resource": "device",
+                "options": {
+                    "$select": ["id", "uuid"],
+                    "$filter": {"uuid": {"$in": missing[i : i + chunk_size]}},
+                },
+            }
+        )
+        device_uuids_by_id = {d["id"]: d["uuid"] for d in devices}
+        if not device_uuids_by_id:
+            continue
+        fetched.update({uuid: [] for uuid in device_uuids_by_id.values()})
+        for env_var in balena_client.pine.get(
+            {
+                "resource": "device_environment_variable",
+                "options": {
+                    "$filter": {"device": {"$in": list(device_uuids_by_id)}},
+                    "$orderby": "name asc",
+                },
+            }
+        ):
+            fetched[device_uuids_by_id[env_var["device"]["__id"]]].append(env_var)
+
+    cache.set_many(
+        {_env_var_cache_key(uuid): value for uuid, value in fetched.items()},
+        timeout=settings.BALENA_ENV_VAR_CACHE_TTL,
+    )
+    env_vars.update(fetched)
+    return env_vars
 
 
 def with_balena():
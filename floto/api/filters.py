@@ -2,8 +2,8 @@ import logging
 
 from django.db.models import Q
 from rest_framework import filters
-from floto.api import kubernetes
 
+from floto.api.access import get_access_context
 from floto.api.models import DeviceData, PeripheralSchema
 from floto.api.serializers import DeviceSerializer
 
@@ -17,10 +17,8 @@ class HasReadAccessFilterBackend(filters.BaseFilterBackend):
         - public
         - owned by the current user
         """
-        active_project = None
-        active_project_pk = request.query_params.get("active_project")
-        if active_project_pk:
-            active_project = request.user.projects.filter(pk=active_project_pk).first()
+        access = get_access_context(request)
+        active_project = access.active_project
 
         if request.user.is_anonymous:
             return queryset.filter(Q(is_public=True))
@@ -30,44 +28,47 @@ class HasReadAccessFilterBackend(filters.BaseFilterBackend):
             )
         else:
             return queryset.filter(
-                Q(created_by_project__in=request.user.projects.all())
-                | Q(is_public=True)
+                Q(created_by_project__in=access.project_ids) | Q(is_public=True)
             )
 
 
 class DeviceFilter(filters.BaseFilterBackend):
     def filter_queryset(self, request, devices, view):
         filtered_devices = []
-        try:
-            nodes = kubernetes.get_nodes()
-        except Exception as e:
-            LOG.error(e)
-            nodes = []
+        nodes_by_id = view.device_snapshot.kubernetes_nodes
 
-        nodes_by_id = {node.metadata.name: node for node in nodes}
+        access = get_access_context(request)
 
-        active_project = None
-        active_project_pk = request.query_params.get("active_project")
-        if active_project_pk:
-            active_project = request.user.projects.filter(pk=active_project_pk).first()
+        devices = list(devices)
+        device_data_by_uuid = {
+            d.device_uuid: d
+            for d in DeviceSerializer.setup_eager_loading(
+                DeviceData.objects.filter(device_uuid__in=[d["uuid"] for d in devices])
+            )
+        }
+        # Shared by every device, so that access and peripheral resources are
+        # computed without further queries.
+        context = {
+            "request": request,
+            "active_project": access.active_project,
+            "user_project_ids": access.project_ids,
+            "peripheral_schemas": list(
+                PeripheralSchema.objects.prefetch_related("resources")
+            ),
+        }
 
         for device in devices:
-            try:
-                device_data = DeviceData.objects.get(device_uuid=device["uuid"])
-                node_data = nodes_by_id.get(device["uuid"])
-
-                json = DeviceSerializer(
-                    device_data,
-                    context={
-                        "balena_device": device,
-                        "kubernetes_node": node_data,
-                        "request": request,
-                        "active_project": active_project,
-                        "peripheral_schemas": PeripheralSchema.objects.all(),
-                    },
-                ).data
-
-                filtered_devices.append(json)
-            except DeviceData.DoesNotExist:
+            device_data = device_data_by_uuid.get(device["uuid"])
+            if device_data is None:
                 LOG.warning(f"Device {device['uuid']} does not have extra data!")
+                continue
+            json = DeviceSerializer(
+                device_data,
+                context=context
+                | {
+                    "balena_device": device,
+                    "kubernetes_node": nodes_by_id.get(device["uuid"]),
+                },
+            ).data
+            filtered_devices.append(json)
         return filtered_devices
@@ -0,0 +1,120 @@
+import logging
+
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from floto.api.balena import get_balena_client
+from floto.api.models import Fleet, Release
+
+LOG = logging.getLogger(__name__)
+
+
+def fetch_fleet_catalog():
+    """
+    Returns all balena fleets, each with its releases in "owns__release", with
+    one balena request
+    """
+    return get_balena_client().pine.get(
+        {
+            "resource": "application",
+            "options": {
+                "$select": ["id", "app_name", "should_be_running__release"],
+                "$expand": {
+                    "owns__release": {
+                        "$select": [
+                            "id",
+                            "commit",
+                            "created_at",
+                            "status",
+                            "note",
+                            "belongs_to__application",
+                        ],
+                    },
+                },
+            },
+        }
+    )
+
+
+def refresh_catalog():
+    """
+    Syncs the Fleet and Release tables with balena. Only rows that changed are
+    written. Returns the number of rows created, updated and deleted.
+    """
+    applications = fetch_fleet_catalog()
+    fleets = Fleet.objects.in_bulk()
+    releases = Release.objects.in_bulk()
+    new_fleets, changed_fleets = [], []
+    new_releases, changed_releases = [], []
+    seen_release_ids = set()
+
+    for application in applications:
+        target = application.get("should_be_running__release") or {}
+        values = {
+            "app_name": application["app_name"],
+            "target_release_id": target.get("__id"),
+        }
+        fleet = fleets.get(application["id"])
+        if fleet is None:
+            new_fleets.append(Fleet(id=application["id"], **values))
+        elif any(getattr(fleet, k) != v for k, v in values.items()):
+            for name, value in values.items():
+                setattr(fleet, name, value)
+            changed_fleets.append(fleet)
+
+        for balena_release in application.get("owns__release", []):
+            seen_release_ids.add(balena_release["id"])
+            values = {
+                "fleet_id": application["id"],
+                "commit": balena_release["commit"],
+                "created_at": parse_datetime(balena_release["created_at"]),
+                "status": balena_release.get("status") or "",
+                "note": balena_release.get("note") or "",
+            }
+            release = releases.get(balena_release["id"])
+            if release is None:
+                new_releases.append(Release(id=balena_release["id"], **values))
+            elif any(getattr(release, k) != v for k, v in values.items()):
+                for name, value in values.items():
+                    setattr(release, name, value)
+                changed_releases.append(release)
+
+    with transaction.atomic():
+        # sync_balena_device_to_db may have created a new fleet meanwhile
+        Fleet.objects.bulk_create(new_fleets, ignore_conflicts=True)
+        Fleet.objects.bulk_update(
+            changed_fleets + new_fleets, ["app_name", "target_release"]
+        )
+        Release.objects.bulk_create(new_releases)
+        Release.objects.bulk_update(
+            changed_releases, Release.synced_fields, batch_size=500
+        )
+        deleted, _ = Release.objects.exclude(pk__in=seen_release_ids).delete()
+
+    return {
+        "fleets_created": len(new_fleets),
+        "fleets_updated": len(changed_fleets),
+        "releases_created": len(new_releases),
+        "releases_updated": len(changed_releases),
+        "releases_deleted": deleted,
+    }
+
+
+def get_fleets():
+    return Fleet.objects.select_related("target_release").order_by("app_name")
+
+
+def get_releases(fleet_id=None):
+    """
+    Returns the releases of the fleet, or of all fleets, newest first
+    """
+    releases = Release.objects.select_related("fleet").order_by("-id")
+    if fleet_id is not None:
+        releases = releases.filter(fleet_id=fleet_id)
+    return releases
+
+
+def set_release_note(release, note):
+    get_balena_client().models.release.set_note(release.id, note)
+    release.note = note
+    release.save(update_fields=["note"])
@@ -0,0 +1,95 @@
+import logging
+import random
+
+import requests
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from floto.api.models import DeviceData, GeocodeCache
+
+LOG = logging.getLogger(__name__)
+
+
+class GeocodingError(Exception):
+    pass
+
+
+class NominatimGeocoder:
+    """
+    Looks addresses up with the OpenStreetMap Nominatim API, which allows at most
+    one request per second.
+    """
+
+    url = "https://nominatim.openstreetmap.org/search"
+
+    def geocode(self, address):
+        """
+        Returns (latitude, longitude) for the address, or None if it was not
+        found. Raises GeocodingError if the lookup failed.
+        """
+        params = {"q": address, "format": "json"}
+        headers = {"User-Agent": "flotowebapp"}
+        LOG.info(f"Making the Nominatim Geocode API request for {address}")
+        try:
+            response = requests.get(
+                self.url, headers=headers, params=params, timeout=10
+            )
+            response.raise_for_status()
+            data = response.json()
+        except requests.RequestException as e:
+            raise GeocodingError(f"Geocoding error for address {address} - {e}")
+        if data:
+            return float(data[0]["lat"]), float(data[0]["lon"])
+        return None
+
+
+def get_geocoder():
+    return import_string(settings.GEOCODER_BACKEND)()
+
+
+def get_cached(addresses):
+    """
+    Returns {address: (latitude, longitude) or None} for the addresses that have
+    been looked up before.
+    """
+    return {
+        address: None if latitude is None else (latitude, longitude)
+        for address, latitude, longitude in GeocodeCache.objects.filter(
+            address__in=addresses
+        ).values_list("address", "latitude", "longitude")
+    }
+
+
+def lookup(address):
+    """
+    Returns the coordinates of the address, from the cache if it has been looked
+    up before, and from the geocoder otherwise.
+    """
+    cached = get_cached([address])
+    if address in cached:
+        return cached[address]
+    coordinates = get_geocoder().geocode(address)
+    latitude, longitude = coordinates or (None, None)
+    GeocodeCache.objects.update_or_create(
+        address=address, defaults={"latitude": latitude, "longitude": longitude}
+    )
+    return coordinates
+
+
+def set_coordinates(device_uuids, address, coordinates):
+    """
+    Moves the devices that are still at the address to a point near its
+    coordinates, so that devices at the same address do not overlap on maps.
+    """
+    if coordinates is None:
+        LOG.info(f"No coordinates found for address {address}")
+        return
+    devices = [
+        device
+        for device in DeviceData.objects.filter(device_uuid__in=device_uuids)
+        if device.address() == address
+    ]
+    for device in devices:
+        device.latitude = coordinates[0] + random.uniform(-0.005, 0.005)
+        device.longitude = coordinates[1] + random.uniform(-0.005, 0.005)
+    DeviceData.objects.bulk_update(devices, ["latitude", "longitude"])
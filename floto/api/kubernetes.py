@@ -1,15 +1,22 @@
 from collections import defaultdict
 import logging
 import json
-from kubernetes import client, config
+import os
+import threading
+import time
+import uuid
+from kubernetes import client, config, watch
+from kubernetes.dynamic import DynamicClient
+from kubernetes.dynamic.exceptions import UnprocessibleEntityError
 from django.conf import settings
+from django.core.cache import cache
 import hashlib
 from concurrent import futures
 
 from floto.api import models
 
 from . import util
-from .balena import get_balena_client
+from .balena import get_device_env_vars
 
 LOG = logging.getLogger(__name__)
 
@@ -18,6 +25,15 @@ def get_namespace_name(job_uuid):
     return f"job-{job_uuid}"
 
 
+def get_job_id_from_namespace(namespace):
+    if not namespace or not namespace.startswith("job-"):
+        return None
+    try:
+        return uuid.UUID(namespace.split("-", 1)[1])
+    except ValueError:
+        return None
+
+
 def get_job_from_namespace(namespace):
     if "job-" not in namespace:
         return None
@@ -57,35 +73,350 @@ def get_volume_name():
     return "floto-volume"
 
 
-def load_config_for_device(device_uuid):
-    fleet_name = models.DeviceData.objects.get(pk=device_uuid).fleet.app_name
-    config_file = settings.KUBE_CLUSTERS.get(fleet_name)
-    if config_file:
-        config.load_kube_config(config_file)
-    else:
-        raise ValueError(f"No kubeconfig file for {fleet_name}")
+def _matches_label_selector(labels, label_selector):
+    """
+    Supports the equality-based selectors we use: "k=v", "k!=v", "k" and "!k"
+    """
+    for requirement in (label_selector or "").split(","):
+        requirement = requirement.strip()
+        if not requirement:
+            continue
+        if "!=" in requirement:
+            key, value = requirement.split("!=", 1)
+            if labels.get(key) == value:
+                return False
+        elif "=" in requirement:
+            key, value = requirement.split("=", 1)
+            if labels.get(key) != value.lstrip("="):
+                return False
+        elif requirement.startswith("!"):
+            if requirement[1:] in labels:
+                return False
+        elif requirement not in labels:
+            return False
+    return True
+
+
+class ClusterWatchCache:
+    """
+    An informer-style cache of the nodes and pods in one cluster, shared by all
+    processes through the Django cache. The watch_clusters command runs a
+    background thread per resource, which lists it, then watches from the
+    list's resourceVersion, and writes every change to the cache. Any process
+    can then read nodes and pods without an API round-trip, while the watcher
+    keeps reporting that it is in sync.
+    """
+
+    KINDS = ("nodes", "pods")
+
+    def __init__(self, fleet_name):
+        self.fleet_name = fleet_name
+        self._key_prefix = f"kube-watch:{fleet_name}"
+        # The watcher's copy of what it wrote, as manifests. Node name ->
+        # manifest, and namespace -> pod name -> manifest.
+        self._nodes = {}
+        self._pods = defaultdict(dict)
+        self._synced = {kind: threading.Event() for kind in self.KINDS}
+
+    def _key(self, *parts):
+        return ":".join([self._key_prefix, *parts])
+
+    def start(self):
+        for kind in self.KINDS:
+            threading.Thread(
+                target=self._run,
+                args=(kind,),
+                name=f"kube-watch-{self.fleet_name}-{kind}",
+                daemon=True,
+            ).start()
+
+    def heartbeat(self):
+        """
+        Reports the resources that are in sync, which readers trust for
+        KUBE_WATCH_SYNCED_TTL seconds. Called periodically by the watcher.
+        """
+        cache.set_many(
+            {
+                self._key("synced", kind): True
+                for kind, synced in self._synced.items()
+                if synced.is_set()
+            },
+            timeout=settings.KUBE_WATCH_SYNCED_TTL,
+        )
+
+    @property
+    def is_synced(self):
+        keys = [self._key("synced", kind) for kind in self.KINDS]
+        return len(cache.get_many(keys)) == len(keys)
+
+    def _list_func(self, kind):
+        core_api = get_core_api(self.fleet_name)
+        if kind == "nodes":
+            return core_api.list_node
+        return core_api.list_pod_for_all_namespaces
+
+    def _run(self, kind):
+        while True:
+            try:
+                resource_list = self._list_func(kind)(
+                    _request_timeout=settings.KUBE_CLUSTER_TIMEOUT
+                )
+                self._replace(kind, resource_list.items)
+                self._synced[kind].set()
+                self.heartbeat()
+                self._watch(kind, resource_list.metadata.resource_version)
+            except client.exceptions.ApiException as e:
+                if e.status == 410:
+                    # Our resourceVersion is too old to resume from, so list again
+                    LOG.info(f"Relisting {kind} for cluster {self.fleet_name}")
+                    continue
+                self._on_error(kind, e)
+            except Exception as e:
+                self._on_error(kind, e)
+
+    def _on_error(self, kind, e):
+        # Stop serving reads until the resource has been listed again
+        self._synced[kind].clear()
+        cache.delete(self._key("synced", kind))
+        LOG.error(f"Error watching {kind} for cluster {self.fleet_name}")
+        LOG.exception(e)
+        time.sleep(settings.KUBE_WATCH_RETRY_SECONDS)
+
+    def _watch(self, kind, resource_version):
+        w = watch.Watch()
+        while True:
+            for event in w.stream(
+                self._list_func(kind),
+                resource_version=resource_version,
+                timeout_seconds=settings.KUBE_WATCH_TIMEOUT,
+            ):
+                self._apply(kind, event["type"], event["object"])
+            # The server ends each watch after timeout_seconds, so resume from
+            # the last version we saw.
+            resource_version = w.resource_version
+
+    def _replace(self, kind, items):
+        if kind == "nodes":
+            self._nodes = {node.metadata.name: to_manifest(node) for node in items}
+            cache.set(self._key("nodes"), self._nodes, timeout=None)
+            return
+        pods = defaultdict(dict)
+        for pod in items:
+            pods[pod.metadata.namespace][pod.metadata.name] = to_manifest(pod)
+        cache.set_many(
+            {self._key("pods", ns): ns_pods for ns, ns_pods in pods.items()},
+            timeout=None,
+        )
+        cache.delete_many(
+            [self._key("pods", ns) for ns in self._pods.keys() - pods.keys()]
+        )
+        self._pods = pods
+
+    def _apply(self, kind, event_type, obj):
+        name = obj.metadata.name
+        if kind == "nodes":
+            if event_type == "DELETED":
+                self._nodes.pop(name, None)
+            else:
+                self._nodes[name] = to_manifest(obj)
+            cache.set(self._key("nodes"), self._nodes, timeout=None)
+            return
+        namespace = obj.metadata.namespace
+        if event_type == "DELETED":
+            self._pods[namespace].pop(name, None)
+        else:
+            self._pods[namespace][name] = to_manifest(obj)
+        if self._pods[namespace]:
+            cache.set(
+                self._key("pods", namespace), self._pods[namespace], timeout=None
+            )
+        else:
+            del self._pods[namespace]
+            cache.delete(self._key("pods", namespace))
+
+    def list_nodes(self, label_selector=None):
+        return [
+            from_manifest(node, "V1Node")
+            for node in (cache.get(self._key("nodes")) or {}).values()
+            if _matches_label_selector(
+                node["metadata"].get("labels") or {}, label_selector
+            )
+        ]
+
+    def list_pods(self, namespace):
+        return [
+            from_manifest(pod, "V1Pod")
+            for pod in (cache.get(self._key("pods", namespace)) or {}).values()
+        ]
+
+    def get_pod(self, namespace, pod_name):
+        pod = (cache.get(self._key("pods", namespace)) or {}).get(pod_name)
+        return pod and from_manifest(pod, "V1Pod")
+
+
+class ClusterRegistry:
+    """
+    Holds one ApiClient per cluster, keyed by fleet name. Each client is built
+    once from its kubeconfig, and rebuilt only when that file changes, so calls
+    reuse connection pools and never touch the global default configuration.
+    """
+
+    def __init__(self):
+        self._reset()
+        # Connection pools must not be shared with forked children
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._dynamic_clients = {}
+        self._discovery_lock = threading.Lock()
+        self.executor = futures.ThreadPoolExecutor(
+            max_workers=settings.KUBE_FANOUT_WORKERS,
+            thread_name_prefix="kube-fanout",
+        )
+
+    def get_api_client(self, fleet_name):
+        config_file = settings.KUBE_CLUSTERS.get(fleet_name)
+        if not config_file:
+            raise ValueError(f"No kubeconfig file for {fleet_name}")
+        mtime = os.path.getmtime(config_file)
+        with self._lock:
+            loaded_mtime, api_client = self._clients.get(fleet_name, (None, None))
+            if loaded_mtime != mtime:
+                LOG.info(f"Loading kubeconfig for {fleet_name} from {config_file}")
+                api_client = config.new_client_from_config(config_file=config_file)
+                self._clients[fleet_name] = (mtime, api_client)
+            return api_client
+
+    def get_dynamic_client(self, fleet_name):
+        api_client = self.get_api_client(fleet_name)
+        with self._lock:
+            loaded_client, dynamic_client = self._dynamic_clients.get(
+                fleet_name, (None, None)
+            )
+            if loaded_client is not api_client:
+                dynamic_client = DynamicClient(api_client)
+                self._dynamic_clients[fleet_name] = (api_client, dynamic_client)
+            return dynamic_client
+
+    def get_resource(self, fleet_name, api_version, kind):
+        """
+        Returns the dynamic client and API resource for a kind of object. The
+        client discovers resources on first use and caches them.
+        """
+        dynamic_client = self.get_dynamic_client(fleet_name)
+        with self._discovery_lock:
+            resource = dynamic_client.resources.get(api_version=api_version, kind=kind)
+        return dynamic_client, resource
+
+
+cluster_registry = ClusterRegistry()
+
+
+def get_synced_watch_cache(fleet_name):
+    """
+    Returns the watch cache for this cluster if it can serve reads, otherwise
+    None, in which case the caller should query the API directly.
+    """
+    if not settings.KUBE_WATCH_CACHE or not settings.KUBE_CLUSTERS.get(fleet_name):
+        return None
+    watch_cache = ClusterWatchCache(fleet_name)
+    return watch_cache if watch_cache.is_synced else None
+
+
+def get_core_api(fleet_name):
+    return client.CoreV1Api(cluster_registry.get_api_client(fleet_name))
+
+
+def get_batch_api(fleet_name):
+    return client.BatchV1Api(cluster_registry.get_api_client(fleet_name))
+
+
+def for_each_cluster(func, timeout=None, raise_errors=False):
+    """
+    Calls func(fleet_name) for every cluster at once, and returns a map of
+    fleet name to result. Clusters that fail, or do not answer within the
+    timeout, are logged and left out of the result, so one slow cluster only
+    loses its own data. If raise_errors is set, the first failure is raised
+    once all clusters have answered instead.
+    """
+    if timeout is None:
+        timeout = settings.KUBE_CLUSTER_TIMEOUT
+    pending = {
+        cluster_registry.executor.submit(func, fleet_name): fleet_name
+        for fleet_name in settings.KUBE_CLUSTERS
+    }
+    done, not_done = futures.wait(pending, timeout=timeout)
+
+    results = {}
+    errors = []
+    for future in done:
+        fleet_name = pending[future]
+        try:
+            results[fleet_name] = future.result()
+        except Exception as e:
+            LOG.error(f"Error querying cluster {fleet_name}")
+            LOG.exception(e)
+            errors.append(e)
+    for future in not_done:
+        LOG.warning(f"Timed out after {timeout}s querying cluster {pending[future]}")
+        future.cancel()
+        errors.append(TimeoutError(f"Timed out querying cluster {pending[future]}"))
+    if raise_errors and errors:
+        raise errors[0]
+    return results
+
+
+def get_fleet_for_device(device_uuid):
+    return (
+        models.DeviceData.objects.select_related("fleet")
+        .get(pk=device_uuid)
+        .fleet.app_name
+    )
 
 
 def get_nodes(label_selector="node-role.kubernetes.io/floto-worker=true"):
+    # We query this because node names may not be unique across clusters,
+    # so that we should only get the node from the correct fleet.
+    fleet_devices = defaultdict(set)
+    for device_uuid, fleet_name in models.DeviceData.objects.values_list(
+        "device_uuid", "fleet__app_name"
+    ):
+        fleet_devices[fleet_name].add(device_uuid)
+
+    def list_nodes(fleet_name):
+        watch_cache = get_synced_watch_cache(fleet_name)
+        if watch_cache:
+            return watch_cache.list_nodes(label_selector)
+        return get_core_api(fleet_name).list_node(
+            label_selector=label_selector,
+            _request_timeout=settings.KUBE_CLUSTER_TIMEOUT,
+        ).items
+
     nodes = []
-    for fleet_name, config_file in settings.KUBE_CLUSTERS.items():
-        config.load_kube_config(config_file=config_file)
-        core_api = client.CoreV1Api()
-        # We query this because node names may not be unique across clusters,
-        # so that we should only get the node from the correct fleet.
-        fleet_devices = set(
-            d.device_uuid
-            for d in models.DeviceData.objects.filter(fleet__app_name=fleet_name)
-        )
-        for node in core_api.list_node(label_selector=label_selector).items:
-            if node.metadata.name in fleet_devices:
+    for fleet_name, cluster_nodes in for_each_cluster(list_nodes).items():
+        for node in cluster_nodes:
+            if node.metadata.name in fleet_devices[fleet_name]:
                 nodes.append(node)
     return nodes
 
 
+def summarize_node(node):
+    """
+    Reduces a V1Node to the JSON-serializable fields used by the device views
+    """
+    ready = next(
+        (c for c in node.status.conditions or [] if c.type == "Ready"), None
+    )
+    return {
+        "is_ready": ready is not None and ready.status == "True",
+        "capacity": sorted((node.status.capacity or {}).keys()),
+    }
+
+
 def label_node(node_name, label="node-role.kubernetes.io/floto-worker", value="true"):
-    load_config_for_device(node_name)
-    core_api = client.CoreV1Api()
+    core_api = get_core_api(get_fleet_for_device(node_name))
     core_api.patch_node(
         node_name,
         {
@@ -99,16 +430,18 @@ def label_node(node_name, label="node-role.kubernetes.io/floto-worker", value="t
 
 
 def get_namespaces_with_no_pods():
-    namespaces = set()
-    for config_file in settings.KUBE_CLUSTERS.values():
-        config.load_kube_config(config_file=config_file)
-        core_api = client.CoreV1Api()
-        namespaces.update(
+    def list_empty_namespaces(fleet_name):
+        core_api = get_core_api(fleet_name)
+        return [
             ns
             for ns in core_api.list_namespace().items
             if ns.metadata.name.startswith("job-")
             and len(core_api.list_namespaced_pod(ns.metadata.name).items) == 0
-        )
+        ]
+
+    namespaces = set()
+    for cluster_namespaces in for_each_cluster(list_empty_namespaces).values():
+        namespaces.update(cluster_namespaces)
     return namespaces
 
 
@@ -129,36 +462,89 @@ def get_job_events(uuid):
 
 
 def get_kube_events(namespace=None):
-    events = []
-    for config_file in settings.KUBE_CLUSTERS.values():
-        config.load_kube_config(config_file=config_file)
-        core_api = client.CoreV1Api()
+    def list_events(fleet_name):
+        core_api = get_core_api(fleet_name)
         if namespace:
-            event_list = core_api.list_namespaced_event(get_namespace_name(namespace))
-        else:
-            event_list = core_api.list_event_for_all_namespaces()
+            return core_api.list_namespaced_event(
+                get_namespace_name(namespace),
+                _request_timeout=settings.KUBE_CLUSTER_TIMEOUT,
+            )
+        return core_api.list_event_for_all_namespaces(
+            _request_timeout=settings.KUBE_CLUSTER_TIMEOUT,
+        )
+
+    events = []
+    for event_list in for_each_cluster(list_events).values():
         events.extend(event_list.items)
     return events
 
 
+def get_kube_events_since(fleet_name, resource_version=None):
+    """
+    Returns the events in this cluster that changed since resource_version, and
+    the resourceVersion to continue from next time. Watches for up to
+    KUBE_EVENT_WATCH_SECONDS; lists every event instead when there is no
+    resourceVersion yet, or it has expired.
+    """
+    list_events = get_core_api(fleet_name).list_event_for_all_namespaces
+    if resource_version:
+        w = watch.Watch()
+        events = []
+        try:
+            for event in w.stream(
+                list_events,
+                resource_version=resource_version,
+                timeout_seconds=settings.KUBE_EVENT_WATCH_SECONDS,
+            ):
+                if event["type"] != "DELETED":
+                    events.append(event["object"])
+            return events, w.resource_version
+        except client.exceptions.ApiException as e:
+            if e.status != 410:
+                raise e
+            LOG.info(f"Event resourceVersion expired for {fleet_name}, relisting")
+
+    event_list = list_events(_request_timeout=settings.KUBE_CLUSTER_TIMEOUT)
+    return event_list.items, event_list.metadata.resource_version
+
+
+def get_pod_nodes(fleet_name, pod_keys):
+    """
+    Maps (namespace, pod name) to node name for the given pods in this cluster
+    """
+    watch_cache = get_synced_watch_cache(fleet_name)
+    if watch_cache:
+        pods = [watch_cache.get_pod(namespace, name) for namespace, name in pod_keys]
+    else:
+        pods = get_core_api(fleet_name).list_pod_for_all_namespaces(
+            _request_timeout=settings.KUBE_CLUSTER_TIMEOUT
+        ).items
+    return {
+        (pod.metadata.namespace, pod.metadata.name): pod.spec.node_name
+        for pod in pods
+        if pod and pod.spec.node_name
+    }
+
+
 def delete_namespace_if_exists(namespace_name):
-    for config_file in settings.KUBE_CLUSTERS.values():
-        config.load_kube_config(config_file=config_file)
-        core_api = client.CoreV1Api()
+    def delete_namespace(fleet_name):
         try:
-            core_api.delete_namespace(namespace_name)
+            get_core_api(fleet_name).delete_namespace(namespace_name)
         except client.exceptions.ApiException as e:
             # Ignore not found, meaning namespace was already deleted
             if e.status != 404:
                 raise e
 
+    # Cleanup must be retried if any cluster could not be reached
+    for_each_cluster(delete_namespace, raise_errors=True)
+
 
 def destroy_job(job_obj):
     for device in job_obj.devices.all():
+        fleet_name = get_fleet_for_device(device.device_uuid)
+        batch_api = get_batch_api(fleet_name)
+        core_api = get_core_api(fleet_name)
         try:
-            load_config_for_device(device.device_uuid)
-            batch_api = client.BatchV1Api()
-            core_api = client.CoreV1Api()
             batch_api.delete_namespaced_job(
                 namespace=get_namespace_name(job_obj.uuid),
                 name=get_job_name(job_obj.uuid, device.device_uuid),
@@ -191,12 +577,13 @@ def get_job_logs(uuid):
         }
     }
     """
-    logs = defaultdict(dict)
-    for config_file in settings.KUBE_CLUSTERS.values():
-        config.load_kube_config(config_file=config_file)
-        core_api = client.CoreV1Api()
-        pod_list = core_api.list_namespaced_pod(get_namespace_name(uuid))
-        ns = get_namespace_name(uuid)
+    ns = get_namespace_name(uuid)
+
+    def fetch_cluster_logs(fleet_name):
+        core_api = get_core_api(fleet_name)
+        pod_list = core_api.list_namespaced_pod(
+            ns, _request_timeout=settings.KUBE_CLUSTER_TIMEOUT
+        )
 
         def fetch_logs(pod, container):
             try:
@@ -206,6 +593,7 @@ def get_job_logs(uuid):
                         ns,
                         container=container.name,
                         tail_lines=100,
+                        _request_timeout=settings.KUBE_LOG_REQUEST_TIMEOUT,
                     )
                 }
             except Exception as e:
@@ -217,16 +605,37 @@ def get_job_logs(uuid):
             # Note container.image is not the same as pod.spec.containers[0].image
             # but image_id seems to be a better
             return pod.spec.node_name, container.image, log_data
-        with futures.ThreadPoolExecutor(max_workers=20) as executor:
-            log_futures = [
-                executor.submit(fetch_logs, pod, container)
-                for pod in pod_list.items
-                for container in pod.spec.containers
-            ]
-            for future in futures.as_completed(log_futures):
-                node_name, image, log_data = future.result()
-                logs[node_name][image] = log_data
 
+        executor = futures.ThreadPoolExecutor(max_workers=20)
+        pending = {
+            executor.submit(fetch_logs, pod, container): (pod, container)
+            for pod in pod_list.items
+            for container in pod.spec.containers
+        }
+        done, not_done = futures.wait(pending, timeout=settings.KUBE_LOGS_TIMEOUT)
+        # Reads still running end by their own request timeout
+        executor.shutdown(wait=False, cancel_futures=True)
+        cluster_logs = [future.result() for future in done]
+        for future in not_done:
+            pod, container = pending[future]
+            cluster_logs.append(
+                (
+                    pod.spec.node_name,
+                    container.image,
+                    {"error": "Timed out getting logs for this container."},
+                )
+            )
+        return cluster_logs
+
+    logs = defaultdict(dict)
+    # The pod list is bounded by KUBE_CLUSTER_TIMEOUT, and reading logs by
+    # KUBE_LOGS_TIMEOUT, so large jobs keep the logs that were read in time
+    cluster_timeout = settings.KUBE_CLUSTER_TIMEOUT + settings.KUBE_LOGS_TIMEOUT + 1
+    for cluster_logs in for_each_cluster(
+        fetch_cluster_logs, timeout=cluster_timeout
+    ).values():
+        for node_name, image, log_data in cluster_logs:
+            logs[node_name][image] = log_data
     return logs
 
 
@@ -242,12 +651,18 @@ def get_pod_health(uuid):
         }
     }
     """
+
+    def list_pods(fleet_name):
+        watch_cache = get_synced_watch_cache(fleet_name)
+        if watch_cache:
+            return watch_cache.list_pods(get_namespace_name(uuid))
+        return get_core_api(fleet_name).list_namespaced_pod(
+            get_namespace_name(uuid), _request_timeout=settings.KUBE_CLUSTER_TIMEOUT
+        ).items
+
     health = defaultdict(dict)
-    for config_file in settings.KUBE_CLUSTERS.values():
-        config.load_kube_config(config_file=config_file)
-        core_api = client.CoreV1Api()
-        pod_list = core_api.list_namespaced_pod(get_namespace_name(uuid))
-        for pod in pod_list.items:
+    for pods in for_each_cluster(list_pods).values():
+        for pod in pods:
             health[pod.spec.node_name]["pod"] = pod.status.phase
             health[pod.spec.node_name]["containers"] = defaultdict(dict)
             for container in pod.status.container_statuses:
@@ -262,49 +677,218 @@ def get_pod_health(uuid):
     return health
 
 
+def _create_if_missing(create, *args, **kwargs):
+    try:
+        create(*args, **kwargs)
+    except client.exceptions.ApiException as e:
+        # Ignore conflict, meaning it was already created
+        if e.status != 409:
+            raise e
+
+
+_manifest_serializer = client.ApiClient()
+
+
+def to_manifest(obj, namespace=None):
+    """
+    Returns a kubernetes model object as the JSON-serializable manifest the API
+    expects, placed in the namespace if given.
+    """
+    manifest = _manifest_serializer.sanitize_for_serialization(obj)
+    if namespace:
+        manifest["metadata"]["namespace"] = namespace
+    return manifest
+
+
+class _ManifestResponse:
+    def __init__(self, manifest):
+        self.data = json.dumps(manifest)
+
+
+def from_manifest(manifest, klass):
+    """
+    Returns the kubernetes model object, e.g. a "V1Pod", for a manifest
+    """
+    return _manifest_serializer.deserialize(_ManifestResponse(manifest), klass)
+
+
+def apply_manifests(fleet_name, manifests):
+    """
+    Applies the manifests to the cluster with server-side apply, which creates
+    or updates each object to match, so applying them again changes nothing.
+    The pod template of a Job cannot be changed, so a Job that already exists
+    with a different one is left as it is.
+    """
+    applied = []
+    for manifest in manifests:
+        dynamic_client, resource = cluster_registry.get_resource(
+            fleet_name, manifest["apiVersion"], manifest["kind"]
+        )
+        try:
+            applied.append(
+                dynamic_client.server_side_apply(
+                    resource,
+                    body=manifest,
+                    field_manager=settings.KUBE_FIELD_MANAGER,
+                    force_conflicts=True,
+                )
+            )
+        except UnprocessibleEntityError:
+            if manifest["kind"] != "Job":
+                raise
+            LOG.warning(
+                f"Job {manifest['metadata']['name']} already exists with a "
+                "different spec, which cannot be changed, so it was kept"
+            )
+    return applied
+
+
 def prepare_deployment(job):
+    """
+    Creates the job's namespace, with its image pull secrets, on every cluster.
+    Anything that already exists is left as is, so this can be retried.
+    """
     namespace = get_namespace_name(job.uuid)
-    for config_file in settings.KUBE_CLUSTERS.values():
-        config.load_kube_config(config_file=config_file)
-        core_api = client.CoreV1Api()
-        core_api.create_namespace(
-            client.V1Namespace(
-                metadata=client.V1ObjectMeta(name=namespace),
-                spec=client.V1NamespaceSpec(finalizers=[]),
-            )
+
+    def prepare_cluster(fleet_name):
+        core_api = get_core_api(fleet_name)
+        v1_namespace = client.V1Namespace(
+            api_version="v1",
+            kind="Namespace",
+            metadata=client.V1ObjectMeta(name=namespace),
+            spec=client.V1NamespaceSpec(finalizers=[]),
         )
         # Copy image pull secrets to newly created namespace
-        for secret_name in settings.KUBE_IMAGE_PULL_SECRETS:
-            secret = core_api.read_namespaced_secret(
-                secret_name, settings.KUBE_SECRET_NAMESPACE
-            )
-            core_api.create_namespaced_secret(
-                namespace,
-                client.V1Secret(
-                    data=secret.data,
-                    type="kubernetes.io/dockerconfigjson",
-                    metadata=client.V1ObjectMeta(
-                        namespace=namespace,
-                        name=secret_name,
-                    ),
+        secrets = [
+            client.V1Secret(
+                api_version="v1",
+                kind="Secret",
+                data=core_api.read_namespaced_secret(
+                    secret_name, settings.KUBE_SECRET_NAMESPACE
+                ).data,
+                type="kubernetes.io/dockerconfigjson",
+                metadata=client.V1ObjectMeta(
+                    namespace=namespace,
+                    name=secret_name,
                 ),
             )
+            for secret_name in settings.KUBE_IMAGE_PULL_SECRETS
+        ]
+        if settings.KUBE_SERVER_SIDE_APPLY:
+            manifests = [to_manifest(obj) for obj in [v1_namespace, *secrets]]
+            apply_manifests(fleet_name, manifests)
+            return
+        _create_if_missing(core_api.create_namespace, v1_namespace)
+        for secret in secrets:
+            _create_if_missing(core_api.create_namespaced_secret, namespace, secret)
+
+    # The job can only be deployed once every cluster is prepared
+    for_each_cluster(prepare_cluster, raise_errors=True)
+
+
+def render_job_objects(job, devices):
+    """
+    Renders the kubernetes objects to deploy the job to each device, grouped by
+    cluster. Everything needed is loaded from the database and balena up front.
+
+    Returns:
+        ({fleet_name: {device_uuid: [object]}}, {device_uuid: why it failed})
+    """
+    template = JobTemplate(job)
+    device_models = (
+        models.DeviceData.objects.select_related("fleet")
+        .prefetch_related(
+            "peripherals__peripheral__schema__configuration_items",
+            "peripherals__configuration",
+        )
+        .in_bulk(devices)
+    )
+    device_env_vars = get_device_env_vars(devices)
+
+    objects = defaultdict(dict)
+    errors = {}
+    for device_uuid in devices:
+        device_model = device_models.get(device_uuid)
+        if device_model is None or device_model.fleet is None:
+            errors[device_uuid] = "Device is not in a known fleet"
+            continue
+        if device_uuid not in device_env_vars:
+            errors[device_uuid] = "Device is not known to balena"
+            continue
+        objects[device_model.fleet.app_name][device_uuid] = template.render(
+            device_uuid,
+            device_env_vars[device_uuid],
+            _get_config_data(device_model),
+        )
+    return objects, errors
 
 
 def create_deployment(devices, job):
     """
+    Deploys the job to the devices, up to KUBE_DEPLOY_CONCURRENCY devices at a
+    time per cluster. Objects are server-side applied (or, if that is turned
+    off, created unless they exist), so a failed deployment can be retried.
+
     Args:
         devices: [str (device_uuids)]
         job: models.Job
+    Returns:
+        {device_uuid: None if deployed, else why it failed}
     """
-    if type(job.environment) is str:
-        environment = json.loads(job.environment).items()
-    else:
-        environment = job.environment.items()
-    balena = get_balena_client()
     namespace = get_namespace_name(job.uuid)
-    for device_uuid in devices:
-        _create_job_for_device(job, device_uuid, environment, balena, namespace)
+    objects, results = render_job_objects(job, devices)
+    executors = {}
+    pending = {}
+    try:
+        for fleet_name, cluster_objects in objects.items():
+            executors[fleet_name] = futures.ThreadPoolExecutor(
+                max_workers=settings.KUBE_DEPLOY_CONCURRENCY,
+                thread_name_prefix=f"deploy-{fleet_name}",
+            )
+            for device_uuid, device_objects in cluster_objects.items():
+                future = executors[fleet_name].submit(
+                    _deploy_objects, fleet_name, namespace, device_objects
+                )
+                pending[future] = device_uuid
+
+        for future in futures.as_completed(pending):
+            device_uuid = pending[future]
+            try:
+                future.result()
+                results[device_uuid] = None
+            except Exception as e:
+                LOG.error(f"Error deploying job {job.uuid} to {device_uuid}")
+                LOG.exception(e)
+                results[device_uuid] = str(e)
+    finally:
+        for executor in executors.values():
+            executor.shutdown(cancel_futures=True)
+    return results
+
+
+def _get_config_data(device_model):
+    config_data = {}
+    for p in device_model.peripherals.all():
+        values = {item.label_id: item.value for item in p.configuration.all()}
+        for item in p.peripheral.schema.configuration_items.all():
+            # The device may not be configured with this option
+            config_data[item.label] = values.get(item.pk, "")
+    return config_data
+
+
+def _get_active_deadline_seconds(job):
+    deadline = None
+    for job_timing in job.timings.all():
+        string_parts = job_timing.timing.split(",")
+        timing_type, args = string_parts[0], string_parts[1:]
+        if timing_type == "type=on_demand":
+            td = util.parse_on_demand_args(args)
+            deadline = int(td.total_seconds())
+        elif timing_type == "type=advanced":
+            ts = util.parse_advanced_timing_args(args)[0]
+            td = ts["stop"] - ts["start"]
+            deadline = int(td.total_seconds())
+    return deadline
 
 
 def _port_name(service_port):
@@ -319,200 +903,239 @@ def _port_name(service_port):
     return f"{service_port.protocol.lower()}-{service_port.target_port}"
 
 
-def _create_job_for_device(job, device_uuid, job_environment, balena, namespace):
-    load_config_for_device(device_uuid)
-    core_api = client.CoreV1Api()
-    containers = []
-
-    device_environment = {
-        "FLOTO_JOB_UUID": str(job.uuid),
-        "FLOTO_DEVICE_UUID": device_uuid,
-    }
-    device_environment.update(
-        {
-            env_obj["name"]: env_obj["value"]
-            for env_obj in balena.models.device.env_var.get_all_by_device(
-                uuid_or_id=device_uuid
-            )
-            if env_obj["name"].startswith(settings.FLOTO_ENV_PREFIX)
-        }
-    )
-    # Overwrite any variables with the job's env
-    device_environment.update(job_environment)
-
-    volume_name = get_volume_name()
-    device_volume_name = f"lv-{device_uuid}"
-    pod_name = get_pod_name(job.application.uuid, device_uuid)
+class JobTemplate:
+    """
+    The parts of a job's kubernetes objects that are the same on every device.
+    They are built once per deployment, and shared by the objects rendered for
+    each device, which only add the device's environment, node, config map and
+    volume.
+    """
 
-    config_data = {}
-    config_name = get_config_map_name(device_uuid)
-    device_model = models.DeviceData.objects.get(pk=device_uuid)
-    for p in device_model.peripherals.all():
-        for item in p.peripheral.schema.configuration_items.all():
-            value = ""
-            try:
-                value = p.configuration.get(label=item).value
-            except Exception:
-                # Device is not configured with this option for some reason
-                pass
-            config_data[item.label] = value
-    core_api.create_namespaced_config_map(
-        namespace,
-        client.V1ConfigMap(
-            data=config_data, metadata=client.V1ObjectMeta(name=config_name)
-        ),
-    )
+    def __init__(self, job):
+        self.job_uuid = job.uuid
+        self.app_uuid = job.application.uuid
+        if type(job.environment) is str:
+            self.environment = json.loads(job.environment)
+        else:
+            self.environment = job.environment
+        self.active_deadline_seconds = _get_active_deadline_seconds(job)
+
+        self.services = []
+        app_services = job.application.services.select_related(
+            "service"
+        ).prefetch_related(
+            "service__ports",
+            "service__peripheral_schemas__peripheral_schema__resources",
+        )
+        for app_service in app_services:
+            service = app_service.service
 
-    k8s_services = []
-    for app_service in job.application.services.all():
-        service = app_service.service
+            resources = defaultdict(int)
+            for ps in service.peripheral_schemas.all():
+                for resource in ps.peripheral_schema.resources.all():
+                    resources[resource.label] += resource.count
+
+            service_ports = list(service.ports.all())
+            self.services.append(
+                {
+                    "uuid": service.uuid,
+                    "image": service.container_ref,
+                    "resources": client.V1ResourceRequirements(
+                        limits={k: str(v) for k, v in resources.items()},
+                    ),
+                    # We should specify this so the service can identify the
+                    # container
+                    "container_ports": [
+                        client.V1ContainerPort(
+                            name=_port_name(p),
+                            container_port=p.target_port,
+                        )
+                        for p in service_ports
+                    ],
+                    "service_ports": [
+                        client.V1ServicePort(
+                            port=p.target_port,
+                            name=f"sp-{_port_name(p)}",
+                            target_port=_port_name(p),
+                            node_port=p.node_port,
+                            protocol=p.protocol,
+                        )
+                        for p in service_ports
+                    ],
+                }
+            )
 
-        resources = defaultdict(int)
-        for ps in service.peripheral_schemas.all():
-            for resource in ps.peripheral_schema.resources.all():
-                resources[resource.label] += resource.count
+        self.volume = client.V1Volume(
+            name=get_volume_name(),
+            empty_dir=client.V1EmptyDirVolumeSource(
+                size_limit=settings.KUBE_VOLUME_SIZE
+            ),
+        )
+        self.volume_mount = client.V1VolumeMount(
+            mount_path=settings.KUBE_VOLUME_MOUNT_PATH, name=get_volume_name()
+        )
+        self.peripheral_volume_mount = client.V1VolumeMount(
+            mount_path=settings.KUBE_PERIPHERAL_VOLUME_MOUNT_PATH,
+            name="peripheral-config",
+        )
+        self.image_pull_secrets = [
+            client.V1LocalObjectReference(name=secret_name)
+            for secret_name in settings.KUBE_IMAGE_PULL_SECRETS
+        ]
+        self.dns_config = client.V1PodDNSConfig(nameservers=["8.8.8.8"])
+
+    def render(self, device_uuid, env_vars, config_data):
+        """
+        Returns the config map, job and services to create for a device, in
+        the order they should be created
+        """
+        device_environment = {
+            "FLOTO_JOB_UUID": str(self.job_uuid),
+            "FLOTO_DEVICE_UUID": device_uuid,
+        }
+        device_environment.update(
+            {
+                env_obj["name"]: env_obj["value"]
+                for env_obj in env_vars
+                if env_obj["name"].startswith(settings.FLOTO_ENV_PREFIX)
+            }
+        )
+        # Overwrite any variables with the job's env
+        device_environment.update(self.environment)
+        env = [client.V1EnvVar(name=n, value=v) for n, v in device_environment.items()]
+
+        device_volume_name = f"lv-{device_uuid}"
+        device_volume_mount = client.V1VolumeMount(
+            mount_path=settings.KUBE_DEVICE_VOLUME_MOUNT_PATH,
+            name=device_volume_name,
+        )
+        pod_name = get_pod_name(self.app_uuid, device_uuid)
+        config_name = get_config_map_name(device_uuid)
+        config_map = client.V1ConfigMap(
+            api_version="v1",
+            kind="ConfigMap",
+            data=config_data,
+            metadata=client.V1ObjectMeta(name=config_name),
+        )
 
-        service_ports = list(service.ports.all())
-        containers.append(
+        containers = [
             client.V1Container(
-                image=service.container_ref,
-                name=f"container-{service.uuid}",
+                image=service["image"],
+                name=f"container-{service['uuid']}",
                 image_pull_policy="Always",
-                env=[
-                    client.V1EnvVar(name=n, value=v)
-                    for n, v in device_environment.items()
-                ],
+                env=env,
                 volume_mounts=[
-                    client.V1VolumeMount(
-                        mount_path=settings.KUBE_VOLUME_MOUNT_PATH, name=volume_name
-                    ),
-                    client.V1VolumeMount(
-                        mount_path=settings.KUBE_PERIPHERAL_VOLUME_MOUNT_PATH,
-                        name="peripheral-config",
-                    ),
-                    client.V1VolumeMount(
-                        mount_path=settings.KUBE_DEVICE_VOLUME_MOUNT_PATH,
-                        name=device_volume_name,
-                    ),
-                ],
-                resources=client.V1ResourceRequirements(
-                    limits={k: str(v) for k, v in resources.items()},
-                ),
-                ports=[
-                    # We should specify this so the service can identify the container
-                    client.V1ContainerPort(
-                        name=_port_name(p),
-                        container_port=p.target_port,
-                    )
-                    for p in service.ports.all()
+                    self.volume_mount,
+                    self.peripheral_volume_mount,
+                    device_volume_mount,
                 ],
+                resources=service["resources"],
+                ports=service["container_ports"],
             )
-        )
-
-        if service_ports:
-            k8s_services.append(
-                client.V1Service(
-                    metadata=client.V1ObjectMeta(
-                        name=get_service_name(device_uuid, service.uuid),
-                    ),
-                    spec=client.V1ServiceSpec(
-                        type="NodePort",
-                        selector={
-                            "pod_name": pod_name,
-                        },
-                        ports=[
-                            client.V1ServicePort(
-                                port=p.target_port,
-                                name=f"sp-{_port_name(p)}",
-                                target_port=_port_name(p),
-                                node_port=p.node_port,
-                                protocol=p.protocol,
-                            )
-                            for p in service_ports
-                        ],
-                    ),
-                )
+            for service in self.services
+        ]
+        k8s_services = [
+            client.V1Service(
+                api_version="v1",
+                kind="Service",
+                metadata=client.V1ObjectMeta(
+                    name=get_service_name(device_uuid, service["uuid"]),
+                ),
+                spec=client.V1ServiceSpec(
+                    type="NodePort",
+                    selector={
+                        "pod_name": pod_name,
+                    },
+                    ports=service["service_ports"],
+                ),
             )
-
-    v1_job = client.V1Job(
-        api_version="batch/v1",
-        kind="Job",
-        metadata=client.V1ObjectMeta(
-            name=get_job_name(job.uuid, device_uuid),
-            labels={"job_name": get_job_name(job.uuid, device_uuid)},
-        ),
-        spec=client.V1JobSpec(
-            backoff_limit=0,
-            ttl_seconds_after_finished=settings.KUBE_JOB_TTL,
-            template=client.V1PodTemplateSpec(
-                spec=client.V1PodSpec(
-                    restart_policy="Never",
-                    containers=containers,
-                    node_name=get_node_uuid(device_uuid),
-                    volumes=[
-                        client.V1Volume(
-                            name=volume_name,
-                            empty_dir=client.V1EmptyDirVolumeSource(
-                                size_limit=settings.KUBE_VOLUME_SIZE
-                            ),
-                        ),
-                        client.V1Volume(
-                            name="peripheral-config",
-                            config_map=client.V1ConfigMapVolumeSource(
-                                name=config_name,
+            for service in self.services
+            if service["service_ports"]
+        ]
+
+        job_name = get_job_name(self.job_uuid, device_uuid)
+        v1_job = client.V1Job(
+            api_version="batch/v1",
+            kind="Job",
+            metadata=client.V1ObjectMeta(
+                name=job_name,
+                labels={"job_name": job_name},
+            ),
+            spec=client.V1JobSpec(
+                backoff_limit=0,
+                active_deadline_seconds=self.active_deadline_seconds,
+                ttl_seconds_after_finished=settings.KUBE_JOB_TTL,
+                template=client.V1PodTemplateSpec(
+                    spec=client.V1PodSpec(
+                        restart_policy="Never",
+                        containers=containers,
+                        node_name=get_node_uuid(device_uuid),
+                        volumes=[
+                            self.volume,
+                            client.V1Volume(
+                                name="peripheral-config",
+                                config_map=client.V1ConfigMapVolumeSource(
+                                    name=config_name,
+                                ),
                             ),
-                        ),
-                        client.V1Volume(
-                            name=device_volume_name,
-                            host_path=client.V1HostPathVolumeSource(
-                                path="/mnt/data/shared_volume",
-                                type="DirectoryOrCreate",
+                            client.V1Volume(
+                                name=device_volume_name,
+                                host_path=client.V1HostPathVolumeSource(
+                                    path="/mnt/data/shared_volume",
+                                    type="DirectoryOrCreate",
+                                ),
                             ),
-                        ),
-                    ],
-                    image_pull_secrets=[
-                        client.V1LocalObjectReference(name=secret_name)
-                        for secret_name in settings.KUBE_IMAGE_PULL_SECRETS
-                    ],
-                    dns_policy="None",
-                    dns_config=client.V1PodDNSConfig(
-                        nameservers=["8.8.8.8"],
+                        ],
+                        image_pull_secrets=self.image_pull_secrets,
+                        dns_policy="None",
+                        dns_config=self.dns_config,
+                    ),
+                    metadata=client.V1ObjectMeta(
+                        name=pod_name, labels={"pod_name": pod_name}
                     ),
-                ),
-                metadata=client.V1ObjectMeta(
-                    name=pod_name, labels={"pod_name": pod_name}
                 ),
             ),
-        ),
-    )
-    for job_timing in job.timings.all():
-        string_parts = job_timing.timing.split(",")
-        timing_type, args = string_parts[0], string_parts[1:]
-        if timing_type == "type=on_demand":
-            td = util.parse_on_demand_args(args)
-            v1_job.spec.active_deadline_seconds = int(td.total_seconds())
-        elif timing_type == "type=advanced":
-            ts = util.parse_advanced_timing_args(args)
-            td = ts["end"] - ts["start"]
-            v1_job.spec.active_deadline_seconds = int(td.total_seconds())
+        )
+        return [config_map, v1_job, *k8s_services]
 
-    batch_api = client.BatchV1Api()
-    batch_api.create_namespaced_job(namespace, v1_job)
 
-    for service in k8s_services:
-        core_api.create_namespaced_service(namespace, service)
+def _deploy_objects(fleet_name, namespace, objects):
+    if settings.KUBE_SERVER_SIDE_APPLY:
+        apply_manifests(fleet_name, [to_manifest(o, namespace) for o in objects])
+        return
+
+    core_api = get_core_api(fleet_name)
+    create_funcs = {
+        "ConfigMap": core_api.create_namespaced_config_map,
+        "Job": get_batch_api(fleet_name).create_namespaced_job,
+        "Service": core_api.create_namespaced_service,
+    }
+    for obj in objects:
+        _create_if_missing(create_funcs[obj.kind], namespace, obj)
 
 
 def get_pod_node(pod_name, namespace):
-    for config_file in settings.KUBE_CLUSTERS.values():
-        try:
-            config.load_kube_config(config_file=config_file)
+    watch_caches = [get_synced_watch_cache(f) for f in settings.KUBE_CLUSTERS]
+    if all(watch_caches):
+        for watch_cache in watch_caches:
+            pod = watch_cache.get_pod(namespace, pod_name)
+            if pod and pod.spec.node_name:
+                return pod.spec.node_name
+        return None
 
-            v1 = client.CoreV1Api()
-            pod = v1.read_namespaced_pod(name=pod_name, namespace=namespace)
-            node_name = pod.spec.node_name
-            if node_name:
-                return node_name
+    def read_pod_node(fleet_name):
+        try:
+            pod = get_core_api(fleet_name).read_namespaced_pod(
+                name=pod_name,
+                namespace=namespace,
+                _request_timeout=settings.KUBE_CLUSTER_TIMEOUT,
+            )
+            return pod.spec.node_name
         except Exception:
-            continue
+            # The pod is not on this cluster
+            return None
+
+    for node_name in for_each_cluster(read_pod_node).values():
+        if node_name:
+            return node_name
     return None
@@ -0,0 +1,26 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from floto.api.kubernetes import ClusterWatchCache
+
+LOG = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Watches the nodes and pods of every cluster into the shared cache"
+
+    def handle(self, *args, **options):
+        if not settings.CACHE_REDIS_URL:
+            LOG.warning("CACHE_REDIS_URL is not set, so other processes cannot read")
+        watch_caches = [ClusterWatchCache(f) for f in settings.KUBE_CLUSTERS]
+        for watch_cache in watch_caches:
+            watch_cache.start()
+        LOG.info(f"Watching {len(watch_caches)} clusters")
+        while True:
+            # Readers stop trusting the cache if the heartbeats stop
+            time.sleep(settings.KUBE_WATCH_SYNCED_TTL / 3)
+            for watch_cache in watch_caches:
+                watch_cache.heartbeat()
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        (
+            "floto_api",
+            "0024_alter_application_deleted_alter_collection_deleted_and_more",
+        ),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DeviceSnapshot",
+            fields=[
+                ("version", models.BigAutoField(primary_key=True, serialize=False)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("balena_devices", models.JSONField(default=dict)),
+                ("kubernetes_nodes", models.JSONField(default=dict)),
+            ],
+        ),
+    ]
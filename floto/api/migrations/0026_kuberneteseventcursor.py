@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("floto_api", "0025_devicesnapshot"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="KubernetesEventCursor",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("fleet_name", models.CharField(max_length=255, unique=True)),
+                ("resource_version", models.CharField(max_length=255)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("floto_api", "0026_kuberneteseventcursor"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="application",
+            name="claims",
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
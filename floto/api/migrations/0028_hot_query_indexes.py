@@ -0,0 +1,48 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("floto_api", "0027_application_claims"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="devicetimeslot",
+            index=models.Index(
+                fields=["device_uuid", "start", "stop"],
+                name="devicetimeslot_device_time_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="event",
+            index=models.Index(fields=["status", "time"], name="event_status_time_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="job",
+            index=models.Index(
+                condition=models.Q(("cleaned_up", False)),
+                fields=["cleaned_up"],
+                name="job_cleaned_up_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="jobdevice",
+            index=models.Index(fields=["device_uuid"], name="jobdevice_device_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="kubernetesevent",
+            index=models.Index(
+                fields=["job", "-event_time"], name="kubeevent_job_time_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="kubernetesevent",
+            index=models.Index(
+                fields=["device", "-event_time"], name="kubeevent_device_time_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("floto_api", "0029_devicedeployment"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="JobManifest",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("device_uuid", models.CharField(max_length=36)),
+                ("fleet_name", models.CharField(max_length=512)),
+                ("manifests", models.JSONField()),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+                (
+                    "job",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="manifests",
+                        to="floto_api.job",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="jobmanifest",
+            constraint=models.UniqueConstraint(
+                fields=("job", "device_uuid"), name="unique_job_manifest_device"
+            ),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("floto_api", "0030_jobmanifest"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="event",
+            name="claimed_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name="event",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("PENDING", "Pending"),
+                    ("DEPLOYING", "Deploying"),
+                    ("DONE", "Done"),
+                    ("ERROR", "Error"),
+                ],
+                max_length=32,
+            ),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.30 on 2026-10-18 19:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("floto_api", "0033_deviceimport"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Release",
+            fields=[
+                ("id", models.IntegerField(primary_key=True, serialize=False)),
+                ("commit", models.CharField(max_length=64)),
+                ("created_at", models.DateTimeField()),
+                ("status", models.CharField(blank=True, max_length=64)),
+                ("note", models.CharField(blank=True, default="", max_length=1024)),
+                (
+                    "fleet",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="releases",
+                        to="floto_api.fleet",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="fleet",
+            name="target_release",
+            field=models.ForeignKey(
+                blank=True,
+                db_constraint=False,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="floto_api.release",
+            ),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-18 20:19
+
+from django.db import migrations, models
+
+partial_index = models.Index(
+    condition=models.Q(("cleaned_up", False)),
+    fields=["cleaned_up"],
+    name="job_cleaned_up_idx",
+)
+
+
+def remove_partial_index(apps, schema_editor):
+    # MySQL and MariaDB do not support partial indexes, so it was never created
+    if schema_editor.connection.features.supports_partial_indexes:
+        schema_editor.remove_index(apps.get_model("floto_api", "Job"), partial_index)
+
+
+def add_partial_index(apps, schema_editor):
+    if schema_editor.connection.features.supports_partial_indexes:
+        schema_editor.add_index(apps.get_model("floto_api", "Job"), partial_index)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("floto_api", "0035_event_retry"),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(remove_partial_index, add_partial_index),
+            ],
+            state_operations=[
+                migrations.RemoveIndex(
+                    model_name="job",
+                    name="job_cleaned_up_idx",
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="job",
+            index=models.Index(fields=["cleaned_up"], name="job_cleaned_up_idx"),
+        ),
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 4.2.30 on 2026-10-18 20:21
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("floto_api", "0036_job_cleaned_up_plain_index"),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name="JobManifest",
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 20:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("floto_api", "0037_delete_jobmanifest"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="application",
+            name="claims_version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -1,13 +1,24 @@
+import csv
+import functools
+import io
+import itertools
 import logging
+import operator
 import uuid
 from datetime import datetime
+from decimal import Decimal, InvalidOperation
 
+from django import dispatch
 from django.conf import settings
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import F, signals
 from django.utils.dateparse import parse_datetime
+from django.utils import timezone
 from django.utils.timezone import make_aware
 
 from floto.api import kubernetes
+from floto.api.balena import get_balena_client
 
 LOG = logging.getLogger(__name__)
 
@@ -95,10 +106,71 @@ class Application(CreatedByUserBase):
     description = models.CharField(max_length=2000)
     environment = models.JSONField()
     is_single_tenant = models.BooleanField(default=True)
+    # What the application's services claim on a device, kept so conflict
+    # checks don't walk the services. Cleared when the services change, which
+    # also bumps the version, so claims computed before are not saved.
+    claims = models.JSONField(null=True, blank=True, editable=False)
+    claims_version = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.name
 
+    @classmethod
+    def load_claims(cls, applications, save=True):
+        """
+        Computes the claims of any of the applications that do not have them,
+        in a fixed number of queries. With save, they are also stored, unless
+        they were cleared again since the applications were loaded.
+        """
+        missing = {app.pk: app for app in applications if app.claims is None}
+        if not missing:
+            return
+        claim_sources = {
+            "peripherals": (ServicePeripheral, "peripheral_schema__type"),
+            "resources": (ServiceClaimableResource, "resource_id"),
+            "ports": (ServicePort, "node_port"),
+        }
+        claims = {pk: {claim: set() for claim in claim_sources} for pk in missing}
+        app_field = "service__applications__application"
+        for claim, (model, field) in claim_sources.items():
+            rows = model.objects.filter(**{f"{app_field}__in": list(missing)})
+            for app_id, value in rows.values_list(app_field, field):
+                claims[app_id][claim].add(value)
+        for pk, app in missing.items():
+            app.claims = {claim: sorted(values) for claim, values in claims[pk].items()}
+        if not save:
+            return
+        cls.objects_all.filter(
+            functools.reduce(
+                operator.or_,
+                (
+                    models.Q(pk=pk, claims_version=app.claims_version)
+                    for pk, app in missing.items()
+                ),
+            )
+        ).update(
+            claims=models.Case(
+                *[
+                    models.When(
+                        pk=pk, then=models.Value(app.claims, models.JSONField())
+                    )
+                    for pk, app in missing.items()
+                ]
+            )
+        )
+
+    def get_claims(self):
+        """
+        Returns whether the application is single-tenant, and the sets of
+        peripherals, resources and node ports its services claim.
+        """
+        if self.claims is None:
+            Application.load_claims([self])
+        return {
+            "is_single_tenant": self.is_single_tenant,
+            **{claim: set(values) for claim, values in self.claims.items()},
+        }
+
 
 class ApplicationService(models.Model):
     application = models.ForeignKey(
@@ -114,11 +186,22 @@ class Job(CreatedByUserBase):
     environment = models.JSONField()
     cleaned_up = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            # cleanup_namespaces looks for the few jobs not cleaned up yet
+            models.Index(fields=["cleaned_up"], name="job_cleaned_up_idx"),
+        ]
+
 
 class JobDevice(models.Model):
     job = models.ForeignKey(Job, related_name="devices", on_delete=models.CASCADE)
     device_uuid = models.CharField(max_length=36)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["device_uuid"], name="jobdevice_device_idx"),
+        ]
+
 
 class JobTiming(models.Model):
     job = models.ForeignKey(Job, related_name="timings", on_delete=models.CASCADE)
@@ -151,16 +234,53 @@ class DeviceTimeslot(models.Model):
     objects = RelatedJobSoftDeleteManager()
     objects_all = models.Manager()
 
+    class Meta:
+        indexes = [
+            # Conflict checks find a device's timeslots overlapping a window
+            models.Index(
+                fields=["device_uuid", "start", "stop"],
+                name="devicetimeslot_device_time_idx",
+            ),
+        ]
+
 
 class Fleet(models.Model):
     id = models.IntegerField(primary_key=True)
     app_name = models.CharField(max_length=512)
     is_app_fleet = models.BooleanField(default=False)
+    # The release the fleet's devices should run, synced from balena
+    target_release = models.ForeignKey(
+        "Release",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="+",
+        db_constraint=False,
+    )
 
     def __str__(self):
         return f"{'*' if self.is_app_fleet else ''}{self.app_name} (id: {self.id})"
 
 
+class Release(models.Model):
+    """
+    A balena release of a fleet, synced by sync_fleet_releases
+    """
+
+    id = models.IntegerField(primary_key=True)
+    fleet = models.ForeignKey(Fleet, on_delete=models.CASCADE, related_name="releases")
+    commit = models.CharField(max_length=64)
+    created_at = models.DateTimeField()
+    status = models.CharField(max_length=64, blank=True)
+    note = models.CharField(max_length=1024, blank=True, default="")
+
+    # Fields that are copied from balena
+    synced_fields = ["fleet", "commit", "created_at", "status", "note"]
+
+    def __str__(self):
+        return f"{self.fleet_id}/{self.commit}"
+
+
 class DeviceData(models.Model):
     """
     Stores our custom data on the device and filter balena API
@@ -228,7 +348,11 @@ class DeviceData(models.Model):
     def address(self):
         return f"{self.address_1}, {self.city}, {self.state}, {self.zip_code}"
 
-    def has_app_access(self, user, active_project=None):
+    def has_app_access(self, user, active_project=None, user_project_ids=None):
+        """
+        user_project_ids can be given when the caller has already loaded the
+        user's projects, e.g. when checking many devices at once.
+        """
         if user.is_anonymous:
             return False
         if active_project:
@@ -236,40 +360,286 @@ class DeviceData(models.Model):
                 self.allow_all_projects
                 or active_project in self.application_projects.all()
             )
+        if user_project_ids is None:
+            user_project_ids = set(user.projects.values_list("pk", flat=True))
         return self.allow_all_projects or any(
-            allowed_project in user.projects.all()
+            allowed_project.pk in user_project_ids
             for allowed_project in self.application_projects.all()
         )
 
-    def save(self, *args, **kwargs):
-        def get_lat_long(address):
-            import requests
+    @classmethod
+    def get_access(cls, device_uuids, project_ids, active_project=None):
+        """
+        Returns {device uuid: (management access, application access)} for the
+        devices that exist, in two queries, for a user in the projects with
+        project_ids. As in has_app_access, only active_project counts if given.
+        """
+        if active_project is not None:
+            project_ids = {active_project.pk}
+        devices = cls.objects.filter(device_uuid__in=device_uuids).values_list(
+            "device_uuid", "owner_project_id", "allow_all_projects"
+        )
+        app_device_uuids = set(
+            cls.application_projects.through.objects.filter(
+                devicedata_id__in=device_uuids, project_id__in=project_ids
+            ).values_list("devicedata_id", flat=True)
+        )
+        access = {}
+        for device_uuid, owner_project_id, allow_all_projects in devices:
+            management = owner_project_id in project_ids
+            access[device_uuid] = (
+                management,
+                management or allow_all_projects or device_uuid in app_device_uuids,
+            )
+        return access
 
-            params = {"q": address, "format": "json"}
-            headers = {"User-Agent": "flotowebapp"}
-            url = "https://nominatim.openstreetmap.org/search"
-            LOG.info(f"Making the Nominatim Geocode API request for {address}")
-            try:
-                response = requests.get(url, headers=headers, params=params)
-                response.raise_for_status()
-                data = response.json()
-                if data:
-                    return float(data[0]["lat"]), float(data[0]["lon"])
-            except requests.RequestException as e:
-                LOG.error(f"Geocoding error for address {address} - {e}")
-            return None, None
-
-        # update lat, long only if address changed
-        if self.__original_address != self.address():
-            lat, long = get_lat_long(self.address())
-            if lat and long:
-                import random
-
-                lat += random.uniform(-0.005, 0.005)
-                long += random.uniform(-0.005, 0.005)
-                self.latitude, self.longitude = lat, long
+    def save(self, *args, **kwargs):
+        # Geocode in the background, only if the address changed
+        address_changed = self.__original_address != self.address()
         self.__original_address = self.address()
         super(DeviceData, self).save(*args, **kwargs)
+        if address_changed:
+            from floto.api import tasks
+
+            transaction.on_commit(
+                lambda: tasks.geocode_devices.delay([self.device_uuid])
+            )
+
+
+class GeocodeCache(models.Model):
+    """
+    Coordinates of addresses that have been geocoded, so that each address is
+    only looked up once. Addresses that were not found have no coordinates.
+    """
+
+    address = models.CharField(max_length=512, unique=True)
+    latitude = models.FloatField(null=True)
+    longitude = models.FloatField(null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.address
+
+
+class DeviceImport(models.Model):
+    """
+    A CSV of device details uploaded in the admin, which is applied in chunks in
+    the background. Rows that fail validation are recorded in errors.
+    """
+
+    class Status(models.TextChoices):
+        PENDING = "PENDING", "Pending"
+        RUNNING = "RUNNING", "Running"
+        DONE = "DONE", "Done"
+        ERROR = "ERROR", "Error"
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True
+    )
+    csv_file = models.FileField(upload_to="device_imports/")
+    status = models.CharField(
+        max_length=32, choices=Status.choices, default=Status.PENDING
+    )
+    total_rows = models.IntegerField(null=True)
+    processed_rows = models.IntegerField(default=0)
+    updated_rows = models.IntegerField(default=0)
+    # The first DEVICE_IMPORT_MAX_ERRORS invalid rows, as
+    # [{"row": line number, "device_uuid": ..., "error": ...}]
+    errors = models.JSONField(default=list, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    # Columns that are copied to the device, the rest are only for reference
+    update_fields = [
+        "deployment_name",
+        "contact",
+        "address_1",
+        "address_2",
+        "city",
+        "state",
+        "country",
+        "zip_code",
+        "latitude",
+        "longitude",
+    ]
+
+    def __str__(self):
+        return f"{self.csv_file.name} ({self.status})"
+
+    def _read_rows(self):
+        with self.csv_file.storage.open(self.csv_file.name, "rb") as f:
+            yield from csv.DictReader(io.TextIOWrapper(f, "utf-8-sig"))
+
+    @staticmethod
+    def _clean_row(row):
+        """
+        Returns the row's values for update_fields, converted with the model
+        fields. Raises ValidationError if a value is not valid.
+        """
+        values = {}
+        for name in DeviceImport.update_fields:
+            field = DeviceData._meta.get_field(name)
+            value = (row.get(name) or "").strip()
+            if not value and field.null:
+                value = None
+            elif isinstance(field, models.DecimalField):
+                # Round e.g. GPS coordinates to what the column stores
+                try:
+                    value = Decimal(value).quantize(
+                        Decimal(1).scaleb(-field.decimal_places)
+                    )
+                except InvalidOperation:
+                    pass
+            values[name] = field.clean(value, None)
+        if (values["latitude"] is None) != (values["longitude"] is None):
+            raise ValidationError("latitude and longitude must be given together")
+        return values
+
+    def _apply_chunk(self, rows):
+        """
+        Updates the devices in the chunk of (line number, row) that changed.
+        Returns the number of devices updated, and the errors.
+        """
+        errors = []
+        devices = DeviceData.objects.in_bulk(
+            [row.get("device_uuid") for _, row in rows]
+        )
+        changed, moved = [], []
+        for line, row in rows:
+            device = devices.get(row.get("device_uuid"))
+            if device is None:
+                errors.append(
+                    {
+                        "row": line,
+                        "device_uuid": row.get("device_uuid"),
+                        "error": "Device does not exist",
+                    }
+                )
+                continue
+            try:
+                values = self._clean_row(row)
+            except ValidationError as e:
+                errors.append(
+                    {
+                        "row": line,
+                        "device_uuid": device.device_uuid,
+                        "error": "; ".join(e.messages),
+                    }
+                )
+                continue
+            if values["latitude"] is None:
+                # Keep the coordinates, geocoding sets them if the address moved
+                del values["latitude"], values["longitude"]
+            original_address = device.address()
+            if all(getattr(device, k) == v for k, v in values.items()):
+                continue
+            for name, value in values.items():
+                setattr(device, name, value)
+            changed.append(device)
+            if device.address() != original_address and "latitude" not in values:
+                moved.append(device.device_uuid)
+
+        with transaction.atomic():
+            DeviceData.objects.bulk_update(changed, self.update_fields)
+            if moved:
+                from floto.api import tasks
+
+                transaction.on_commit(lambda: tasks.geocode_devices.delay(moved))
+        return len(changed), errors
+
+    def run(self, chunk_size):
+        """
+        Applies the CSV in chunks of chunk_size rows, saving the progress after
+        each chunk
+        """
+        self.status = DeviceImport.Status.RUNNING
+        self.save(update_fields=["status"])
+        try:
+            self.total_rows = sum(1 for _ in self._read_rows())
+            self.save(update_fields=["total_rows"])
+            rows = enumerate(self._read_rows(), start=2)
+            while chunk := list(itertools.islice(rows, chunk_size)):
+                updated, errors = self._apply_chunk(chunk)
+                self.processed_rows += len(chunk)
+                self.updated_rows += updated
+                update_fields = ["processed_rows", "updated_rows"]
+                errors = errors[: settings.DEVICE_IMPORT_MAX_ERRORS - len(self.errors)]
+                if errors:
+                    self.errors.extend(errors)
+                    update_fields.append("errors")
+                self.save(update_fields=update_fields)
+        except Exception as e:
+            LOG.exception(f"Device import {self.pk} failed")
+            self.errors.append({"row": None, "device_uuid": None, "error": str(e)})
+            self.status = DeviceImport.Status.ERROR
+        else:
+            self.status = DeviceImport.Status.DONE
+        self.finished_at = timezone.now()
+        self.save(update_fields=["status", "errors", "finished_at"])
+
+
+class DeviceSnapshot(models.Model):
+    """
+    A materialized copy of the balena devices and kubernetes nodes, refreshed in
+    the background so that device listings never wait on either API.
+    """
+
+    version = models.BigAutoField(primary_key=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # balena device JSON, keyed by device uuid
+    balena_devices = models.JSONField(default=dict)
+    # Output of kubernetes.summarize_node, keyed by node name
+    kubernetes_nodes = models.JSONField(default=dict)
+
+    # The snapshot most recently loaded by this process
+    _current = None
+
+    @classmethod
+    def current(cls):
+        """
+        Returns the newest snapshot, or None if one has not been built yet.
+        The parsed snapshot is reused for as long as its version is the newest.
+        """
+        latest = (
+            cls.objects.order_by("-version")
+            .values_list("version", "created_at")
+            .first()
+        )
+        if latest is None:
+            return None
+        current = cls._current
+        if current is None or (current.version, current.created_at) != latest:
+            current = cls.objects.get(pk=latest[0])
+            cls._current = current
+        return current
+
+    @classmethod
+    def refresh(cls):
+        """
+        Builds a new snapshot from balena and kubernetes, and prunes old versions.
+        If kubernetes cannot be reached, the nodes from the previous snapshot are kept.
+        """
+        balena = get_balena_client()
+        balena_devices = {d["uuid"]: d for d in balena.models.device.get_all()}
+        try:
+            kubernetes_nodes = {
+                node.metadata.name: kubernetes.summarize_node(node)
+                for node in kubernetes.get_nodes()
+            }
+        except Exception as e:
+            LOG.error("Could not get kubernetes nodes for device snapshot")
+            LOG.exception(e)
+            previous = cls.current()
+            kubernetes_nodes = previous.kubernetes_nodes if previous else {}
+
+        snapshot = cls.objects.create(
+            balena_devices=balena_devices,
+            kubernetes_nodes=kubernetes_nodes,
+        )
+        cls.objects.filter(
+            version__lte=snapshot.version - settings.DEVICE_SNAPSHOT_RETENTION
+        ).delete()
+        return snapshot
 
 
 class PeripheralSchema(models.Model):
@@ -359,10 +729,17 @@ class Event(models.Model):
 
     class Status(models.TextChoices):
         PENDING = "PENDING", "Pending"
+        DEPLOYING = "DEPLOYING", "Deploying"
         DONE = "DONE", "Done"
         ERROR = "ERROR", "Error"
 
     status = models.CharField(max_length=32, choices=Status.choices)
+    # When a worker started deploying the event
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    # How many times deploying the event was started
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # When a failed deployment is retried, if later than the event's time
+    retry_at = models.DateTimeField(null=True, blank=True)
 
     class RelatedJobSoftDeleteManager(models.Manager):
         def get_queryset(self):
@@ -371,6 +748,40 @@ class Event(models.Model):
     objects = RelatedJobSoftDeleteManager()
     objects_all = models.Manager()
 
+    class Meta:
+        indexes = [
+            # deploy_jobs looks for pending events that are due
+            models.Index(fields=["status", "time"], name="event_status_time_idx"),
+        ]
+
+
+class DeviceDeployment(models.Model):
+    """
+    The outcome of deploying an event's job to one of its devices
+    """
+
+    event = models.ForeignKey(
+        Event, related_name="deployments", on_delete=models.CASCADE
+    )
+    device_uuid = models.CharField(max_length=36)
+
+    class Status(models.TextChoices):
+        PENDING = "PENDING", "Pending"
+        DONE = "DONE", "Done"
+        ERROR = "ERROR", "Error"
+
+    status = models.CharField(
+        max_length=32, choices=Status.choices, default=Status.PENDING
+    )
+    error = models.TextField(blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["event", "device_uuid"], name="unique_event_device"
+            ),
+        ]
+
 
 class KubernetesEvent(models.Model):
     # Basically everything in kubernetes is optional, so everything is nullable
@@ -411,9 +822,16 @@ class KubernetesEvent(models.Model):
         ordering = ['-event_time']
         verbose_name = "Kubernetes Event"
         verbose_name_plural = "Kubernetes Events"
+        indexes = [
+            # The job and device events endpoints list events newest first
+            models.Index(fields=["job", "-event_time"], name="kubeevent_job_time_idx"),
+            models.Index(
+                fields=["device", "-event_time"], name="kubeevent_device_time_idx"
+            ),
+        ]
 
     @classmethod
-    def from_kubernetes_event(cls, event):
+    def from_kubernetes_event(cls, event, job=None, device=None):
         def to_datetime(k8s_time):
             if not k8s_time:
                 return None
@@ -422,25 +840,6 @@ class KubernetesEvent(models.Model):
                 return make_aware(dt) if dt else None
             return make_aware(k8s_time) if not k8s_time.tzinfo else k8s_time
 
-        try:
-            job = kubernetes.get_job_from_namespace(event.metadata.namespace)
-        except Exception:
-            job = None
-
-        device = None
-        if event.involved_object.kind.lower() == "node":
-            try:
-                device = DeviceData.objects.get(pk=event.involved_object.name)
-            except DeviceData.DoesNotExist:
-                device = None
-        elif event.involved_object.kind.lower() == "pod":
-            try:
-                # Look up the node for the pod
-                device_pk = kubernetes.get_pod_node(event.involved_object.name, event.metadata.namespace)
-                device = DeviceData.objects.get(pk=device_pk)
-            except DeviceData.DoesNotExist:
-                device = None
-
         return KubernetesEvent(
             uid=event.metadata.uid,
             name=event.metadata.name,
@@ -462,6 +861,72 @@ class KubernetesEvent(models.Model):
             device=device,
         )
 
+    @classmethod
+    def save_kubernetes_events(cls, events, pod_nodes=None):
+        """
+        Saves new events, and updates the count and timestamps of ones we have
+        already seen, in a fixed number of queries. pod_nodes maps
+        (namespace, pod name) to node name, for events about pods.
+        Returns the number of (created, updated) events.
+        """
+        pod_nodes = pod_nodes or {}
+        # A watch can return several versions of an event; keep the latest
+        latest = {e.metadata.uid: e for e in events if e.metadata.uid}
+
+        node_names = {}
+        for uid, event in latest.items():
+            kind = (event.involved_object.kind or "").lower()
+            if kind == "node":
+                node_names[uid] = event.involved_object.name
+            elif kind == "pod":
+                node_names[uid] = pod_nodes.get(
+                    (event.metadata.namespace, event.involved_object.name)
+                )
+        devices = DeviceData.objects.in_bulk(
+            {name for name in node_names.values() if name}
+        )
+        job_ids = {
+            uid: kubernetes.get_job_id_from_namespace(event.metadata.namespace)
+            for uid, event in latest.items()
+        }
+        jobs = Job.objects.in_bulk({job_id for job_id in job_ids.values() if job_id})
+
+        existing = cls.objects.in_bulk(list(latest), field_name="uid")
+        to_create, to_update = [], []
+        for uid, event in latest.items():
+            event_obj = cls.from_kubernetes_event(
+                event,
+                job=jobs.get(job_ids[uid]),
+                device=devices.get(node_names.get(uid)),
+            )
+            if uid in existing:
+                current = existing[uid]
+                current.count = event_obj.count
+                current.last_timestamp = event_obj.last_timestamp
+                current.event_time = event_obj.event_time
+                current.message = event_obj.message
+                to_update.append(current)
+            else:
+                to_create.append(event_obj)
+
+        cls.objects.bulk_create(to_create, batch_size=500, ignore_conflicts=True)
+        cls.objects.bulk_update(
+            to_update,
+            ["count", "last_timestamp", "event_time", "message"],
+            batch_size=500,
+        )
+        return len(to_create), len(to_update)
+
+
+class KubernetesEventCursor(models.Model):
+    """
+    The resourceVersion collect_events resumes watching events from, per cluster
+    """
+
+    fleet_name = models.CharField(max_length=255, unique=True)
+    resource_version = models.CharField(max_length=255)
+    updated_at = models.DateTimeField(auto_now=True)
+
 
 class Dataset(CreatedByUserBase):
     name = models.CharField(max_length=1024, unique=True)
@@ -482,3 +947,33 @@ class DownloadEvent(models.Model):
         Dataset,
         on_delete=models.CASCADE,
     )
+
+
+@dispatch.receiver(signals.post_save, sender=ApplicationService)
+@dispatch.receiver(signals.post_delete, sender=ApplicationService)
+def clear_application_claims(sender, instance, **kwargs):
+    Application.objects_all.filter(pk=instance.application_id).update(
+        claims=None, claims_version=F("claims_version") + 1
+    )
+
+
+@dispatch.receiver(signals.post_save, sender=ServicePeripheral)
+@dispatch.receiver(signals.post_delete, sender=ServicePeripheral)
+@dispatch.receiver(signals.post_save, sender=ServiceClaimableResource)
+@dispatch.receiver(signals.post_delete, sender=ServiceClaimableResource)
+@dispatch.receiver(signals.post_save, sender=ServicePort)
+@dispatch.receiver(signals.post_delete, sender=ServicePort)
+def clear_service_claims(sender, instance, **kwargs):
+    """
+    When a service's claims change, so do those of every application using it
+    """
+    Application.objects_all.filter(services__service=instance.service_id).update(
+        claims=None, claims_version=F("claims_version") + 1
+    )
+
+
+@dispatch.receiver(signals.post_save, sender=PeripheralSchema)
+def clear_peripheral_schema_claims(sender, instance, **kwargs):
+    Application.objects_all.filter(
+        services__service__peripheral_schemas__peripheral_schema=instance
+    ).update(claims=None, claims_version=F("claims_version") + 1)
@@ -1,9 +1,9 @@
 import logging
 
 from rest_framework import permissions
+from rest_framework.exceptions import NotFound
 from rest_framework.permissions import SAFE_METHODS
-from floto.api.models import DeviceData
-from floto.api.serializers import DeviceSerializer
+from floto.api.access import get_access_context
 
 LOG = logging.getLogger(__name__)
 
@@ -17,7 +17,7 @@ class MethodAllowed(permissions.BasePermission):
             return True
         if not request.user.is_authenticated:
             return False
-        return any(request.user.projects.all())
+        return bool(get_access_context(request).project_ids)
 
     def has_object_permission(self, request, view, obj):
         return self.has_permission(request, view)
@@ -42,35 +42,26 @@ class DevicePermission(permissions.BasePermission):
 
     APPLICATION_VIEWS = {}
 
+    def _get_access(self, request, view):
+        pk = view.kwargs.get("pk")
+        access = get_access_context(request).device_access([pk]).get(pk)
+        if access is None:
+            raise NotFound(f"Device {pk} does not exist")
+        return access
+
     def has_permission(self, request, view):
         # Always check for management permission
         if DevicePermission.MANAGEMENT_VIEWS.get(view.basename, {}).get(view.name):
-            pk = view.kwargs.get("pk")
-            if pk:
-                device = DeviceData.objects.get(pk=pk)
-                return DeviceSerializer(
-                    device,
-                    context={
-                        "balena_device": {},
-                        "kubernetes_node": {},
-                        "request": request,
-                    },
-                ).data["management_access"]
+            if view.kwargs.get("pk"):
+                management_access, _ = self._get_access(request, view)
+                return management_access
         # Check write methods against application views
         if (
             request.method not in SAFE_METHODS
             and DevicePermission.APPLICATION_VIEWS.get(view.basename, {}).get(view.name)
         ):
-            pk = view.kwargs.get("pk")
-            if pk:
-                device = DeviceData.objects.get(pk=pk)
-                return DeviceSerializer(
-                    device,
-                    context={
-                        "balena_device": {},
-                        "kubernetes_node": {},
-                        "request": request,
-                    },
-                ).data["application_access"]
+            if view.kwargs.get("pk"):
+                _, application_access = self._get_access(request, view)
+                return application_access
         # Otherwise, view is allowed
         return True
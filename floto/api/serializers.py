@@ -1,12 +1,14 @@
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
+from floto.api.access import get_access_context
 from floto.api import models
 from floto.api import util
-from floto.api import kubernetes
+from floto.api import tasks
 from floto.auth.models import KeycloakUser
 
 import logging
 from django.db import transaction
+from django.db.models import Prefetch
 from django.conf import settings
 from drf_spectacular.utils import extend_schema_serializer, extend_schema_field
 from drf_spectacular.types import OpenApiTypes
@@ -39,7 +41,7 @@ class CreatedByUserSerializer(serializers.ModelSerializer):
     )
 
     def validate_created_by_project(self, value):
-        if value not in self.context["request"].user.projects.all():
+        if not get_access_context(self.context["request"]).is_member(value):
             raise serializers.ValidationError("You are not a member of that project")
         return value
 
@@ -111,6 +113,7 @@ class ApplicationServiceSerializer(serializers.ModelSerializer):
 class ApplicationSerializer(CreatedByUserSerializer):
     class Meta(CreatedByUserMeta):
         model = models.Application
+        exclude = CreatedByUserMeta.exclude + ("claims",)
 
     @transaction.atomic
     def create(self, validated_data):
@@ -161,25 +164,6 @@ class JobDeviceSerializer(serializers.ModelSerializer):
         fields = ["device_uuid"]
         read_only_fields = ["job"]
 
-    def validate_device_uuid(self, value):
-        try:
-            device = models.DeviceData.objects.get(pk=value)
-        except models.DeviceData.DoesNotExist:
-            raise serializers.ValidationError(f"Invalid device UUID {value}")
-        r = DeviceSerializer(
-            device,
-            context={
-                "balena_device": {},
-                "kubernetes_node": {},
-                "request": self.context["request"],
-            },
-        ).data["application_access"]
-        if not r:
-            raise serializers.ValidationError(
-                f"No application access to device {value}"
-            )
-        return value
-
 
 class EventSerializer(serializers.ModelSerializer):
     class Meta:
@@ -223,29 +207,34 @@ class JobSerializer(CreatedByUserSerializer):
             "cleaned_up",
         )
 
+    def validate_devices(self, value):
+        """
+        Checks access to all of the job's devices at once. Errors are keyed per
+        device, as if JobDeviceSerializer had validated each one.
+        """
+        device_uuids = [device["device_uuid"] for device in value]
+        access = get_access_context(self.context["request"]).device_access(
+            device_uuids
+        )
+        errors = []
+        for device_uuid in device_uuids:
+            if device_uuid not in access:
+                errors.append({"device_uuid": [f"Invalid device UUID {device_uuid}"]})
+            elif not access[device_uuid][1]:
+                errors.append(
+                    {"device_uuid": [f"No application access to device {device_uuid}"]}
+                )
+            else:
+                errors.append({})
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return value
+
     @transaction.atomic
     def create(self, validated_data):
         devices_data = validated_data.pop("devices")
         timings_data = validated_data.pop("timings")
 
-        job = models.Job.objects.create(**validated_data)
-        for device in devices_data:
-            models.JobDevice.objects.create(
-                job=job,
-                device_uuid=device["device_uuid"],
-            )
-        for timing in timings_data:
-            db_timing = models.JobTiming.objects.create(
-                job=job,
-                timing=timing["timing"],
-            )
-            for ts in util.parse_timing_string(timing["timing"]):
-                models.Event.objects.create(
-                    time=ts["start"],
-                    timing=db_timing,
-                    status=models.Event.Status.PENDING,
-                )
-
         res = util.parse_timings(
             timings_data, devices_data, validated_data["application"].uuid
         )
@@ -255,24 +244,56 @@ class JobSerializer(CreatedByUserSerializer):
                 + "\n".join(res["conflicts"].keys()),
                 code=409,
             )
-        for device in devices_data:
-            for label, timeslots in res["timeslots"].items():
-                # Get the DB object we created above for this timing.
-                db_timing = models.JobTiming.objects.get(timing=label, job=job)
-                for timeslot in timeslots:
-                    start = timeslot["start"]
-                    stop = timeslot["stop"]
-                    models.DeviceTimeslot.objects.create(
-                        start=start,
-                        stop=stop,
-                        device_uuid=device["device_uuid"],
-                        job=job,
-                        note=label,
-                        category="JOB",
-                        timing=db_timing,
-                    )
+
+        job = models.Job.objects.create(**validated_data)
+        models.JobDevice.objects.bulk_create(
+            models.JobDevice(job=job, device_uuid=device["device_uuid"])
+            for device in devices_data
+        )
+        # There are few timings, so create them one by one to get their keys on
+        # every database, and keep them to create the per-device rows in bulk.
+        db_timings = {
+            timing["timing"]: models.JobTiming.objects.create(
+                job=job, timing=timing["timing"]
+            )
+            for timing in timings_data
+        }
+        models.Event.objects.bulk_create(
+            models.Event(
+                time=timeslot["start"],
+                timing=db_timings[label],
+                status=models.Event.Status.PENDING,
+            )
+            for label, timeslots in res["timeslots"].items()
+            for timeslot in timeslots
+        )
+        models.DeviceTimeslot.objects.bulk_create(
+            (
+                models.DeviceTimeslot(
+                    start=timeslot["start"],
+                    stop=timeslot["stop"],
+                    device_uuid=device["device_uuid"],
+                    job=job,
+                    note=label,
+                    category="JOB",
+                    timing=db_timings[label],
+                )
+                for device in devices_data
+                for label, timeslots in res["timeslots"].items()
+                for timeslot in timeslots
+            ),
+            batch_size=1000,
+        )
         if not settings.KUBE_READ_ONLY:
-            kubernetes.prepare_deployment(job)
+            # Creating namespaces can be slow, so do it after the job is saved,
+            # rather than holding the transaction open.
+            transaction.on_commit(
+                lambda: tasks.prepare_job_deployment.delay(str(job.uuid))
+            )
+        event_times = list(
+            models.Event.objects.filter(timing__job=job).values_list("pk", "time")
+        )
+        transaction.on_commit(lambda: tasks.schedule_events(event_times))
 
         return job
 
@@ -290,6 +311,18 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ["email"]
 
 
+class FleetSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.Fleet
+        fields = ["id", "app_name", "is_app_fleet", "target_release"]
+
+
+class ReleaseSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = models.Release
+        fields = ["id", "fleet", "commit", "created_at", "status", "note"]
+
+
 class ProjectSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.Project
@@ -344,6 +377,26 @@ class DeviceSerializer(serializers.ModelSerializer):
         model = models.DeviceData
         fields = []  # No fields by default
 
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """
+        Prefetch everything to_representation reads, so serializing any
+        number of devices costs a fixed number of queries.
+        """
+        return queryset.prefetch_related(
+            "application_projects",
+            Prefetch(
+                "peripherals",
+                queryset=models.PeripheralInstance.objects.select_related(
+                    "peripheral__schema"
+                ).prefetch_related(
+                    "peripheral__schema__resources",
+                    "peripheral__schema__configuration_items",
+                    "configuration",
+                ),
+            ),
+        )
+
     def _device_supports_schema(self, ps, node_status_capacity):
         # For each resource in the schema, it exists on the device
         for resource in ps.resources.all():
@@ -353,7 +406,7 @@ class DeviceSerializer(serializers.ModelSerializer):
 
     def to_representation(self, instance):
         """
-        Combine the openbalena device, kubernetes_node,
+        Combine the openbalena device, kubernetes_node (see kubernetes.summarize_node),
         and this to get the public version
 
         If active_project is passed, compute management/app access based on only that
@@ -369,6 +422,9 @@ class DeviceSerializer(serializers.ModelSerializer):
         )
 
         active_project = self.context.get("active_project", None)
+        user_project_ids = self.context.get("user_project_ids")
+        if user_project_ids is None:
+            user_project_ids = get_access_context(request).project_ids
 
         BALENA_KEYS = [
             "created_at",
@@ -396,19 +452,11 @@ class DeviceSerializer(serializers.ModelSerializer):
         is_ready = False
         peripheral_resources = []
         if kubernetes_node:
-            is_ready = (
-                next(
-                    c for c in kubernetes_node.status.conditions if c.type == "Ready"
-                ).status
-                == "True"
-            )
-
+            is_ready = kubernetes_node["is_ready"]
             peripheral_resources = [
                 ps.type
                 for ps in peripheral_schemas
-                if self._device_supports_schema(
-                    ps, kubernetes_node.status.capacity.keys()
-                )
+                if self._device_supports_schema(ps, kubernetes_node["capacity"])
             ]
         ip_address = (
             []
@@ -421,9 +469,9 @@ class DeviceSerializer(serializers.ModelSerializer):
             else [mac for mac in balena_device["mac_address"].split(" ")]
         )
         management_access = (
-            active_project == instance.owner_project
+            active_project.pk == instance.owner_project_id
             if active_project
-            else request.user in instance.owner_project.members.all()
+            else instance.owner_project_id in user_project_ids
         )
 
         # Get status, use balena status if none set in DB
@@ -436,7 +484,9 @@ class DeviceSerializer(serializers.ModelSerializer):
             {
                 "management_access": management_access,
                 "application_access": management_access
-                or instance.has_app_access(request.user, active_project),
+                or instance.has_app_access(
+                    request.user, active_project, user_project_ids
+                ),
                 "is_ready": is_ready,
                 "ip_address": ip_address,
                 "mac_address": mac_address,
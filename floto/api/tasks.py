@@ -1,24 +1,40 @@
 import csv
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 import logging
 import os
-import time
 
 
 from celery.app import shared_task
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
-from floto.api import kubernetes
+from django.db.models import Value
+from django.db.models.functions import Coalesce, Greatest
+from floto.api import fleets, geocoding, kubernetes
 
 from floto.api.balena import get_balena_client
 from floto.api.kubernetes import get_nodes, label_node
-from floto.api.models import DeviceData, Fleet, Job, Project, Event, KubernetesEvent
+from floto.api.models import (
+    DeviceData,
+    DeviceDeployment,
+    DeviceImport,
+    DeviceSnapshot,
+    Fleet,
+    Job,
+    Event,
+    KubernetesEvent,
+    KubernetesEventCursor,
+)
+from floto.celery import SingletonTask
 
 LOG = logging.getLogger(__name__)
 
 
-@shared_task(name="label_nodes")
+@shared_task(
+    name="label_nodes",
+    base=SingletonTask,
+    time_limit=300,
+    soft_time_limit=270,
+)
 def label_nodes():
     """
     Label all kubernetes nodes that match to balena devices
@@ -33,12 +49,19 @@ def label_nodes():
             pass
 
 
-@shared_task(name="cleanup_namespaces")
+@shared_task(
+    name="cleanup_namespaces",
+    base=SingletonTask,
+    time_limit=900,
+    soft_time_limit=810,
+)
 def cleanup_namespaces():
     """
     Cleanup all jobs that are over in k8s
     """
-    for job in Job.objects_all.filter(cleaned_up=False):
+    # Compared with = rather than written as NOT cleaned_up, which databases
+    # do not look up in the cleaned_up index
+    for job in Job.objects_all.filter(cleaned_up=Value(False)):
         # If all timeslots have finished, we can terminate in k8s
         ts = job.timeslots.filter(stop__gte=datetime.now(timezone.utc))
         if not ts:
@@ -49,42 +72,121 @@ def cleanup_namespaces():
             job.save()
 
 
-@shared_task(name="sync_balena_device_to_db")
+@shared_task(
+    name="sync_balena_device_to_db",
+    base=SingletonTask,
+    time_limit=300,
+    soft_time_limit=270,
+)
 def sync_balena_device_to_db():
     """
     Syncs balena data to local database
 
     1. Stores fleets from balena
     2. Updates devices with that fleet information
+
+    Only rows that differ from balena are written, in bulk, and without saving
+    each device, so that no address is geocoded. Returns the number of rows
+    created and updated.
     """
     balena = get_balena_client()
-    for fleet in balena.models.application.get_all():
-        obj, created = Fleet.objects.get_or_create(
-            app_name=fleet["app_name"],
-            id=fleet["id"],
-        )
-        if created:
-            LOG.info(f"Created fleet object '${obj.app_name}'")
-    devices = balena.models.device.get_all()
-    for device in devices:
-        try:
-            obj = DeviceData.objects.get(device_uuid=device["uuid"])
-            obj.fleet = Fleet.objects.get(pk=device["belongs_to__application"]["__id"])
-            obj.save()
-        except DeviceData.DoesNotExist:
-            obj = DeviceData(
-                device_uuid=device["uuid"],
-                name=device["device_name"],
-                allow_all_projects=False,
-                owner_project=Project.objects.get(pk=settings.FLOTO_ADMIN_PROJECT),
-                fleet=Fleet.objects.get(pk=device["belongs_to__application"]["__id"]),
+    counts = {
+        "fleets_created": 0,
+        "fleets_updated": 0,
+        "devices_created": 0,
+        "devices_updated": 0,
+    }
+
+    fleets_by_id = Fleet.objects.in_bulk()
+    new_fleets, changed_fleets = [], []
+    for fleet in balena.models.application.get_all({"$select": ["id", "app_name"]}):
+        obj = fleets_by_id.get(fleet["id"])
+        if obj is None:
+            obj = Fleet(id=fleet["id"], app_name=fleet["app_name"])
+            new_fleets.append(obj)
+            fleets_by_id[obj.id] = obj
+            LOG.info(f"Created fleet object '{obj.app_name}'")
+        elif obj.app_name != fleet["app_name"]:
+            obj.app_name = fleet["app_name"]
+            changed_fleets.append(obj)
+    # sync_fleet_releases may have created a new fleet meanwhile
+    Fleet.objects.bulk_create(new_fleets, ignore_conflicts=True)
+    Fleet.objects.bulk_update(changed_fleets, ["app_name"])
+    counts["fleets_created"] = len(new_fleets)
+    counts["fleets_updated"] = len(changed_fleets)
+
+    device_fleets = dict(DeviceData.objects.values_list("device_uuid", "fleet_id"))
+    new_devices, changed_devices = [], []
+    for device in balena.models.device.get_all(
+        {"$select": ["uuid", "device_name", "belongs_to__application"]}
+    ):
+        fleet_id = device["belongs_to__application"]["__id"]
+        if fleet_id not in fleets_by_id:
+            LOG.warning(f"Device {device['uuid']} is in unknown fleet {fleet_id}")
+            continue
+        if device["uuid"] not in device_fleets:
+            new_devices.append(
+                DeviceData(
+                    device_uuid=device["uuid"],
+                    name=device["device_name"],
+                    allow_all_projects=False,
+                    owner_project_id=settings.FLOTO_ADMIN_PROJECT,
+                    fleet_id=fleet_id,
+                )
+            )
+            LOG.info(f"New device '{device['device_name']}'")
+        elif device_fleets[device["uuid"]] != fleet_id:
+            changed_devices.append(
+                DeviceData(device_uuid=device["uuid"], fleet_id=fleet_id)
             )
-            obj.save()
-            if created:
-                LOG.info(f"New device '${obj.name}'")
+    DeviceData.objects.bulk_create(new_devices)
+    DeviceData.objects.bulk_update(changed_devices, ["fleet"], batch_size=500)
+    counts["devices_created"] = len(new_devices)
+    counts["devices_updated"] = len(changed_devices)
+
+    LOG.info(f"Synced balena devices: {counts}")
+    return counts
+
+
+@shared_task(
+    name="sync_fleet_releases",
+    base=SingletonTask,
+    time_limit=300,
+    soft_time_limit=270,
+)
+def sync_fleet_releases():
+    """
+    Syncs the fleets and their releases from balena, for the fleet API and the
+    dashboard
+    """
+    counts = fleets.refresh_catalog()
+    LOG.info(f"Synced balena releases: {counts}")
+    return counts
+
+
+@shared_task(
+    name="refresh_device_snapshot",
+    base=SingletonTask,
+    time_limit=60,
+    soft_time_limit=54,
+)
+def refresh_device_snapshot():
+    """
+    Rebuilds the device snapshot served by the device API
+    """
+    snapshot = DeviceSnapshot.refresh()
+    LOG.info(
+        f"Built device snapshot {snapshot.version} with "
+        f"{len(snapshot.balena_devices)} devices"
+    )
 
 
-@shared_task(name="rename_devices")
+@shared_task(
+    name="rename_devices",
+    base=SingletonTask,
+    time_limit=180,
+    soft_time_limit=162,
+)
 def rename_devices():
     """
     Renames devices based on UUID
@@ -108,81 +210,230 @@ def rename_devices():
                 balena.models.device.rename(device_uuid, labelname)
 
 
-@shared_task(name="bulk_device_update_csv_reader")
-def bulk_device_update_csv_reader(devices_data):
-    """Updates devices' metadata from param:devices_data
+@shared_task(
+    name="import_devices",
+    time_limit=3600,
+    soft_time_limit=3540,
+)
+def import_devices(import_id):
+    """
+    Applies an uploaded device CSV, see DeviceImport
+    """
+    DeviceImport.objects.get(pk=import_id).run(settings.DEVICE_IMPORT_CHUNK_SIZE)
+
 
-    Args:
-        devices_data (list): list of dicts with keys as device attributes
+@shared_task(name="geocode_devices")
+def geocode_devices(device_uuids):
     """
-    for row in devices_data:
-        try:
-            device = DeviceData.objects.get(device_uuid=row["device_uuid"])
-        except ObjectDoesNotExist:
-            LOG.error(
-                f"device with UUID - {row['device_uuid']} does not exist. Skipping"
-            )
-            continue
-        device.device_uuid = row["device_uuid"]
-        device.deployment_name = row["deployment_name"]
-        device.contact = row["contact"]
-        device.address_1 = row["address_1"]
-        device.address_2 = row["address_2"]
-        device.city = row["city"]
-        device.state = row["state"]
-        device.country = row["country"]
-        device.zip_code = row["zip_code"]
-        if row["latitude"] and row["longitude"]:
-            device.latitude = float(row["latitude"])
-            device.longitude = float(row["longitude"])
-        try:
-            device.save()
-        except Exception as e:
-            LOG.error(
-                f"Error while updating device with UUID - {row['device_uuid']} from CSV - {e}"
-            )
-        # sleep to honor the rate limit for geocode API
-        time.sleep(1)
+    Sets the devices' coordinates from their addresses. Addresses that have not
+    been looked up before are queued for geocode_address.
+    """
+    addresses = {}
+    for device in DeviceData.objects.filter(device_uuid__in=device_uuids):
+        if device.address_1 or device.city or device.zip_code:
+            addresses.setdefault(device.address(), []).append(device.device_uuid)
+    cached = geocoding.get_cached(addresses)
+    for address, uuids in addresses.items():
+        if address in cached:
+            geocoding.set_coordinates(uuids, address, cached[address])
+        else:
+            geocode_address.delay(address, uuids)
+
+
+@shared_task(
+    name="geocode_address",
+    rate_limit=settings.GEOCODER_RATE_LIMIT,
+    autoretry_for=(geocoding.GeocodingError,),
+    retry_backoff=True,
+    max_retries=3,
+)
+def geocode_address(address, device_uuids):
+    """
+    Looks the address up with the geocoder, unless it was looked up while this
+    task was queued, and sets the devices' coordinates from it
+    """
+    geocoding.set_coordinates(device_uuids, address, geocoding.lookup(address))
+
+
+@shared_task(
+    name="prepare_job_deployment",
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    max_retries=5,
+    time_limit=300,
+    soft_time_limit=270,
+)
+def prepare_job_deployment(job_uuid):
+    """
+    Creates the namespaces for a newly created job
+    """
+    kubernetes.prepare_deployment(Job.objects.get(pk=job_uuid))
+
 
+def schedule_events(event_times):
+    """
+    Queues a deploy_event task to run when each of the (event id, time) is due,
+    for events due within DEPLOY_LOOKAHEAD_SECONDS. deploy_jobs queues the
+    later ones as they come within that window.
+    """
+    horizon = datetime.now(timezone.utc) + timedelta(
+        seconds=settings.DEPLOY_LOOKAHEAD_SECONDS
+    )
+    for event_id, due in event_times:
+        if due <= horizon:
+            deploy_event.apply_async((event_id,), eta=due)
 
-@shared_task(name="deploy_jobs")
+
+@shared_task(
+    name="deploy_jobs",
+    base=SingletonTask,
+    time_limit=60,
+    soft_time_limit=54,
+)
 def deploy_jobs():
     """
-    Deploy all pending jobs that have reached their time
+    Safety net for deploy_event: queues pending events that are due soon, and
+    returns events whose deployment stalled, e.g. because its worker died, to
+    pending.
     """
-    for event in Event.objects.filter(
-        status="PENDING",
-        time__lt=datetime.now(),
-    ):
-        with transaction.atomic():
-            job = event.timing.job
-            device_uuids = [ts.device_uuid for ts in job.timeslots.all()]
-            LOG.info(f"Exec {job.uuid} with {len(device_uuids)} devices")
-            try:
-                if not settings.KUBE_READ_ONLY:
-                    kubernetes.create_deployment(device_uuids, job)
-                event.status = "DONE"
-                event.save()
-            except Exception as e:
-                LOG.error(f"Error deploy job {job.uuid}:")
-                LOG.error(e)
-                event.status = "ERROR"
-                event.save()
-
-
-@shared_task(name="collect_events")
+    now = datetime.now(timezone.utc)
+    stalled = Event.objects.filter(
+        status=Event.Status.DEPLOYING,
+        claimed_at__lt=now - timedelta(seconds=settings.DEPLOY_CLAIM_TIMEOUT),
+    ).update(status=Event.Status.PENDING)
+    if stalled:
+        LOG.warning(f"Returned {stalled} stalled deployments to pending")
+
+    horizon = now + timedelta(seconds=settings.DEPLOY_LOOKAHEAD_SECONDS)
+    schedule_events(
+        Event.objects.filter(status=Event.Status.PENDING, time__lt=horizon)
+        # Failed deployments are due again when their backoff ends
+        .annotate(due=Greatest("time", Coalesce("retry_at", "time")))
+        .filter(due__lt=horizon)
+        .values_list("pk", "due")
+    )
+
+
+@shared_task(
+    name="deploy_event",
+    time_limit=settings.DEPLOY_CLAIM_TIMEOUT,
+    soft_time_limit=settings.DEPLOY_CLAIM_TIMEOUT - 60,
+)
+def deploy_event(event_id):
+    """
+    Deploys a pending event's job once it is due. The event is claimed first, so
+    that when several workers get the same event only one deploys it. Devices
+    that failed are retried with a backoff, up to DEPLOY_MAX_ATTEMPTS times.
+    """
+    now = datetime.now(timezone.utc)
+    with transaction.atomic():
+        event = (
+            Event.objects.select_for_update(skip_locked=True)
+            .filter(pk=event_id, status=Event.Status.PENDING)
+            .first()
+        )
+        if event is None:
+            # Already deployed, deleted, or being deployed by another worker
+            return
+        due = max(event.time, event.retry_at or event.time)
+        if due > now:
+            # Queued early, e.g. before its time was changed
+            deploy_event.apply_async((event_id,), eta=due)
+            return
+        event.status = Event.Status.DEPLOYING
+        event.claimed_at = now
+        event.attempts += 1
+        event.save(update_fields=["status", "claimed_at", "attempts"])
+
+    job = event.timing.job
+    device_uuids = list(dict.fromkeys(ts.device_uuid for ts in job.timeslots.all()))
+    DeviceDeployment.objects.bulk_create(
+        [DeviceDeployment(event=event, device_uuid=d) for d in device_uuids],
+        ignore_conflicts=True,
+    )
+    # Devices that were already deployed to are not deployed again
+    deployments = {
+        d.device_uuid: d
+        for d in event.deployments.exclude(status=DeviceDeployment.Status.DONE)
+    }
+    LOG.info(f"Exec {job.uuid} with {len(deployments)} devices")
+    try:
+        if settings.KUBE_READ_ONLY:
+            errors = {}
+        else:
+            # In case preparing the job when it was created failed
+            kubernetes.prepare_deployment(job)
+            errors = kubernetes.create_deployment(list(deployments), job)
+    except Exception as e:
+        LOG.error(f"Error deploy job {job.uuid}:")
+        LOG.error(e)
+        errors = {device_uuid: str(e) for device_uuid in deployments}
+
+    for device_uuid, deployment in deployments.items():
+        error = errors.get(device_uuid)
+        deployment.status = (
+            DeviceDeployment.Status.ERROR if error else DeviceDeployment.Status.DONE
+        )
+        deployment.error = error or ""
+    DeviceDeployment.objects.bulk_update(deployments.values(), ["status", "error"])
+    if not any(errors.values()):
+        event.status = Event.Status.DONE
+    elif event.attempts < settings.DEPLOY_MAX_ATTEMPTS:
+        # Retry the devices that failed, backing off after each attempt
+        backoff = settings.DEPLOY_RETRY_BACKOFF_SECONDS * 2 ** (event.attempts - 1)
+        event.status = Event.Status.PENDING
+        event.retry_at = datetime.now(timezone.utc) + timedelta(seconds=backoff)
+        LOG.warning(
+            f"Deploy job {job.uuid} failed on attempt {event.attempts}, "
+            f"retrying at {event.retry_at}"
+        )
+    else:
+        event.status = Event.Status.ERROR
+    event.save(update_fields=["status", "retry_at"])
+    if event.status == Event.Status.PENDING:
+        schedule_events([(event.pk, event.retry_at)])
+
+
+@shared_task(
+    name="collect_events",
+    base=SingletonTask,
+    time_limit=180,
+    soft_time_limit=162,
+)
 def collect_events():
-    # Gets all kubernetes events, saves to DB if not there already.
-    events = kubernetes.get_kube_events(namespace=None)
-    for event in events:
-        uid = event.metadata.uid
-        if KubernetesEvent.objects.filter(uid=uid).exists():
-            # TODO update the event if needed
-            continue
+    """
+    Saves the kubernetes events that changed on each cluster since the last run,
+    by watching from the resourceVersion stored for that cluster.
+    """
+    cursors = dict(
+        KubernetesEventCursor.objects.values_list("fleet_name", "resource_version")
+    )
+
+    def collect(fleet_name):
+        events, resource_version = kubernetes.get_kube_events_since(
+            fleet_name, cursors.get(fleet_name)
+        )
+        pod_keys = {
+            (e.metadata.namespace, e.involved_object.name)
+            for e in events
+            if (e.involved_object.kind or "").lower() == "pod"
+        }
+        pod_nodes = kubernetes.get_pod_nodes(fleet_name, pod_keys) if pod_keys else {}
+        return events, resource_version, pod_nodes
+
+    timeout = settings.KUBE_EVENT_WATCH_SECONDS + settings.KUBE_CLUSTER_TIMEOUT
+    results = kubernetes.for_each_cluster(collect, timeout=timeout)
+    for fleet_name, (events, resource_version, pod_nodes) in results.items():
         try:
-            event_obj = KubernetesEvent.from_kubernetes_event(event)
-            event_obj.save()
+            created, updated = KubernetesEvent.save_kubernetes_events(
+                events, pod_nodes
+            )
         except Exception as e:
-            LOG.error(f"Error gathering event {event.metadata.uid}")
+            LOG.error(f"Error saving events for cluster {fleet_name}")
             LOG.exception(e)
             continue
+        # Only move the cursor once the events are saved, so none are lost
+        KubernetesEventCursor.objects.update_or_create(
+            fleet_name=fleet_name, defaults={"resource_version": resource_version}
+        )
+        LOG.info(f"Events for {fleet_name}: {created} created, {updated} updated")
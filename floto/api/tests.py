@@ -0,0 +1,1517 @@
+import base64
+import json
+import tempfile
+import threading
+import uuid
+from datetime import timedelta
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.db.models import Value
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from balena import exceptions as sdk_exceptions
+from kubernetes import client as kube_client
+from kubernetes.dynamic.exceptions import UnprocessibleEntityError
+from rest_framework import status
+from rest_framework.test import APIClient, APIRequestFactory
+
+from floto.api import (
+    balena,
+    fleets,
+    kubernetes,
+    models,
+    serializers,
+    tasks,
+    util,
+)
+from floto.api.access import get_access_context
+from floto.auth.models import KeycloakUser
+
+
+def create_test_user(email="test@test.com"):
+    # Bypasses KeycloakUserManager, which looks the user up in Keycloak
+    return KeycloakUser.objects.create(id=uuid.uuid4(), username=email, email=email)
+
+
+class DeviceListQueryCountTest(TestCase):
+    """
+    Tests that listing devices costs a fixed number of queries, no matter how
+    many devices, peripherals or projects there are.
+    """
+
+    def setUp(self):
+        self.user = create_test_user()
+        self.project = models.Project.objects.create(
+            created_by=self.user, name="test", description="test"
+        )
+        self.project.members.add(self.user)
+        self.other_project = models.Project.objects.create(
+            created_by=self.user, name="other", description="other"
+        )
+        self.schema = models.PeripheralSchema.objects.create(type="camera")
+        models.PeripheralSchemaResource.objects.create(
+            label="camera", count=1, schema=self.schema
+        )
+        self.config_item = models.PeripheralSchemaConfigItem.objects.create(
+            label="resolution", schema=self.schema
+        )
+        self.peripheral = models.Peripheral.objects.create(
+            schema=self.schema, name="test camera", documentation_url=""
+        )
+        self.devices = []
+
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def add_device(self, owner_project):
+        device = models.DeviceData.objects.create(
+            device_uuid=uuid.uuid4().hex,
+            owner_project=owner_project,
+            name=f"device {len(self.devices)}",
+        )
+        device.application_projects.add(self.project, self.other_project)
+        instance = models.PeripheralInstance.objects.create(
+            peripheral=self.peripheral, device=device
+        )
+        models.PeripheralConfigurationItem.objects.create(
+            label=self.config_item, peripheral=instance, value="1080p"
+        )
+        self.devices.append(device)
+
+    def list_devices(self):
+        models.DeviceSnapshot.objects.create(
+            balena_devices={
+                d.device_uuid: {"uuid": d.device_uuid, "device_name": d.name}
+                for d in self.devices
+            },
+            kubernetes_nodes={
+                d.device_uuid: {"is_ready": True, "capacity": ["camera", "cpu"]}
+                for d in self.devices
+            },
+        )
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("api:device-list"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(queries), response.json()
+
+    def test_device_list_query_count(self):
+        self.add_device(self.project)
+        n_queries, devices = self.list_devices()
+        self.assertEqual(len(devices), 1)
+
+        for _ in range(10):
+            self.add_device(self.other_project)
+        self.assertEqual(self.list_devices()[0], n_queries)
+
+    def test_device_list_before_snapshot(self):
+        cache.delete("device-snapshot-refresh-queued")
+        with (
+            mock.patch.object(models.DeviceSnapshot, "refresh") as refresh,
+            mock.patch.object(tasks.refresh_device_snapshot, "delay") as delay,
+        ):
+            for _ in range(2):
+                response = self.client.get(reverse("api:device-list"))
+                self.assertEqual(
+                    response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE
+                )
+        self.assertEqual(response["Retry-After"], "10")
+        # The snapshot is built by a worker, which is only asked once
+        refresh.assert_not_called()
+        delay.assert_called_once_with()
+
+    def test_device_list_access(self):
+        self.add_device(self.project)
+        self.add_device(self.other_project)
+        _, devices = self.list_devices()
+        by_uuid = {d["uuid"]: d for d in devices}
+
+        owned = by_uuid[self.devices[0].device_uuid]
+        self.assertTrue(owned["management_access"])
+        self.assertTrue(owned["is_ready"])
+        self.assertEqual(owned["peripheral_resources"], ["camera"])
+        self.assertEqual(len(owned["peripherals"]), 1)
+
+        shared = by_uuid[self.devices[1].device_uuid]
+        self.assertFalse(shared["management_access"])
+        self.assertTrue(shared["application_access"])
+
+
+class ClusterWatchCacheTest(TestCase):
+    """
+    Tests that watch events keep the node and pod indexes up to date.
+    """
+
+    def make_node(self, name, ready="True", labels=None):
+        return kube_client.V1Node(
+            metadata=kube_client.V1ObjectMeta(name=name, labels=labels or {}),
+            status=kube_client.V1NodeStatus(
+                conditions=[kube_client.V1NodeCondition(type="Ready", status=ready)],
+                capacity={"cpu": "4"},
+            ),
+        )
+
+    def make_pod(self, namespace, name, node_name):
+        return kube_client.V1Pod(
+            metadata=kube_client.V1ObjectMeta(name=name, namespace=namespace),
+            spec=kube_client.V1PodSpec(containers=[], node_name=node_name),
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_apply_events(self):
+        watcher = kubernetes.ClusterWatchCache("test")
+        watcher._replace("nodes", [self.make_node("a", labels={"role": "worker"})])
+        watcher._replace(
+            "pods", [self.make_pod("ns", "p1", "a"), self.make_pod("old", "p", "a")]
+        )
+
+        watcher._apply("nodes", "MODIFIED", self.make_node("a", ready="False"))
+        watcher._apply("nodes", "ADDED", self.make_node("b", labels={"role": "worker"}))
+        watcher._apply("pods", "ADDED", self.make_pod("ns", "p2", "b"))
+        watcher._apply("pods", "DELETED", self.make_pod("ns", "p1", "a"))
+        watcher._replace("pods", [self.make_pod("ns", "p2", "b")])
+
+        # Read as another process would, from the shared cache
+        reader = kubernetes.ClusterWatchCache("test")
+        nodes = {n.metadata.name: n for n in reader.list_nodes()}
+        self.assertFalse(kubernetes.summarize_node(nodes["a"])["is_ready"])
+        self.assertEqual(kubernetes.summarize_node(nodes["b"])["capacity"], ["cpu"])
+        self.assertEqual(
+            [n.metadata.name for n in reader.list_nodes("role=worker")], ["b"]
+        )
+        self.assertEqual(len(reader.list_nodes("!role")), 1)
+        self.assertIsNone(reader.get_pod("ns", "p1"))
+        self.assertEqual(reader.get_pod("ns", "p2").spec.node_name, "b")
+        self.assertEqual(len(reader.list_pods("ns")), 1)
+        # Namespaces that are gone when relisting are dropped
+        self.assertEqual(reader.list_pods("old"), [])
+
+    @override_settings(KUBE_CLUSTERS={"test": "/tmp/kubeconfig"})
+    def test_read_while_synced(self):
+        watcher = kubernetes.ClusterWatchCache("test")
+        watcher._replace("nodes", [])
+        watcher._replace("pods", [self.make_pod("ns", "p", "a")])
+        with mock.patch.object(kubernetes.ClusterWatchCache, "start") as start:
+            # Until the watcher reports being in sync, reads go to the API
+            self.assertIsNone(kubernetes.get_synced_watch_cache("test"))
+            for synced in watcher._synced.values():
+                synced.set()
+            watcher.heartbeat()
+            pod = kubernetes.get_synced_watch_cache("test").get_pod("ns", "p")
+            self.assertEqual(pod.spec.node_name, "a")
+        # Readers never watch the cluster themselves
+        start.assert_not_called()
+
+        with mock.patch.object(kubernetes.time, "sleep"):
+            watcher._on_error("pods", Exception("watch failed"))
+        self.assertIsNone(kubernetes.get_synced_watch_cache("test"))
+
+
+class SaveKubernetesEventsTest(TestCase):
+    """
+    Tests that collected events are created or updated in bulk.
+    """
+
+    def make_event(self, uid, kind, name, namespace, count=1):
+        return kube_client.CoreV1Event(
+            metadata=kube_client.V1ObjectMeta(
+                uid=uid, name=f"{name}.{uid}", namespace=namespace
+            ),
+            involved_object=kube_client.V1ObjectReference(
+                kind=kind, name=name, namespace=namespace
+            ),
+            type="Normal",
+            reason="Started",
+            count=count,
+        )
+
+    def test_save_events(self):
+        user = create_test_user()
+        project = models.Project.objects.create(
+            created_by=user, name="test", description="test"
+        )
+        application = models.Application.objects.create(
+            created_by=user, created_by_project=project, name="app", description="",
+            environment={},
+        )
+        job = models.Job.objects.create(
+            created_by=user,
+            created_by_project=project,
+            application=application,
+            environment={},
+        )
+        device = models.DeviceData.objects.create(
+            device_uuid=uuid.uuid4().hex, owner_project=project
+        )
+        namespace = kubernetes.get_namespace_name(job.pk)
+        events = [
+            self.make_event("1", "Pod", "pod-1", namespace),
+            self.make_event("2", "Node", device.device_uuid, "default"),
+        ]
+        pod_nodes = {(namespace, "pod-1"): device.device_uuid}
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(
+                models.KubernetesEvent.save_kubernetes_events(events, pod_nodes),
+                (2, 0),
+            )
+        n_queries = len(queries)
+        pod_event = models.KubernetesEvent.objects.get(uid="1")
+        self.assertEqual(pod_event.job, job)
+        self.assertEqual(pod_event.device, device)
+        self.assertEqual(models.KubernetesEvent.objects.get(uid="2").device, device)
+
+        events.append(self.make_event("1", "Pod", "pod-1", namespace, count=3))
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(
+                models.KubernetesEvent.save_kubernetes_events(events, pod_nodes),
+                (0, 2),
+            )
+        self.assertLessEqual(len(queries), n_queries + 1)
+        self.assertEqual(models.KubernetesEvent.objects.get(uid="1").count, 3)
+
+
+class JobLogsTest(TestCase):
+    """
+    Tests that the logs read in time are returned, even if some reads hang.
+    """
+
+    def make_pod(self, name, containers):
+        return kube_client.V1Pod(
+            metadata=kube_client.V1ObjectMeta(name=name),
+            spec=kube_client.V1PodSpec(
+                node_name=name,
+                containers=[
+                    kube_client.V1Container(name=c, image=f"{c}-image")
+                    for c in containers
+                ],
+            ),
+        )
+
+    @override_settings(
+        KUBE_CLUSTERS={"test": "/tmp/kubeconfig"},
+        KUBE_LOG_REQUEST_TIMEOUT=5,
+        KUBE_LOGS_TIMEOUT=0.5,
+    )
+    def test_slow_container(self):
+        released = threading.Event()
+        self.addCleanup(released.set)
+
+        def read_log(pod_name, namespace, container, **kwargs):
+            self.assertEqual(kwargs["_request_timeout"], 5)
+            if container == "slow":
+                released.wait()
+            return f"{container} logs"
+
+        core_api = mock.Mock()
+        core_api.list_namespaced_pod.return_value = kube_client.V1PodList(
+            items=[self.make_pod("a", ["app", "slow"]), self.make_pod("b", ["app"])]
+        )
+        core_api.read_namespaced_pod_log.side_effect = read_log
+        with mock.patch.object(kubernetes, "get_core_api", return_value=core_api):
+            logs = kubernetes.get_job_logs(uuid.uuid4())
+
+        self.assertEqual(logs["a"]["app-image"], {"logs": "app logs"})
+        self.assertIn("error", logs["a"]["slow-image"])
+        self.assertEqual(logs["b"]["app-image"], {"logs": "app logs"})
+
+
+class ParseTimingsTest(TestCase):
+    """
+    Tests that conflicts are found in a fixed number of queries.
+    """
+
+    def setUp(self):
+        self.user = create_test_user()
+        self.project = models.Project.objects.create(
+            created_by=self.user, name="test", description="test"
+        )
+        self.app = self.create_application(port=30000)
+
+    def create_application(self, port, is_single_tenant=False):
+        app = models.Application.objects.create(
+            created_by=self.user,
+            created_by_project=self.project,
+            name="app",
+            description="",
+            environment={},
+            is_single_tenant=is_single_tenant,
+        )
+        service = models.Service.objects.create(
+            created_by=self.user, container_ref="test"
+        )
+        models.ApplicationService.objects.create(application=app, service=service)
+        models.ServicePort.objects.create(
+            service=service, protocol="TCP", node_port=port, target_port=80
+        )
+        return app
+
+    def schedule(self, app, device_uuid, start, stop):
+        job = models.Job.objects.create(
+            created_by=self.user, application=app, environment={}
+        )
+        models.DeviceTimeslot.objects.create(
+            job=job,
+            device_uuid=device_uuid,
+            start=start,
+            stop=stop,
+            note="",
+            category="JOB",
+        )
+
+    def check(self, devices, start, stop):
+        timing = f"type=advanced,start={start.isoformat()},end={stop.isoformat()}"
+        with CaptureQueriesContext(connection) as queries:
+            res = util.parse_timings(
+                [{"timing": timing}],
+                [{"device_uuid": d} for d in devices],
+                self.app.pk,
+            )
+        return len(queries), res["conflicts"]
+
+    def test_conflicts(self):
+        now = timezone.now()
+        hour = timedelta(hours=1)
+        shared_port = self.create_application(port=30000)
+        other_port = self.create_application(port=30001)
+        single_tenant = self.create_application(port=30002, is_single_tenant=True)
+        self.schedule(shared_port, "a", now, now + 10 * hour)
+        self.schedule(other_port, "a", now + hour, now + 2 * hour)
+        self.schedule(single_tenant, "b", now + 3 * hour, now + 4 * hour)
+        self.schedule(single_tenant, "c", now + 6 * hour, now + 7 * hour)
+
+        n_queries, conflicts = self.check(["a", "b", "c"], now + hour, now + 5 * hour)
+        self.assertEqual(set(conflicts), {"a", "b"})
+        self.assertEqual(
+            [c["reason"] for c in conflicts["a"]],
+            ["Node port '30000' is already in use on device"],
+        )
+        self.assertEqual(
+            [c["reason"] for c in conflicts["b"]],
+            ["Single-tenant already scheduled on device"],
+        )
+
+        for i in range(10):
+            device = f"d{i}"
+            self.schedule(self.create_application(port=i), device, now, now + hour)
+            self.schedule(shared_port, device, now + 2 * hour, now + 3 * hour)
+        devices = ["a", "b", "c"] + [f"d{i}" for i in range(10)]
+        self.assertEqual(self.check(devices, now + hour, now + 5 * hour)[0], n_queries)
+
+    def test_claims_are_cached(self):
+        now = timezone.now()
+        other = self.create_application(port=30001)
+        self.schedule(other, "a", now, now + timedelta(hours=1))
+        self.check(["a"], now, now + timedelta(hours=1))
+        n_queries, conflicts = self.check(["a"], now, now + timedelta(hours=1))
+        self.assertFalse(conflicts)
+
+        # Adding a claim to the other application clears its stored claims
+        service = other.services.get().service
+        models.ServicePort.objects.create(
+            service=service, protocol="TCP", node_port=30000, target_port=80
+        )
+        self.assertIsNone(models.Application.objects.get(pk=other.pk).claims)
+        self.assertEqual(len(self.check(["a"], now, now + timedelta(hours=1))[1]), 1)
+        self.assertEqual(self.check(["a"], now, now + timedelta(hours=1))[0], n_queries)
+
+    def test_stale_claims_are_not_saved(self):
+        other = self.create_application(port=30001)
+        apps = list(models.Application.objects.filter(pk__in=[self.app.pk, other.pk]))
+        # The claims change after they were loaded, but before they are saved
+        models.ServicePort.objects.create(
+            service=other.services.get().service,
+            protocol="TCP",
+            node_port=30002,
+            target_port=80,
+        )
+        models.Application.load_claims(apps)
+        self.assertIsNone(models.Application.objects.get(pk=other.pk).claims)
+        self.assertEqual(
+            models.Application.objects.get(pk=self.app.pk).claims["ports"], [30000]
+        )
+
+        # Read-only checks compute claims without saving them
+        models.Application.load_claims(
+            [models.Application.objects.get(pk=other.pk)], save=False
+        )
+        self.assertIsNone(models.Application.objects.get(pk=other.pk).claims)
+
+
+class QueryPlanTest(TestCase):
+    """
+    Tests that the hot queries use their indexes once tables hold realistic
+    numbers of rows. The plans are SQLite's, those of MariaDB in production
+    are not checked.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        user = create_test_user()
+        project = models.Project.objects.create(
+            created_by=user, name="test", description="test"
+        )
+        app = models.Application.objects.create(
+            created_by=user, name="app", description="", environment={}
+        )
+        cls.device = models.DeviceData.objects.create(
+            device_uuid=uuid.uuid4().hex, owner_project=project
+        )
+        now = timezone.now()
+        jobs = models.Job.objects.bulk_create(
+            models.Job(
+                created_by=user, application=app, environment={}, cleaned_up=i > 10
+            )
+            for i in range(200)
+        )
+        cls.job = jobs[0]
+        timings = models.JobTiming.objects.bulk_create(
+            models.JobTiming(job=job, timing="") for job in jobs
+        )
+        models.JobDevice.objects.bulk_create(
+            models.JobDevice(job=job, device_uuid=f"device-{i}")
+            for job in jobs
+            for i in range(10)
+        )
+        models.DeviceTimeslot.objects.bulk_create(
+            models.DeviceTimeslot(
+                job=job,
+                device_uuid=f"device-{i}",
+                start=now + timedelta(hours=j),
+                stop=now + timedelta(hours=j + 1),
+                note="",
+                category="JOB",
+            )
+            for j, job in enumerate(jobs)
+            for i in range(10)
+        )
+        models.Event.objects.bulk_create(
+            models.Event(
+                timing=timing,
+                time=now + timedelta(hours=j),
+                status="DONE" if j < 150 else "PENDING",
+            )
+            for j, timing in enumerate(timings)
+        )
+        models.KubernetesEvent.objects.bulk_create(
+            models.KubernetesEvent(
+                uid=str(i),
+                job=jobs[i % len(jobs)],
+                device=cls.device if i % 2 else None,
+                event_time=now + timedelta(seconds=i),
+            )
+            for i in range(2000)
+        )
+
+    def assertUsesIndex(self, queryset, index_name):
+        self.assertIn(index_name, queryset.explain())
+
+    def test_query_plans(self):
+        now = timezone.now()
+        self.assertUsesIndex(
+            models.DeviceTimeslot.objects.filter(
+                device_uuid__in=["device-1", "device-2"],
+                start__lte=now + timedelta(hours=5),
+                stop__gte=now,
+            ),
+            "devicetimeslot_device_time_idx",
+        )
+        self.assertUsesIndex(
+            models.Event.objects.filter(status="PENDING", time__lt=now),
+            "event_status_time_idx",
+        )
+        self.assertUsesIndex(
+            models.Job.objects_all.filter(cleaned_up=Value(False)),
+            "job_cleaned_up_idx",
+        )
+        self.assertUsesIndex(
+            models.Job.objects.filter(devices__device_uuid="device-1"),
+            "jobdevice_device_idx",
+        )
+        self.assertUsesIndex(
+            self.job.kubernetes_events.all(), "kubeevent_job_time_idx"
+        )
+        self.assertUsesIndex(
+            self.device.kubernetes_events.all(), "kubeevent_device_time_idx"
+        )
+
+
+class JobCreateQueryCountTest(TestCase):
+    """
+    Tests that saving a job costs a fixed number of queries, no matter how many
+    devices it runs on.
+    """
+
+    def setUp(self):
+        self.user = create_test_user()
+        self.project = models.Project.objects.create(
+            created_by=self.user, name="test", description="test"
+        )
+        self.project.members.add(self.user)
+        self.app = models.Application.objects.create(
+            created_by=self.user, name="app", description="", environment={}
+        )
+
+    def create_job(self, n_devices):
+        request = APIRequestFactory().post("/")
+        request.user = self.user
+        devices = []
+        for _ in range(n_devices):
+            device = models.DeviceData.objects.create(
+                device_uuid=uuid.uuid4().hex, owner_project=self.project
+            )
+            device.application_projects.add(self.project)
+            devices.append({"device_uuid": device.device_uuid})
+        start = timezone.now() + timedelta(days=1)
+        timing = (
+            f"type=advanced,start={start.isoformat()},"
+            f"end={(start + timedelta(hours=1)).isoformat()}"
+        )
+        serializer = serializers.JobSerializer(
+            data={
+                "created_by_project": self.project.pk,
+                "application": self.app.pk,
+                "environment": {},
+                "devices": devices,
+                "timings": [{"timing": timing}],
+            },
+            context={"request": request},
+        )
+        with CaptureQueriesContext(connection) as validate_queries:
+            serializer.is_valid(raise_exception=True)
+        with self.captureOnCommitCallbacks() as callbacks:
+            with CaptureQueriesContext(connection) as queries:
+                job = serializer.save()
+        # Preparing namespaces, and scheduling the job's events
+        self.assertEqual(len(callbacks), 2)
+        self.assertEqual(job.timeslots.count(), n_devices)
+        self.assertEqual(models.Event.objects.filter(timing__job=job).count(), 1)
+        return len(validate_queries), len(queries)
+
+    def test_job_create_query_count(self):
+        with self.settings(KUBE_READ_ONLY=False):
+            self.assertEqual(self.create_job(1), self.create_job(20))
+
+    def test_device_errors(self):
+        owned = models.DeviceData.objects.create(
+            device_uuid="owned", owner_project=self.project
+        )
+        other_project = models.Project.objects.create(
+            created_by=self.user, name="other", description="other"
+        )
+        models.DeviceData.objects.create(
+            device_uuid="private", owner_project=other_project
+        )
+        request = APIRequestFactory().post("/")
+        request.user = self.user
+        serializer = serializers.JobSerializer(
+            data={
+                "created_by_project": self.project.pk,
+                "application": self.app.pk,
+                "environment": {},
+                "devices": [
+                    {"device_uuid": owned.device_uuid},
+                    {"device_uuid": "private"},
+                    {"device_uuid": "unknown"},
+                ],
+                "timings": [],
+            },
+            context={"request": request},
+        )
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(
+            serializer.errors["devices"],
+            [
+                {},
+                {"device_uuid": ["No application access to device private"]},
+                {"device_uuid": ["Invalid device UUID unknown"]},
+            ],
+        )
+
+
+class CreateDeploymentTest(TestCase):
+    """
+    Tests that deployment results are tracked per device, and that objects which
+    already exist count as deployed.
+    """
+
+    @override_settings(KUBE_SERVER_SIDE_APPLY=False)
+    def test_create_deployment(self):
+        user = create_test_user()
+        project = models.Project.objects.create(
+            created_by=user, name="test", description="test"
+        )
+        fleet = models.Fleet.objects.create(id=1, app_name="fleet")
+        app = models.Application.objects.create(
+            created_by=user, name="app", description="", environment={}
+        )
+        job = models.Job.objects.create(
+            created_by=user, application=app, environment={"A": "1"}
+        )
+        devices = [uuid.uuid4().hex for _ in range(3)]
+        for device_uuid in devices[:2]:
+            models.DeviceData.objects.create(
+                device_uuid=device_uuid, owner_project=project, fleet=fleet
+            )
+
+        def create_job(namespace, v1_job, **kwargs):
+            if v1_job.metadata.name == kubernetes.get_job_name(job.uuid, devices[1]):
+                raise kube_client.exceptions.ApiException(status=409)
+
+        batch_api = mock.Mock()
+        batch_api.create_namespaced_job.side_effect = create_job
+        env_vars = {d: [] for d in devices}
+        with (
+            mock.patch.object(kubernetes, "get_core_api"),
+            mock.patch.object(kubernetes, "get_batch_api", return_value=batch_api),
+            mock.patch.object(kubernetes, "get_device_env_vars", return_value=env_vars),
+        ):
+            results = kubernetes.create_deployment(devices, job)
+
+        self.assertEqual(
+            results,
+            {
+                devices[0]: None,
+                devices[1]: None,
+                devices[2]: "Device is not in a known fleet",
+            },
+        )
+        self.assertEqual(batch_api.create_namespaced_job.call_count, 2)
+
+
+class DeviceEnvVarsTest(TestCase):
+    """
+    Tests that environment variables are fetched for many devices at once, and
+    reused while cached.
+    """
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_get_device_env_vars(self):
+        def pine_get(params):
+            if params["resource"] == "device":
+                return [{"id": 1, "uuid": "a"}, {"id": 2, "uuid": "b"}]
+            return [
+                {"name": "FLOTO_A", "value": "1", "device": {"__id": 1}},
+                {"name": "FLOTO_B", "value": "2", "device": {"__id": 1}},
+            ]
+
+        balena_client = mock.Mock()
+        balena_client.pine.get.side_effect = pine_get
+        with mock.patch.object(
+            balena, "get_balena_client", return_value=balena_client
+        ):
+            env_vars = balena.get_device_env_vars(["a", "b", "c"])
+            self.assertEqual(balena_client.pine.get.call_count, 2)
+            self.assertEqual(
+                [e["name"] for e in env_vars["a"]], ["FLOTO_A", "FLOTO_B"]
+            )
+            self.assertEqual(env_vars["b"], [])
+            self.assertNotIn("c", env_vars)
+
+            self.assertEqual(balena.get_device_env_vars(["a", "b"]), env_vars)
+            self.assertEqual(balena_client.pine.get.call_count, 2)
+
+
+class JobTemplateTest(TestCase):
+    """
+    Tests that a job's template is built once and rendered per device without
+    further queries.
+    """
+
+    def test_render(self):
+        user = create_test_user()
+        app = models.Application.objects.create(
+            created_by=user, name="app", description="", environment={}
+        )
+        service = models.Service.objects.create(created_by=user, container_ref="img")
+        models.ApplicationService.objects.create(application=app, service=service)
+        models.ServicePort.objects.create(
+            service=service, protocol="TCP", node_port=30000, target_port=80
+        )
+        job = models.Job.objects.create(
+            created_by=user, application=app, environment={"FLOTO_A": "job"}
+        )
+        template = kubernetes.JobTemplate(job)
+
+        with self.assertNumQueries(0):
+            config_map, v1_job, *k8s_services = template.render(
+                "device-1", [{"name": "FLOTO_A", "value": "device"}], {"k": "v"}
+            )
+        pod_spec = v1_job.spec.template.spec
+        self.assertEqual(pod_spec.node_name, "device1")
+        self.assertEqual(pod_spec.containers[0].image, "img")
+        self.assertIn(
+            kube_client.V1EnvVar(name="FLOTO_A", value="job"),
+            pod_spec.containers[0].env,
+        )
+        self.assertEqual(config_map.data, {"k": "v"})
+        self.assertEqual(
+            k8s_services[0].spec.selector["pod_name"],
+            v1_job.spec.template.metadata.name,
+        )
+        self.assertEqual(k8s_services[0].spec.ports[0].node_port, 30000)
+
+
+class ServerSideApplyTest(TestCase):
+    """
+    Tests that deployments apply manifests, keeping a Job whose spec changed.
+    """
+
+    def test_apply(self):
+        user = create_test_user()
+        project = models.Project.objects.create(
+            created_by=user, name="test", description="test"
+        )
+        fleet = models.Fleet.objects.create(id=1, app_name="fleet")
+        app = models.Application.objects.create(
+            created_by=user, name="app", description="", environment={}
+        )
+        service = models.Service.objects.create(created_by=user, container_ref="img")
+        models.ApplicationService.objects.create(application=app, service=service)
+        job = models.Job.objects.create(
+            created_by=user, application=app, environment={"A": "1"}
+        )
+        device = models.DeviceData.objects.create(
+            device_uuid=uuid.uuid4().hex, owner_project=project, fleet=fleet
+        )
+        devices = [device.device_uuid]
+
+        dynamic_client = mock.Mock()
+        with (
+            mock.patch.object(
+                kubernetes.cluster_registry,
+                "get_resource",
+                return_value=(dynamic_client, mock.Mock()),
+            ),
+            mock.patch.object(
+                kubernetes, "get_device_env_vars", return_value={devices[0]: []}
+            ),
+        ):
+            self.assertEqual(
+                kubernetes.create_deployment(devices, job), {devices[0]: None}
+            )
+            applied = [
+                c.kwargs["body"]["kind"]
+                for c in dynamic_client.server_side_apply.call_args_list
+            ]
+            self.assertEqual(applied, ["ConfigMap", "Job"])
+
+            def apply(resource, body, **kwargs):
+                if body["kind"] == "Job":
+                    raise UnprocessibleEntityError(
+                        kube_client.ApiException(status=422, reason="immutable")
+                    )
+
+            # A Job that was deployed before is kept, as it cannot be changed
+            dynamic_client.server_side_apply.side_effect = apply
+            job.environment = {"A": "2"}
+            job.save()
+            self.assertEqual(
+                kubernetes.create_deployment(devices, job), {devices[0]: None}
+            )
+
+
+@override_settings(KUBE_READ_ONLY=False)
+class DeployEventTest(TestCase):
+    """
+    Tests that an event is deployed once, with results recorded per device.
+    """
+
+    def setUp(self):
+        user = create_test_user()
+        app = models.Application.objects.create(
+            created_by=user, name="app", description="", environment={}
+        )
+        self.job = models.Job.objects.create(
+            created_by=user, application=app, environment={}
+        )
+        timing = models.JobTiming.objects.create(job=self.job, timing="")
+        now = timezone.now()
+        for device_uuid in ["a", "b"]:
+            models.DeviceTimeslot.objects.create(
+                job=self.job,
+                timing=timing,
+                device_uuid=device_uuid,
+                start=now,
+                stop=now + timedelta(hours=1),
+                note="",
+                category="JOB",
+            )
+        self.event = models.Event.objects.create(
+            timing=timing, time=now, status=models.Event.Status.PENDING
+        )
+
+    def deploy(self, results):
+        with (
+            mock.patch.object(kubernetes, "prepare_deployment"),
+            mock.patch.object(
+                kubernetes, "create_deployment", return_value=results
+            ) as create_deployment,
+            mock.patch.object(tasks.deploy_event, "apply_async") as apply_async,
+        ):
+            tasks.deploy_event(self.event.pk)
+        self.event.refresh_from_db()
+        return create_deployment, apply_async
+
+    @override_settings(DEPLOY_MAX_ATTEMPTS=2, DEPLOY_RETRY_BACKOFF_SECONDS=600)
+    def test_deploy_event(self):
+        create_deployment, apply_async = self.deploy({"a": None, "b": "failed"})
+        self.assertEqual(
+            dict(self.event.deployments.values_list("device_uuid", "status")),
+            {"a": "DONE", "b": "ERROR"},
+        )
+        create_deployment.assert_called_once_with(["a", "b"], self.job)
+
+        # A failed deployment goes back to pending, and is retried after a backoff
+        self.assertEqual(self.event.status, models.Event.Status.PENDING)
+        self.assertEqual(self.event.attempts, 1)
+        self.assertGreater(
+            self.event.retry_at, timezone.now() + timedelta(seconds=500)
+        )
+        # It is queued by deploy_jobs once its retry is within the lookahead
+        self.assertFalse(apply_async.called)
+
+        # Until then it is not deployed
+        with mock.patch.object(tasks, "schedule_events") as schedule_events:
+            tasks.deploy_jobs.run()
+        self.assertEqual(list(schedule_events.call_args.args[0]), [])
+        create_deployment, apply_async = self.deploy({})
+        self.assertFalse(create_deployment.called)
+        apply_async.assert_called_once_with(
+            (self.event.pk,), eta=self.event.retry_at
+        )
+
+        # Retrying only deploys to the devices that failed, and once it has
+        # used up its attempts the event is left in error
+        self.event.retry_at = timezone.now()
+        self.event.save()
+        with mock.patch.object(tasks, "schedule_events") as schedule_events:
+            tasks.deploy_jobs.run()
+        self.assertEqual(
+            list(schedule_events.call_args.args[0]),
+            [(self.event.pk, self.event.retry_at)],
+        )
+        create_deployment, apply_async = self.deploy({"b": "failed again"})
+        create_deployment.assert_called_once_with(["b"], self.job)
+        self.assertEqual(self.event.status, models.Event.Status.ERROR)
+        self.assertEqual(self.event.attempts, 2)
+        self.assertFalse(apply_async.called)
+
+        # The event is no longer pending, so it is not deployed again
+        self.assertFalse(self.deploy({})[0].called)
+
+    def test_retry_succeeds(self):
+        self.deploy({"a": "failed", "b": None})
+        self.event.retry_at = timezone.now()
+        self.event.save()
+        create_deployment, _ = self.deploy({"a": None})
+        create_deployment.assert_called_once_with(["a"], self.job)
+        self.assertEqual(self.event.status, models.Event.Status.DONE)
+
+
+class SingletonTaskTest(TestCase):
+    """
+    Tests that a beat task is skipped while a previous run holds its lock.
+    """
+
+    def run_deploy_jobs(self, acquired):
+        redis_client = mock.Mock()
+        redis_client.lock.return_value.acquire.return_value = acquired
+        with mock.patch("floto.celery.get_redis", return_value=redis_client):
+            with mock.patch.object(tasks, "schedule_events") as schedule_events:
+                tasks.deploy_jobs()
+        redis_client.lock.assert_called_once_with(
+            "floto-task-lock:deploy_jobs", timeout=60, blocking=False
+        )
+        return redis_client, schedule_events
+
+    def test_runs_when_lock_is_free(self):
+        redis_client, schedule_events = self.run_deploy_jobs(acquired=True)
+        schedule_events.assert_called_once()
+        redis_client.lock.return_value.release.assert_called_once()
+
+    def test_skips_when_lock_is_held(self):
+        redis_client, schedule_events = self.run_deploy_jobs(acquired=False)
+        schedule_events.assert_not_called()
+        redis_client.lock.return_value.release.assert_not_called()
+
+
+class TaskMetricsTest(TestCase):
+    """
+    Tests that task runtime metrics are served to admins
+    """
+
+    def setUp(self):
+        self.user = create_test_user()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.redis_client = mock.Mock()
+        self.redis_client.scan_iter.return_value = [b"floto-task-metrics:deploy_jobs"]
+        self.redis_client.hgetall.return_value = {
+            b"runs": b"3",
+            b"total_seconds": b"1.5",
+            b"last_state": b"SUCCESS",
+        }
+        patcher = mock.patch("floto.celery.get_redis", return_value=self.redis_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_metrics(self):
+        response = self.client.get(reverse("api:metrics-list"))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(reverse("api:metrics-list"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json()["tasks"],
+            {
+                "deploy_jobs": {
+                    "runs": 3.0,
+                    "total_seconds": 1.5,
+                    "last_state": "SUCCESS",
+                }
+            },
+        )
+        self.assertEqual(
+            response.json()["balena"].keys(),
+            {"login_count", "login_seconds", "client_requests", "token_expires_at"},
+        )
+
+
+class SyncBalenaDevicesTest(TestCase):
+    """
+    Tests that syncing balena devices only writes the rows that changed.
+    """
+
+    def setUp(self):
+        user = create_test_user()
+        self.project = models.Project.objects.create(
+            created_by=user, name="admin", description="admin"
+        )
+        self.fleet = models.Fleet.objects.create(id=1, app_name="fleet")
+        self.moved = models.DeviceData.objects.create(
+            device_uuid="moved", owner_project=self.project, name="moved"
+        )
+        self.unchanged = models.DeviceData.objects.create(
+            device_uuid="unchanged",
+            owner_project=self.project,
+            name="unchanged",
+            fleet=self.fleet,
+        )
+        self.balena = mock.Mock()
+        self.balena.models.application.get_all.return_value = [
+            {"id": 1, "app_name": "fleet"},
+            {"id": 2, "app_name": "other fleet"},
+        ]
+        self.balena.models.device.get_all.return_value = [
+            {
+                "uuid": uuid,
+                "device_name": uuid,
+                "belongs_to__application": {"__id": fleet_id},
+            }
+            for uuid, fleet_id in [("moved", 2), ("unchanged", 1), ("new", 1)]
+        ]
+
+    def sync(self):
+        with override_settings(FLOTO_ADMIN_PROJECT=str(self.project.pk)):
+            with mock.patch.object(
+                tasks, "get_balena_client", return_value=self.balena
+            ):
+                # run() skips the singleton lock
+                return tasks.sync_balena_device_to_db.run()
+
+    def test_sync(self):
+        with mock.patch.object(models.DeviceData, "save") as save:
+            counts = self.sync()
+        save.assert_not_called()
+        self.assertEqual(
+            counts,
+            {
+                "fleets_created": 1,
+                "fleets_updated": 0,
+                "devices_created": 1,
+                "devices_updated": 1,
+            },
+        )
+        self.assertEqual(
+            dict(models.DeviceData.objects.values_list("device_uuid", "fleet_id")),
+            {"moved": 2, "unchanged": 1, "new": 1},
+        )
+
+    def test_unchanged_sync_writes_nothing(self):
+        self.sync()
+        with CaptureQueriesContext(connection) as queries:
+            counts = self.sync()
+        self.assertFalse(any(counts.values()))
+        self.assertEqual(len(queries), 2)
+
+
+class FakeGeocoder:
+    """
+    Geocoder backend for tests, which knows one address
+    """
+
+    lookups = []
+
+    def geocode(self, address):
+        self.lookups.append(address)
+        if address.startswith("1 Main St"):
+            return 41.0, -87.0
+        return None
+
+
+@override_settings(GEOCODER_BACKEND="floto.api.tests.FakeGeocoder")
+class GeocodingTest(TestCase):
+    """
+    Tests that devices are geocoded in the background, and that each address is
+    looked up only once.
+    """
+
+    def setUp(self):
+        FakeGeocoder.lookups = []
+        user = create_test_user()
+        self.project = models.Project.objects.create(
+            created_by=user, name="test", description="test"
+        )
+        self.devices = [
+            models.DeviceData.objects.create(
+                device_uuid=f"device-{i}", owner_project=self.project, name=str(i)
+            )
+            for i in range(3)
+        ]
+
+    def move(self, device, address_1):
+        device.address_1 = address_1
+        device.city = "Chicago"
+        with self.captureOnCommitCallbacks(execute=True):
+            device.save()
+
+    def test_geocoding(self):
+        with mock.patch.object(tasks.geocode_devices, "delay") as geocode_devices:
+            with mock.patch.object(
+                tasks.geocode_address, "delay", side_effect=tasks.geocode_address
+            ):
+                geocode_devices.side_effect = tasks.geocode_devices
+                for device in self.devices[:2]:
+                    self.move(device, "1 Main St")
+                self.move(self.devices[2], "nowhere")
+                self.assertIsNone(self.devices[2].latitude)
+                self.move(self.devices[2], "1 Main St")
+                # Saves that do not change the address do not geocode
+                models.DeviceData.objects.get(pk="device-0").save()
+
+        self.assertEqual(geocode_devices.call_count, 4)
+        self.assertEqual(
+            FakeGeocoder.lookups,
+            ["1 Main St, Chicago, , ", "nowhere, Chicago, , "],
+        )
+        for device in self.devices:
+            device.refresh_from_db()
+            self.assertAlmostEqual(float(device.latitude), 41.0, delta=0.01)
+            self.assertAlmostEqual(float(device.longitude), -87.0, delta=0.01)
+        self.assertEqual(models.GeocodeCache.objects.count(), 2)
+
+
+class DeviceImportTest(TestCase):
+    """
+    Tests that a device CSV import updates the devices that changed in bulk, and
+    records the rows that could not be imported.
+    """
+
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_root.cleanup)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        user = create_test_user()
+        project = models.Project.objects.create(
+            created_by=user, name="test", description="test"
+        )
+        for name in ["moved", "located", "unchanged", "invalid"]:
+            models.DeviceData.objects.create(
+                device_uuid=name, owner_project=project, name=name
+            )
+
+    def test_import(self):
+        columns = models.DeviceData.device_update_columns
+        rows = [
+            {"device_uuid": "moved", "address_1": "1 Main St", "city": "Chicago"},
+            {
+                "device_uuid": "located",
+                "latitude": "41.878113",
+                "longitude": "-87.629799",
+            },
+            {"device_uuid": "unchanged"},
+            {"device_uuid": "invalid", "zip_code": "1234567"},
+            {"device_uuid": "unknown"},
+        ]
+        lines = [",".join(columns)] + [
+            ",".join(row.get(col, "") for col in columns) for row in rows
+        ]
+        device_import = models.DeviceImport.objects.create(
+            csv_file=ContentFile("\n".join(lines).encode(), name="devices.csv")
+        )
+
+        with mock.patch.object(tasks.geocode_devices, "delay") as geocode_devices:
+            with self.captureOnCommitCallbacks(execute=True):
+                with CaptureQueriesContext(connection) as queries:
+                    device_import.run(chunk_size=10)
+
+        device_import.refresh_from_db()
+        self.assertEqual(device_import.status, models.DeviceImport.Status.DONE)
+        self.assertEqual(device_import.total_rows, 5)
+        self.assertEqual(device_import.processed_rows, 5)
+        self.assertEqual(device_import.updated_rows, 2)
+        self.assertEqual(
+            [(e["row"], e["device_uuid"]) for e in device_import.errors],
+            [(5, "invalid"), (6, "unknown")],
+        )
+        # Only the device whose address changed is geocoded
+        geocode_devices.assert_called_once_with(["moved"])
+        located = models.DeviceData.objects.get(pk="located")
+        self.assertEqual(float(located.latitude), 41.878)
+        self.assertEqual(float(located.longitude), -87.630)
+        self.assertEqual(
+            models.DeviceData.objects.get(pk="moved").address_1, "1 Main St"
+        )
+        # The status, one lookup and update per chunk, and the result
+        self.assertLessEqual(len(queries), 9)
+
+    @override_settings(DEVICE_IMPORT_MAX_ERRORS=2)
+    def test_errors_are_capped(self):
+        lines = ["device_uuid"] + [f"unknown{i}" for i in range(5)]
+        device_import = models.DeviceImport.objects.create(
+            csv_file=ContentFile("\n".join(lines).encode(), name="devices.csv")
+        )
+        device_import.run(chunk_size=2)
+        device_import.refresh_from_db()
+        self.assertEqual(device_import.status, models.DeviceImport.Status.DONE)
+        self.assertEqual(device_import.processed_rows, 5)
+        self.assertEqual(
+            [e["device_uuid"] for e in device_import.errors], ["unknown0", "unknown1"]
+        )
+
+    def test_unreadable_file(self):
+        device_import = models.DeviceImport.objects.create(
+            csv_file=ContentFile(b"device_uuid\nmoved\n\xff\n", name="devices.csv")
+        )
+        device_import.run(chunk_size=10)
+        device_import.refresh_from_db()
+        # The import ends in error rather than staying running
+        self.assertEqual(device_import.status, models.DeviceImport.Status.ERROR)
+        self.assertIn("utf-8", device_import.errors[-1]["error"])
+        self.assertIsNotNone(device_import.finished_at)
+
+
+class AccessContextQueryCountTest(TestCase):
+    """
+    Tests that the user's projects are looked up once per request, by however
+    many permissions, filters and serializers check them.
+    """
+
+    def setUp(self):
+        self.user = create_test_user()
+        self.project = models.Project.objects.create(
+            created_by=self.user, name="test", description="test"
+        )
+        self.project.members.add(self.user)
+        models.Collection.objects.create(
+            created_by=self.user,
+            created_by_project=self.project,
+            name="collection",
+            description="collection",
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def assert_project_queries(self, n_queries, method, url, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url, **kwargs)
+        self.assertLess(response.status_code, 400, response.content)
+        project_queries = [
+            q for q in queries if "floto_api_project_members" in q["sql"]
+        ]
+        self.assertEqual(len(project_queries), 1)
+        self.assertEqual(len(queries), n_queries)
+
+    def test_list(self):
+        # Projects, collections, and each collection's user and devices
+        self.assert_project_queries(
+            4,
+            "get",
+            reverse("api:collection-list"),
+            data={"active_project": str(self.project.pk)},
+        )
+
+    def test_active_project_formats(self):
+        other_project = models.Project.objects.create(
+            created_by=self.user, name="other", description="other"
+        )
+        other_project.members.add(self.user)
+        models.Collection.objects.create(
+            created_by=self.user,
+            created_by_project=other_project,
+            name="other collection",
+            description="other",
+        )
+        # Any form of the project's UUID selects it
+        for active_project in [
+            str(self.project.pk).upper(),
+            self.project.pk.hex,
+        ]:
+            response = self.client.get(
+                reverse("api:collection-list"), {"active_project": active_project}
+            )
+            self.assertEqual(
+                [c["name"] for c in response.json()], ["collection"]
+            )
+        response = self.client.get(
+            reverse("api:collection-list"), {"active_project": "not-a-uuid"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_create(self):
+        # created_by_project, projects, the insert and its savepoint, and devices
+        self.assert_project_queries(
+            6,
+            "post",
+            reverse("api:collection-list"),
+            data={
+                "name": "new collection",
+                "description": "new",
+                "created_by_project": str(self.project.pk),
+                "devices": [],
+            },
+            format="json",
+        )
+
+
+class DeviceAccessTest(TestCase):
+    """
+    Tests resolving access to many devices at once
+    """
+
+    def setUp(self):
+        user = create_test_user()
+        self.project, self.other_project, self.third_project = [
+            models.Project.objects.create(created_by=user, name=name, description="")
+            for name in ["project", "other", "third"]
+        ]
+        for name, owner_project, allow_all_projects in [
+            ("owned", self.project, False),
+            ("shared", self.other_project, False),
+            ("open", self.other_project, True),
+            ("private", self.other_project, False),
+        ]:
+            device = models.DeviceData.objects.create(
+                device_uuid=name,
+                owner_project=owner_project,
+                allow_all_projects=allow_all_projects,
+            )
+            if name == "shared":
+                device.application_projects.add(self.third_project)
+
+    def test_get_access(self):
+        device_uuids = ["owned", "shared", "open", "private", "unknown"]
+        with self.assertNumQueries(2):
+            access = models.DeviceData.get_access(
+                device_uuids, {self.project.pk, self.third_project.pk}
+            )
+        self.assertEqual(
+            access,
+            {
+                "owned": (True, True),
+                "shared": (False, True),
+                "open": (False, True),
+                "private": (False, False),
+            },
+        )
+        # Only the active project counts
+        access = models.DeviceData.get_access(
+            device_uuids,
+            {self.project.pk, self.third_project.pk},
+            active_project=self.project,
+        )
+        self.assertEqual(access["owned"], (True, True))
+        self.assertEqual(access["shared"], (False, False))
+
+    def test_device_access_ignores_active_project(self):
+        user = create_test_user("member@test.com")
+        self.project.members.add(user)
+        self.third_project.members.add(user)
+        request = APIRequestFactory().get(
+            "/", {"active_project": str(self.project.pk)}
+        )
+        request.user = user
+        access = get_access_context(request)
+        self.assertEqual(access.active_project, self.project)
+        # As before the access context, only the serializers narrow access to
+        # the active project
+        self.assertEqual(access.device_access(["shared"]), {"shared": (False, True)})
+        self.assertEqual(
+            access.device_access(["shared"], access.active_project),
+            {"shared": (False, False)},
+        )
+
+
+class FleetCatalogTest(TestCase):
+    """
+    Tests that fleets and releases are synced from balena with one request, and
+    served from the database.
+    """
+
+    def setUp(self):
+        self.balena = mock.Mock()
+        self.balena.pine.get.return_value = [
+            {
+                "id": fleet_id,
+                "app_name": f"fleet {fleet_id}",
+                "should_be_running__release": {"__id": fleet_id * 10},
+                "owns__release": [
+                    {
+                        "id": fleet_id * 10,
+                        "commit": "abc",
+                        "created_at": "2024-01-01T00:00:00.000Z",
+                        "status": "success",
+                        "note": None,
+                        "belongs_to__application": {"__id": fleet_id},
+                    }
+                ],
+            }
+            for fleet_id in [1, 2]
+        ]
+        patcher = mock.patch.object(
+            fleets, "get_balena_client", return_value=self.balena
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_refresh_catalog(self):
+        self.assertEqual(
+            fleets.refresh_catalog(),
+            {
+                "fleets_created": 2,
+                "fleets_updated": 0,
+                "releases_created": 2,
+                "releases_updated": 0,
+                "releases_deleted": 0,
+            },
+        )
+        self.assertEqual(models.Fleet.objects.get(pk=2).target_release_id, 20)
+
+        self.balena.pine.get.return_value[1]["owns__release"][0]["note"] = "v2"
+        del self.balena.pine.get.return_value[0]["owns__release"][0]
+        counts = fleets.refresh_catalog()
+        self.assertEqual(counts["releases_updated"], 1)
+        self.assertEqual(counts["releases_deleted"], 1)
+        self.assertEqual(models.Release.objects.get().note, "v2")
+        self.assertIsNone(models.Fleet.objects.get(pk=1).target_release)
+
+    def test_fleet_created_meanwhile(self):
+        # As if sync_balena_device_to_db created the fleet during the refresh
+        models.Fleet.objects.create(id=1, app_name="fleet 1")
+        with mock.patch.object(models.Fleet.objects, "in_bulk", return_value={}):
+            fleets.refresh_catalog()
+        self.assertEqual(models.Fleet.objects.get(pk=1).target_release_id, 10)
+
+    def test_release_note(self):
+        for fleet in self.balena.pine.get.return_value:
+            fleet["app_name"] = "same name"
+        fleets.refresh_catalog()
+        user = create_test_user()
+        user.is_staff = True
+        user.save()
+        client = APIClient()
+        client.force_authenticate(user)
+
+        response = client.post(
+            reverse("api:fleet-note", args=[2, "abc"]), {"note": "v2"}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.balena.models.release.set_note.assert_called_once_with(20, "v2")
+        self.assertEqual(models.Release.objects.get(pk=20).note, "v2")
+
+    def test_fleet_api(self):
+        fleets.refresh_catalog()
+        client = APIClient()
+        client.force_authenticate(create_test_user())
+
+        response = client.get(reverse("api:fleet-list"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [f["app_name"] for f in response.json()], ["fleet 1", "fleet 2"]
+        )
+        response = client.get(
+            reverse("api:fleet-list"), HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        response = client.get(reverse("api:fleet-releases", kwargs={"pk": 2}))
+        self.assertEqual([r["id"] for r in response.json()], [20])
+
+    def test_dashboard_pages(self):
+        fleets.refresh_catalog()
+        self.balena.pine.get.reset_mock()
+        self.client.force_login(create_test_user())
+        # Keeps the OIDC session refresh middleware from redirecting to log in
+        session = self.client.session
+        session["oidc_id_token_expiration"] = timezone.now().timestamp() + 3600
+        session.save()
+        for url in [reverse("dashboard:fleets"), reverse("dashboard:releases")]:
+            response = self.client.get(url)
+            self.assertContains(response, "fleet 1")
+        self.balena.pine.get.assert_not_called()
+
+
+class BalenaClientManagerTest(TestCase):
+    """
+    Tests reading the expiry of balena session tokens, and logging in again
+    when a session is rejected.
+    """
+
+    def test_token_expiry(self):
+        payload = base64.urlsafe_b64encode(json.dumps({"exp": 1700000000}).encode())
+        token = f"header.{payload.decode().rstrip('=')}.signature"
+        get_token_expiry = balena.BalenaClientManager._get_token_expiry
+        self.assertEqual(get_token_expiry(token), 1700000000)
+        # API keys do not expire
+        self.assertEqual(get_token_expiry("api-key"), float("inf"))
+        self.assertEqual(get_token_expiry("a.!!!.b"), float("inf"))
+
+    def test_login_again_when_rejected(self):
+        client_settings = {}
+        balena_client = mock.Mock()
+        balena_client.settings.get.side_effect = client_settings.get
+        balena_client.auth.login.side_effect = lambda **kwargs: client_settings.update(
+            token=f"token {balena_client.auth.login.call_count}"
+        )
+        request = balena_client.pine._request
+        request.side_effect = [
+            sdk_exceptions.RequestError("expired", status_code=401),
+            "ok",
+            sdk_exceptions.RequestError("not found", status_code=404),
+        ]
+
+        manager = balena.BalenaClientManager()
+        with mock.patch.object(balena.balena, "Balena", return_value=balena_client):
+            self.assertIs(manager.get_client(), balena_client)
+        self.assertEqual(balena_client.pine._request("GET", "url"), "ok")
+        self.assertEqual(manager.login_count, 2)
+        self.assertEqual(client_settings["token"], "token 2")
+
+        # Other errors are raised without logging in again
+        with self.assertRaises(sdk_exceptions.RequestError):
+            balena_client.pine._request("GET", "url")
+        self.assertEqual(manager.login_count, 2)
@@ -17,4 +17,6 @@ router.register(
 router.register("peripheral", views.PeripheralViewSet, basename="peripheral")
 router.register("resources", views.ClaimableResourceViewSet, basename="resource")
 router.register("datasets", views.DatasetViewSet, basename="dataset")
+router.register("fleets", views.FleetViewSet, basename="fleet")
+router.register("metrics", views.MetricsViewSet, basename="metrics")
 urlpatterns = router.urls
@@ -1,4 +1,6 @@
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
+from django.utils.timezone import is_naive, make_aware
 from rest_framework.exceptions import ValidationError
 from datetime import datetime, timedelta
 import logging
@@ -83,7 +85,53 @@ def parse_timing_string(value):
         raise ValidationError(f"Invalid timing string {value}")
 
 
-def parse_timings(timings, devices, application_uuid):
+class TimeslotIndex:
+    """
+    Indexes one device's timeslots by start time, so the ones overlapping a
+    window are found by bisection instead of scanning every timeslot.
+    """
+
+    def __init__(self, timeslots):
+        self.timeslots = sorted(timeslots, key=lambda ts: ts.start)
+        self.starts = [ts.start for ts in self.timeslots]
+        self.max_duration = max(
+            (ts.stop - ts.start for ts in self.timeslots), default=timedelta(0)
+        )
+
+    def overlapping(self, start, stop):
+        # A timeslot overlapping [start, stop] can start no earlier than the
+        # longest timeslot's duration before the window.
+        lo = bisect_left(self.starts, start - self.max_duration)
+        hi = bisect_right(self.starts, stop)
+        return [ts for ts in self.timeslots[lo:hi] if ts.stop >= start]
+
+
+def get_conflict_reasons(app_claims, other_claims):
+    """
+    Returns why an application with app_claims cannot share a device with one
+    with other_claims, if it cannot
+    """
+    if app_claims["is_single_tenant"]:
+        # If there is a single tenant claim, there is a conflict.
+        return ["Cannot schedule single-tentant on device due to existing job"]
+    if other_claims["is_single_tenant"]:
+        return ["Single-tenant already scheduled on device"]
+    reasons = [
+        f"'{peripheral}' is already claimed on device"
+        for peripheral in app_claims["peripherals"] & other_claims["peripherals"]
+    ]
+    reasons += [
+        f"'{resource}' is already claimed on device"
+        for resource in app_claims["resources"] & other_claims["resources"]
+    ]
+    reasons += [
+        f"Node port '{port}' is already in use on device"
+        for port in app_claims["ports"] & other_claims["ports"]
+    ]
+    return reasons
+
+
+def parse_timings(timings, devices, application_uuid, save_claims=True):
     """
     Parse the list of timings and devices into
     {
@@ -96,18 +144,10 @@ def parse_timings(timings, devices, application_uuid):
             ]
         }
     }
+    Claims that are computed are saved for later checks only if save_claims is
+    set, so that read-only checks do not write.
     """
     db_app = models.Application.objects.get(pk=application_uuid)
-    db_services = [s.service for s in db_app.services.all()]
-    db_app_peripherals = set(
-        p.peripheral_schema.type
-        for s in db_services
-        for p in s.peripheral_schemas.all()
-    )
-    db_app_resources = set(
-        r.resource.resource for s in db_services for r in s.resources.all()
-    )
-    db_app_ports = set(p.node_port for s in db_services for p in s.ports.all())
 
     res = {
         "conflicts": defaultdict(list),
@@ -117,101 +157,61 @@ def parse_timings(timings, devices, application_uuid):
     for timing in timings:
         res["timeslots"][timing["timing"]] = parse_timing_string(timing["timing"])
 
-    # Compute conflicts
+    windows = [
+        (_as_aware(timeslot["start"]), _as_aware(timeslot["stop"]))
+        for timeslots in res["timeslots"].values()
+        for timeslot in timeslots
+    ]
+    if not windows:
+        return res
+
+    # Load every timeslot that could overlap any window in one query. Timeslots
+    # collide if either one starts before the other stops.
     device_uuids = [d["device_uuid"] for d in devices]
-    for timeslots in res["timeslots"].values():
-        for timeslot in timeslots:
-            start = timeslot["start"]
-            end = timeslot["stop"]
-            # Get all conflicting timeslots on this device. Timeslots collide if either timeslot
-            # overlaps at start, end, or start and end surround
-            timeslots_starting_during_slot = list(
-                models.DeviceTimeslot.objects.filter(
-                    start__range=(start, end), device_uuid__in=device_uuids
-                )
-            )
-            timeslots_ending_during_slot = list(
-                models.DeviceTimeslot.objects.filter(
-                    stop__range=(start, end), device_uuid__in=device_uuids
-                )
-            )
-            timeslots_encompassing_slot = list(
-                models.DeviceTimeslot.objects.filter(
-                    start__lt=start, stop__gt=end, device_uuid__in=device_uuids
-                )
-            )
-            for dts in (
-                timeslots_starting_during_slot
-                + timeslots_ending_during_slot
-                + timeslots_encompassing_slot
-            ):
-                dts_app = dts.job.application
-                # We check the nature of the timeslot.
-                if db_app.is_single_tenant:
-                    # If there is a single tenant claim, there is a conflict.
-                    res["conflicts"][dts.device_uuid].append(
-                        {
-                            "start": dts.start,
-                            "stop": dts.stop,
-                            "reason": "Cannot schedule single-tentant on device due to existing job",
-                        }
-                    )
-                elif dts_app.is_single_tenant:
-                    res["conflicts"][dts.device_uuid].append(
-                        {
-                            "start": dts.start,
-                            "stop": dts.stop,
-                            "reason": "Single-tenant already scheduled on device",
-                        }
-                    )
-                else:
-                    dts_services = [s.service for s in dts_app.services.all()]
-                    # Check if peripherals are in conflict
-                    dts_app_peripherals = set(
-                        p.peripheral_schema.type
-                        for s in dts_services
-                        for p in s.peripheral_schemas.all()
-                    )
-                    for peripheral in db_app_peripherals.intersection(
-                        dts_app_peripherals
-                    ):
-                        res["conflicts"][dts.device_uuid].append(
-                            {
-                                "start": dts.start,
-                                "stop": dts.stop,
-                                "reason": f"'{peripheral}' is already claimed on device",
-                            }
-                        )
-
-                    # Check if claimed resources are in conflict
-                    dts_app_resources = set(
-                        r.resource.resource
-                        for s in dts_services
-                        for r in s.resources.all()
-                    )
-                    for resource in db_app_resources.intersection(dts_app_resources):
-                        res["conflicts"][dts.device_uuid].append(
-                            {
-                                "start": dts.start,
-                                "stop": dts.stop,
-                                "reason": f"'{resource}' is already claimed on device",
-                            }
-                        )
-                    # Check if node ports are in conflict
-                    dts_app_ports = set(
-                        p.node_port for s in dts_services for p in s.ports.all()
+    candidates = models.DeviceTimeslot.objects.filter(
+        device_uuid__in=device_uuids,
+        start__lte=max(stop for _, stop in windows),
+        stop__gte=min(start for start, _ in windows),
+    ).select_related("job__application")
+    device_timeslots = defaultdict(list)
+    for dts in candidates:
+        device_timeslots[dts.device_uuid].append(dts)
+    if not device_timeslots:
+        return res
+
+    # Conflicts only depend on the other application, so check each one once
+    apps = {
+        dts.job.application_id: dts.job.application
+        for timeslots in device_timeslots.values()
+        for dts in timeslots
+    }
+    models.Application.load_claims([db_app, *apps.values()], save=save_claims)
+    app_claims = db_app.get_claims()
+    reasons_by_app = {
+        app_id: get_conflict_reasons(app_claims, app.get_claims())
+        for app_id, app in apps.items()
+    }
+
+    for device_uuid, timeslots in device_timeslots.items():
+        index = TimeslotIndex(timeslots)
+        seen = set()
+        for start, stop in windows:
+            for dts in index.overlapping(start, stop):
+                if dts.pk in seen:
+                    continue
+                seen.add(dts.pk)
+                for reason in reasons_by_app[dts.job.application_id]:
+                    res["conflicts"][device_uuid].append(
+                        {"start": dts.start, "stop": dts.stop, "reason": reason}
                     )
-                    for port in db_app_ports.intersection(dts_app_ports):
-                        res["conflicts"][dts.device_uuid].append(
-                            {
-                                "start": dts.start,
-                                "stop": dts.stop,
-                                "reason": f"Node port '{port}' is already in use on device",
-                            }
-                        )
     return res
 
 
+def _as_aware(value):
+    # On-demand timings use naive local times, which the DB treats as UTC
+    return make_aware(value) if is_naive(value) else value
+
+
 def parse_javascript_iso_string(date_str):
     """
     Javascript ISO date format adds "Z" to the end, but python
@@ -2,12 +2,14 @@ from collections import defaultdict
 import json
 
 from django.conf import settings
+from django.core.cache import cache
 from django.http import Http404
 from django.db.models import Q
 from drf_spectacular.types import OpenApiTypes
 from drf_spectacular.utils import extend_schema, extend_schema_view, OpenApiParameter
 from drf_spectacular.helpers import forced_singular_serializer
 import base64
+import hashlib
 import logging
 import ssl
 import socket
@@ -16,6 +18,7 @@ from datetime import datetime
 
 from floto.api.models import (
     DeviceData,
+    DeviceSnapshot,
     Peripheral,
     PeripheralConfigurationItem,
     PeripheralInstance,
@@ -24,6 +27,7 @@ from floto.api.models import (
     Project,
     Collection,
     Job,
+    Release,
 )
 from floto.api.openapi import (
     InlineDeviceSerializer,
@@ -49,9 +53,9 @@ from floto.api.openapi import (
 )
 from floto.auth.models import KeycloakUser
 
-from .balena import get_balena_client
+from .balena import client_manager, get_balena_client, get_device_env_vars
 
-from floto.api import filters, permissions
+from floto.api import filters, fleets, permissions
 from floto.api.serializers import (
     ClaimableResourceSerializer,
     DeviceSerializer,
@@ -66,20 +70,33 @@ from floto.api.serializers import (
     TimeslotSerializer,
     PeripheralInstaceSerializer,
     DatasetSerializer,
+    FleetSerializer,
+    ReleaseSerializer,
 )
 from floto.api import util
 from floto.api.models import CollectionDevice
 from rest_framework import viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import APIException
 from rest_framework import filters as drf_filters
+from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from rest_framework import status
 
-from floto.api import kubernetes
+from floto.api import kubernetes, tasks
+from floto.celery import get_task_metrics
 
 LOG = logging.getLogger(__name__)
 
 
+class DeviceSnapshotUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Devices are still being loaded, try again shortly."
+    default_code = "device_snapshot_unavailable"
+    # Seconds sent in the Retry-After header
+    wait = 10
+
+
 @extend_schema_view(
     list=extend_schema(
         description="List all devices",
@@ -161,14 +178,32 @@ class DeviceViewSet(viewsets.ViewSet):
             res = f.filter_queryset(request, res, view)
         return res
 
+    def get_device_snapshot(self):
+        """
+        Returns the materialized balena/kubernetes state that devices are served from.
+        """
+        snapshot = DeviceSnapshot.current()
+        if snapshot is None:
+            # Nothing has been built yet, e.g. on a fresh deployment. Building it
+            # takes too long for a request, so a worker builds it instead.
+            if cache.add("device-snapshot-refresh-queued", True, timeout=60):
+                tasks.refresh_device_snapshot.delay()
+            raise DeviceSnapshotUnavailable()
+        return snapshot
+
     def list(self, request):
-        balena = get_balena_client()
-        res = DeviceViewSet.filter(request, balena.models.device.get_all(), self)
+        self.device_snapshot = self.get_device_snapshot()
+        res = DeviceViewSet.filter(
+            request, self.device_snapshot.balena_devices.values(), self
+        )
         return Response(res)
 
     def retrieve(self, request, pk):
-        balena = get_balena_client()
-        res = DeviceViewSet.filter(request, [balena.models.device.get(pk)], self)
+        self.device_snapshot = self.get_device_snapshot()
+        balena_device = self.device_snapshot.balena_devices.get(pk)
+        if not balena_device:
+            raise Http404
+        res = DeviceViewSet.filter(request, [balena_device], self)
         # Note we are essentially just checking this device
         # was not filtered out entirely
         if res:
@@ -291,9 +326,10 @@ class DeviceViewSet(viewsets.ViewSet):
 
     @action(methods=["GET"], detail=True, url_path="environment")
     def environment_retrieve(self, request, pk):
-        balena = get_balena_client()
-        env = balena.models.device.env_var.get_all_by_device(uuid_or_id=pk)
-        return Response(env, status=status.HTTP_200_OK)
+        env_vars = get_device_env_vars([pk])
+        if pk not in env_vars:
+            raise Http404
+        return Response(env_vars[pk], status=status.HTTP_200_OK)
 
 
 @extend_schema_view(
@@ -425,6 +461,7 @@ class JobViewSet(ModelWithOwnerViewSet):
                 request.data["timings"],
                 request.data["devices"],
                 request.data["application"]["uuid"],
+                save_claims=False,
             )
         )
 
@@ -612,3 +649,82 @@ class DatasetViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         return self.serializer_class.Meta.model.objects.filter(approved=True)
+
+
+def etag_response(request, data):
+    """
+    Returns data with an ETag of its content, or 304 Not Modified if the client
+    already has it
+    """
+    digest = hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode())
+    etag = f'"{digest.hexdigest()}"'
+    if etag in request.headers.get("If-None-Match", ""):
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return Response(data, headers={"ETag": etag})
+
+
+@extend_schema_view(
+    list=extend_schema(description="List all fleets."),
+    retrieve=extend_schema(description="Gets a fleet by ID."),
+    releases=extend_schema(
+        description="List the releases of a fleet, newest first.",
+        responses=ReleaseSerializer(many=True),
+    ),
+    note=extend_schema(
+        description="Set the note of a fleet's release. Only permitted for admins.",
+        request=None,
+        responses=ReleaseSerializer,
+    ),
+)
+class FleetViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    Fleets and releases, as synced from balena by sync_fleet_releases
+    """
+
+    serializer_class = FleetSerializer
+    lookup_value_regex = r"[0-9]+"
+
+    def get_queryset(self):
+        return fleets.get_fleets()
+
+    def list(self, request):
+        return etag_response(
+            request, self.get_serializer(self.get_queryset(), many=True).data
+        )
+
+    @action(detail=True, url_path="releases")
+    def releases(self, request, pk):
+        return etag_response(
+            request,
+            ReleaseSerializer(fleets.get_releases(int(pk)), many=True).data,
+        )
+
+    @action(
+        methods=["POST"],
+        detail=True,
+        url_path=r"releases/(?P<commit>[^/.]+)/note",
+        permission_classes=[IsAdminUser],
+    )
+    def note(self, request, pk, commit):
+        try:
+            release = Release.objects.get(fleet_id=int(pk), commit=commit)
+        except Release.DoesNotExist:
+            raise Http404
+        fleets.set_release_note(release, request.data.get("note", ""))
+        return Response(ReleaseSerializer(release).data)
+
+
+@extend_schema_view(
+    list=extend_schema(
+        description="Runtime metrics of the background tasks, and balena client "
+        "stats of the serving process. Only permitted for admins.",
+        responses=OpenApiTypes.OBJECT,
+    ),
+)
+class MetricsViewSet(viewsets.ViewSet):
+    permission_classes = [IsAdminUser]
+
+    def list(self, request):
+        return Response(
+            {"tasks": get_task_metrics(), "balena": client_manager.stats()}
+        )
@@ -1,9 +1,12 @@
-from keycloak import KeycloakAdmin
+from keycloak import KeycloakAdmin, KeycloakGetError
 
 
 from django.conf import settings
+from django.core.cache import cache
 
 import logging
+import os
+import threading
 
 LOG = logging.getLogger(__name__)
 
@@ -44,3 +47,56 @@ class KeycloakClient:
             LOG.error(groups)
         group_id = groups[0]["id"]
         self.keycloak_admin.group_user_add(user_id, group_id)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def _reset_client():
+    global _client, _client_lock
+    _client = None
+    _client_lock = threading.Lock()
+
+
+# The admin session must not be shared with forked children, e.g. celery workers
+os.register_at_fork(after_in_child=_reset_client)
+
+
+def get_keycloak_client():
+    """
+    Returns the process's KeycloakClient. Its admin connection fetches a token
+    once, and a new one when it expires, instead of once per client.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = KeycloakClient()
+        return _client
+
+
+def _user_cache_key(user_id):
+    return f"keycloak-user:{user_id}"
+
+
+def get_cached_user(user_id):
+    """
+    Returns the Keycloak representation of the user, which is kept for
+    KEYCLOAK_USER_CACHE_TTL seconds. Users that do not exist in Keycloak are
+    kept as {} for KEYCLOAK_USER_NEGATIVE_CACHE_TTL seconds.
+    """
+    key = _user_cache_key(user_id)
+    user = cache.get(key)
+    if user is not None:
+        return user
+    try:
+        user = get_keycloak_client().get_user_by_id(str(user_id))
+        timeout = settings.KEYCLOAK_USER_CACHE_TTL
+    except KeycloakGetError as e:
+        if e.response_code != 404:
+            raise
+        LOG.warning(f"User {user_id} does not exist in Keycloak")
+        user = {}
+        timeout = settings.KEYCLOAK_USER_NEGATIVE_CACHE_TTL
+    cache.set(key, user, timeout=timeout)
+    return user
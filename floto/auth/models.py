@@ -8,7 +8,7 @@ from django.db.models import signals
 from keycloak import KeycloakError
 from rest_framework.authtoken import models as token_models
 
-from floto.auth.keycloak import KeycloakClient
+from floto.auth.keycloak import get_cached_user, get_keycloak_client
 
 import logging
 
@@ -30,8 +30,7 @@ class KeycloakUserManager(auth_models.UserManager):
         # NOTE We do not use username, it's a random string from keycloak.
         # Instead, we use email, as keycloak also enforces that is unique.
         try:
-            keycloak_client = KeycloakClient()
-            keycloak_user = keycloak_client.get_user_by_email(email)
+            keycloak_user = get_keycloak_client().get_user_by_email(email)
         except KeycloakError as e:
             raise ValueError(f"Failed to fetch user {email} from Keycloak") from e
         return super().create_user(
@@ -79,11 +78,11 @@ class KeycloakUser(auth_models.AbstractUser):
 
     @property
     def keycloak_client(self):
-        return KeycloakClient()
+        return get_keycloak_client()
 
     @cached_property
     def keycloak_user(self):
-        return self.keycloak_client.get_user_by_id(self.id)
+        return get_cached_user(self.id)
 
     @transaction.atomic
     def rotate_api_token(self):
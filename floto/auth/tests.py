@@ -1,7 +1,13 @@
+import uuid
+from unittest import mock
+
+from django.core.cache import cache
 from django.test import TestCase
 from django.urls import reverse
+from keycloak import KeycloakGetError
 from rest_framework import status
 
+from floto.auth import keycloak
 from floto.auth.models import KeycloakUser
 
 
@@ -35,3 +41,41 @@ class ApiKeyTest(TestCase):
             test_url, headers={"Authorization": f"Token {test_key}"}
         )
         self.assertEquals(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class KeycloakUserCacheTest(TestCase):
+    """
+    Tests that Keycloak users are fetched once, and shared between requests
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = KeycloakUser.objects.create(
+            id=uuid.uuid4(), username="test@test.com", email="test@test.com"
+        )
+        self.keycloak_client = mock.Mock()
+        patcher = mock.patch.object(
+            keycloak, "get_keycloak_client", return_value=self.keycloak_client
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_user_is_cached(self):
+        self.keycloak_client.get_user_by_id.return_value = {
+            "enabled": True,
+            "firstName": "Test",
+            "lastName": "User",
+        }
+        for _ in range(3):
+            user = KeycloakUser.objects.get(pk=self.user.pk)
+            self.assertTrue(user.is_active)
+            self.assertEqual(user.get_full_name(), "Test User")
+        self.keycloak_client.get_user_by_id.assert_called_once_with(str(self.user.pk))
+
+    def test_missing_user_is_cached(self):
+        self.keycloak_client.get_user_by_id.side_effect = KeycloakGetError(
+            error_message="User not found", response_code=404
+        )
+        for _ in range(2):
+            self.assertFalse(KeycloakUser.objects.get(pk=self.user.pk).is_active)
+        self.keycloak_client.get_user_by_id.assert_called_once()
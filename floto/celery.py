@@ -1,12 +1,20 @@
+import functools
+import logging
 import os
+import time
+
 from django.apps import apps
 from django.conf import settings
 
-from celery import Celery
+import redis
+from celery import Celery, Task
+from celery.signals import task_postrun, task_prerun
 
 # Set the default Django settings module for the 'celery' program.
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "floto.settings")
 
+LOG = logging.getLogger(__name__)
+
 app = Celery("floto")
 
 # Using a string here means the worker doesn't have to serialize
@@ -20,6 +28,88 @@ if not settings.FLOTO_DISABLE_CELERY:
     app.autodiscover_tasks(lambda: [n.name for n in apps.get_app_configs()])
 
 
+@functools.lru_cache(maxsize=None)
+def get_redis():
+    return redis.Redis.from_url(settings.CELERY_BROKER_URL)
+
+
+class SingletonTask(Task):
+    """
+    Task that skips a run while another run of it still holds its lock, so that
+    beat ticks do not pile up behind a slow run. The lock expires after the
+    task's time limit, in case its worker dies without releasing it.
+    """
+
+    def __call__(self, *args, **kwargs):
+        lock = get_redis().lock(
+            f"floto-task-lock:{self.name}",
+            timeout=self.time_limit or settings.CELERY_SINGLETON_LOCK_TIMEOUT,
+            blocking=False,
+        )
+        if not lock.acquire():
+            LOG.info(f"Skipping {self.name}, its previous run has not finished")
+            get_redis().hincrby(f"floto-task-metrics:{self.name}", "skipped", 1)
+            return None
+        try:
+            return super().__call__(*args, **kwargs)
+        finally:
+            try:
+                lock.release()
+            except redis.exceptions.LockError:
+                LOG.warning(f"Lock for {self.name} expired before the task finished")
+
+
+_task_started = {}
+
+
+@task_prerun.connect
+def record_task_start(task_id=None, **kwargs):
+    _task_started[task_id] = time.monotonic()
+
+
+@task_postrun.connect
+def record_task_metrics(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is None:
+        return
+    elapsed = time.monotonic() - started
+    LOG.info(f"Task {task.name} finished with {state} in {elapsed:.2f}s")
+    key = f"floto-task-metrics:{task.name}"
+    try:
+        pipe = get_redis().pipeline()
+        pipe.hincrby(key, "runs", 1)
+        if state != "SUCCESS":
+            pipe.hincrby(key, "failures", 1)
+        pipe.hincrbyfloat(key, "total_seconds", elapsed)
+        pipe.hset(
+            key,
+            mapping={
+                "last_seconds": elapsed,
+                "last_state": state,
+                "last_run": time.time(),
+            },
+        )
+        pipe.execute()
+    except redis.exceptions.RedisError as e:
+        LOG.warning(f"Could not record metrics for {task.name}: {e}")
+
+
+def get_task_metrics():
+    """
+    Returns {task name: {metric: value}} for the tasks that have run, with the
+    number of runs, failures and skipped runs, and their total and last runtime.
+    """
+    metrics = {}
+    for key in get_redis().scan_iter(match="floto-task-metrics:*"):
+        name = key.decode().split(":", 1)[1]
+        values = {k.decode(): v.decode() for k, v in get_redis().hgetall(key).items()}
+        metrics[name] = {
+            field: value if field == "last_state" else float(value)
+            for field, value in values.items()
+        }
+    return metrics
+
+
 @app.task(bind=True, ignore_result=True)
 def debug_task(self):
     print(f"Request: {self.request!r}")
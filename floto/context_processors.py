@@ -1,3 +1,4 @@
+from .api.access import get_access_context
 from .api.serializers import ProjectSerializer
 import logging
 
@@ -8,7 +9,7 @@ def global_values(request):
     selected_project = {}
     projects = []
     if request.user.is_authenticated:
-        projects = list(request.user.projects.all())
+        projects = get_access_context(request).projects
         if not request.session.get("selected_project"):
             try:
                 request.session["selected_project"] = ProjectSerializer(
@@ -6,8 +6,8 @@ import json
 import logging
 from django.views.decorators.clickjacking import xframe_options_exempt
 
-from . import util
 from .. import util as floto_util
+from floto.api import fleets as fleets_service
 from floto.api.models import DownloadEvent, Dataset
 
 LOG = logging.getLogger(__name__)
@@ -26,31 +26,23 @@ def device(request, uuid):
 
 
 def releases(request, fleet=None):
-    releases = util.get_all_releases(request, fleet)
-
     context = {
-        "releases": sorted(releases, key=lambda r: (r["id"]), reverse=True),
+        "releases": fleets_service.get_releases(fleet),
     }
     template = loader.get_template("dashboard/releases.html")
     return HttpResponse(template.render(context, request))
 
 
 def fleets(request):
-    fleets = util.getURL(request, "api:fleet-list", [])
-    releases_by_id = util.get_releases_by_id(request)
     processed_fleets = []
-    for fleet in fleets:
+    for fleet in fleets_service.get_fleets():
+        release = fleet.target_release
         processed_fleets.append(
             {
-                "app_name": fleet["app_name"],
+                "app_name": fleet.app_name,
+                "target_release": (release.note or release.id) if release else "None",
             }
         )
-        try:
-            release_id = fleet["should_be_running__release"]["__id"]
-            note = releases_by_id[release_id]["note"]
-            processed_fleets[-1]["target_release"] = note if note else release_id
-        except (KeyError, TypeError):
-            processed_fleets[-1]["target_release"] = "None"
 
     context = {
         "fleets": processed_fleets,
@@ -157,6 +157,9 @@ USE_TZ = True
 STATIC_ROOT = "/static"
 STATIC_URL = "/static/"
 
+# Uploaded files, e.g. device CSV imports, which background tasks read as well
+MEDIA_ROOT = os.environ.get("MEDIA_ROOT", "/media")
+
 
 STATICFILES_DIRS = (os.path.join(BASE_DIR, "floto", "static"),)
 STATICFILES_FINDERS = (
@@ -238,6 +241,12 @@ OIDC_RP_CLIENT_ID = os.environ["OIDC_RP_CLIENT_ID"]
 OIDC_RP_CLIENT_SECRET = os.environ["OIDC_RP_CLIENT_SECRET"]
 OIDC_RP_ADMIN_CLIENT_ID = os.environ["OIDC_RP_ADMIN_CLIENT_ID"]
 OIDC_RP_ADMIN_CLIENT_SECRET = os.environ["OIDC_RP_ADMIN_CLIENT_SECRET"]
+# How long user details fetched from Keycloak are reused
+KEYCLOAK_USER_CACHE_TTL = int(os.environ.get("KEYCLOAK_USER_CACHE_TTL", "300"))
+# How long to remember that a user does not exist in Keycloak
+KEYCLOAK_USER_NEGATIVE_CACHE_TTL = int(
+    os.environ.get("KEYCLOAK_USER_NEGATIVE_CACHE_TTL", "60")
+)
 
 OIDC_OP_AUTHORIZATION_ENDPOINT = (
     "https://auth.floto.science/realms/floto/protocol/openid-connect/auth"
@@ -260,6 +269,23 @@ BALENA_USERNAME = os.environ.get("BALENA_USERNAME")
 BALENA_PASSWORD = os.environ.get("BALENA_PASSWORD")
 BALENA_TUNNEL_PORT = os.environ.get("BALENA_TUNNEL_PORT")
 BALENA_TUNNEL_HOST = os.environ.get("BALENA_TUNNEL_HOST")
+# Log in to balena again when the session token is this close to expiring
+BALENA_TOKEN_REFRESH_MARGIN = int(os.environ.get("BALENA_TOKEN_REFRESH_MARGIN", "300"))
+# Log the balena client's login counts every this many client requests
+BALENA_STATS_LOG_INTERVAL = int(os.environ.get("BALENA_STATS_LOG_INTERVAL", "100"))
+# How long device environment variables fetched from balena are reused
+BALENA_ENV_VAR_CACHE_TTL = int(os.environ.get("BALENA_ENV_VAR_CACHE_TTL", "60"))
+
+# Cache shared by all web and task processes, if set, e.g. redis://redis:6379/1.
+# Otherwise each process has its own.
+CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL")
+if CACHE_REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": CACHE_REDIS_URL,
+        }
+    }
 
 # DRF
 REST_FRAMEWORK = {
@@ -301,12 +327,62 @@ else:
 
 KUBE_JOB_TTL = int(os.environ.get("KUBE_JOB_TTL", str(timedelta(days=7).total_seconds)))
 KUBE_READ_ONLY = os.environ.get("KUBE_READ_ONLY", "false").lower() == "true"
+# Seconds to wait on each cluster before leaving its data out of a response
+KUBE_CLUSTER_TIMEOUT = int(os.environ.get("KUBE_CLUSTER_TIMEOUT", "10"))
+# Seconds to wait for the logs of each container, and for all of a job's logs
+KUBE_LOG_REQUEST_TIMEOUT = int(os.environ.get("KUBE_LOG_REQUEST_TIMEOUT", "10"))
+KUBE_LOGS_TIMEOUT = int(os.environ.get("KUBE_LOGS_TIMEOUT", "30"))
+# Threads shared by queries that are sent to every cluster at once
+KUBE_FANOUT_WORKERS = int(os.environ.get("KUBE_FANOUT_WORKERS", "16"))
+# How many devices create_deployment deploys to at once, per cluster
+KUBE_DEPLOY_CONCURRENCY = int(os.environ.get("KUBE_DEPLOY_CONCURRENCY", "8"))
+# Deploy with server-side apply, instead of creating objects that don't exist
+KUBE_SERVER_SIDE_APPLY = (
+    os.environ.get("KUBE_SERVER_SIDE_APPLY", "true").lower() == "true"
+)
+KUBE_FIELD_MANAGER = os.environ.get("KUBE_FIELD_MANAGER", "floto")
+# Serve node and pod reads from the list+watch cache of each cluster, which the
+# watch_clusters command keeps in the shared cache (see CACHE_REDIS_URL). Reads
+# go to the API while it is not running, or has not been in sync for
+# KUBE_WATCH_SYNCED_TTL seconds.
+KUBE_WATCH_CACHE = os.environ.get("KUBE_WATCH_CACHE", "true").lower() == "true"
+KUBE_WATCH_SYNCED_TTL = int(os.environ.get("KUBE_WATCH_SYNCED_TTL", "60"))
+KUBE_WATCH_TIMEOUT = int(os.environ.get("KUBE_WATCH_TIMEOUT", "300"))
+KUBE_WATCH_RETRY_SECONDS = int(os.environ.get("KUBE_WATCH_RETRY_SECONDS", "10"))
+# How long collect_events watches each cluster for new events per run
+KUBE_EVENT_WATCH_SECONDS = int(os.environ.get("KUBE_EVENT_WATCH_SECONDS", "60"))
 
 # FLOTO configuration
 FLOTO_ENV_PREFIX = os.environ.get("FLOTO_ENV_PREFIX", "FLOTO_")
 FLOTO_ADMIN_PROJECT = os.environ.get("FLOTO_ADMIN_PROJECT")
 FLOTO_DISABLE_CELERY = bool(os.environ.get("FLOTO_DISABLE_CELERY", False))
 
+# Looks up device coordinates from their address
+GEOCODER_BACKEND = os.environ.get(
+    "GEOCODER_BACKEND", "floto.api.geocoding.NominatimGeocoder"
+)
+# Geocoding requests per worker, Nominatim allows one per second
+GEOCODER_RATE_LIMIT = os.environ.get("GEOCODER_RATE_LIMIT", "1/s")
+
+# Rows of a device CSV import applied per transaction
+DEVICE_IMPORT_CHUNK_SIZE = int(os.environ.get("DEVICE_IMPORT_CHUNK_SIZE", "500"))
+# At most this many invalid rows of a device CSV import are recorded
+DEVICE_IMPORT_MAX_ERRORS = int(os.environ.get("DEVICE_IMPORT_MAX_ERRORS", "1000"))
+
+# How many versions of the device snapshot to keep
+DEVICE_SNAPSHOT_RETENTION = int(os.environ.get("DEVICE_SNAPSHOT_RETENTION", "5"))
+
+# Events due within this many seconds are queued to deploy at their time
+DEPLOY_LOOKAHEAD_SECONDS = int(os.environ.get("DEPLOY_LOOKAHEAD_SECONDS", "120"))
+# A deployment still running after this long is assumed dead, and retried
+DEPLOY_CLAIM_TIMEOUT = int(os.environ.get("DEPLOY_CLAIM_TIMEOUT", "3600"))
+# Attempts to deploy an event before it is left in error
+DEPLOY_MAX_ATTEMPTS = int(os.environ.get("DEPLOY_MAX_ATTEMPTS", "3"))
+# Seconds before retrying a failed deployment, doubled after each attempt
+DEPLOY_RETRY_BACKOFF_SECONDS = int(
+    os.environ.get("DEPLOY_RETRY_BACKOFF_SECONDS", "60")
+)
+
 # Celery task configuration
 CELERY_BROKER_URL = "redis://redis:6379"
 CELERY_RESULT_BACKEND = "redis://redis:6379"
@@ -316,6 +392,28 @@ CELERY_TASK_SERIALIZER = "json"
 CELERY_IMPORTS = [
     "floto.api.tasks",
 ]
+# Each queue has its own workers, so that e.g. a slow event collection does not
+# delay deployments, and deploy workers can be scaled on their own
+CELERY_TASK_DEFAULT_QUEUE = "sync"
+CELERY_TASK_ROUTES = {
+    "prepare_job_deployment": {"queue": "deploy"},
+    "deploy_jobs": {"queue": "deploy"},
+    "deploy_event": {"queue": "deploy"},
+    "cleanup_namespaces": {"queue": "deploy"},
+    "label_nodes": {"queue": "sync"},
+    "sync_balena_device_to_db": {"queue": "sync"},
+    "sync_fleet_releases": {"queue": "sync"},
+    "refresh_device_snapshot": {"queue": "sync"},
+    "rename_devices": {"queue": "sync"},
+    "import_devices": {"queue": "sync"},
+    "geocode_devices": {"queue": "sync"},
+    "geocode_address": {"queue": "sync"},
+    "collect_events": {"queue": "telemetry"},
+}
+# Long tasks hold up the other tasks prefetched by the same worker process
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+# Lock expiry for singleton tasks without a time limit
+CELERY_SINGLETON_LOCK_TIMEOUT = 600
 CELERY_BEAT_SCHEDULE = {
     "label_nodes": {
         "task": "label_nodes",
@@ -325,6 +423,14 @@ CELERY_BEAT_SCHEDULE = {
         "task": "sync_balena_device_to_db",
         "schedule": crontab(minute="*/5"),
     },
+    "sync_fleet_releases": {
+        "task": "sync_fleet_releases",
+        "schedule": crontab(minute="*/5"),
+    },
+    "refresh_device_snapshot": {
+        "task": "refresh_device_snapshot",
+        "schedule": crontab(minute="*/1"),
+    },
     "rename_devices": {
         "task": "rename_devices",
         "schedule": crontab(minute="*/3"),